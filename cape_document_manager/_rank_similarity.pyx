@@ -1,28 +1,58 @@
-from libc.math cimport log, sqrt, fmax
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
 
+from libc.math cimport log, sqrt
 
-def rank_similarity(py_match_info, *raw_weights):
+cdef enum:
+    _MAX_COLUMNS = 64
+
+cdef double _BM25_K1 = 1.2
+cdef double _BM25_B = 0.75
+
+# Column weights of the last call, SQLite passes the same constant weights for every row of a query
+cdef tuple _parsed_weights = None
+cdef double _column_weights[_MAX_COLUMNS]
+
+
+cdef void _parse_weights(tuple raw_weights) except *:
+    global _parsed_weights
+    if len(raw_weights) > _MAX_COLUMNS:
+        raise ValueError(f"Ranking functions support at most {_MAX_COLUMNS} columns, got {len(raw_weights)} weights")
+    for col in range(_MAX_COLUMNS):
+        _column_weights[col] = <double> raw_weights[col] if col < len(raw_weights) else 0.0
+    _parsed_weights = raw_weights
+
+
+cdef const unsigned int *_checked_match_info(bytes py_match_info) except NULL:
+    "matchinfo(table, 'pcnalx') read in place, after checking that it holds all the columns and terms"
+    cdef const unsigned int *match_info = <const unsigned int *> (<const char *> py_match_info)
+    if len(py_match_info) < 3 * sizeof(unsigned int) or match_info[1] > _MAX_COLUMNS or \
+            <size_t> len(py_match_info) < (3 + 2 * match_info[1] + 3 * match_info[1] * match_info[0]) * \
+            sizeof(unsigned int):
+        raise ValueError("Expected matchinfo(table, 'pcnalx')")
+    return match_info
+
+
+def rank_similarity(bytes py_match_info, *raw_weights):
     # Usage: pseudo_similarity(matchinfo(table, 'pcnalx'), 1,...)
     # An approximation of the tf-idf cosine similarity that computes norms based on term intersection only
-    # raw_weights is an array of weights per column
+    # raw_weights is an array of weights per column, columns without a weight are ignored
     cdef:
-        unsigned int *match_info
-        bytes _match_info_buf = bytes(py_match_info)
-        char *match_info_buf = _match_info_buf
-        int term_count, col_count, initial_position, initial_row_col
+        const unsigned int *match_info = _checked_match_info(py_match_info)
+        unsigned int term_count, col_count, col, term, initial_position, initial_row_col
         double total_docs, term_frequency, docs_with_hits, idf, tfidf_doc, tfidf_query, score, col_weight
         double pseudo_norm_doc = 0.0
         double norm_query = 0.0
         double component_sum = 0.0
 
-    match_info = <unsigned int *> match_info_buf
+    if raw_weights != _parsed_weights:
+        _parse_weights(raw_weights)
     term_count = match_info[0]
     col_count = match_info[1]
     total_docs = match_info[2]
     initial_position = 3 + col_count + col_count
 
     for col in range(col_count):
-        col_weight = <double> raw_weights[col]
+        col_weight = _column_weights[col]
         if col_weight == 0.0:
             continue
         for term in range(term_count):
@@ -48,5 +78,38 @@ def rank_similarity(py_match_info, *raw_weights):
 
     return -1 * score
 
-def register_rank_functions(database):
-    database.register_function(rank_similarity, 'rank_similarity')
+
+def rank_bm25(bytes py_match_info, *raw_weights):
+    # Usage: rank_bm25(matchinfo(table, 'pcnalx'), 1,...)
+    # Okapi BM25 with k1=1.2 and b=0.75, summed over the columns times their weight, negated like rank_similarity
+    cdef:
+        const unsigned int *match_info = _checked_match_info(py_match_info)
+        unsigned int term_count, col_count, col, term, initial_position, initial_row_col
+        double total_docs, term_frequency, docs_with_hits, idf, col_weight, average_length, length_norm
+        double score = 0.0
+
+    if raw_weights != _parsed_weights:
+        _parse_weights(raw_weights)
+    term_count = match_info[0]
+    col_count = match_info[1]
+    total_docs = match_info[2]
+    initial_position = 3 + col_count + col_count
+
+    for col in range(col_count):
+        col_weight = _column_weights[col]
+        if col_weight == 0.0:
+            continue
+        average_length = match_info[3 + col]
+        length_norm = _BM25_K1 * (1.0 - _BM25_B)
+        if average_length > 0.0:
+            length_norm += _BM25_K1 * _BM25_B * match_info[3 + col_count + col] / average_length
+        for term in range(term_count):
+            initial_row_col = initial_position + 3 * (col + term * col_count)
+            term_frequency = match_info[initial_row_col]
+            docs_with_hits = match_info[initial_row_col + 2]
+            idf = log((total_docs - docs_with_hits + 0.5) / (docs_with_hits + 0.5))
+            if idf <= 0.0:  # terms in more than half of the rows still count a little
+                idf = 1e-6
+            score += col_weight * idf * term_frequency * (_BM25_K1 + 1.0) / (term_frequency + length_norm)
+
+    return -1 * score
@@ -13,10 +13,10 @@
 # limitations under the License.
 
 import random
-from collections import OrderedDict
-from typing import List, Dict, Iterable, Optional
+from copy import deepcopy
+from typing import List, Dict, Iterable, Optional, Generator, Tuple
 from cape_document_manager.document_manager_core import Retriever, Retrievable, Indexable, AUTOFILL, SearchResult, \
-    roundrobin
+    decode_cursor, paginate
 from cape_api_helpers.exceptions import UserException
 from cape_api_helpers.text_responses import *
 import calendar
@@ -25,6 +25,13 @@ from itertools import chain
 from cytoolz import compose
 from uuid import uuid4
 from datetime import datetime
+from cape_document_manager.document_manager_settings import DEFAULT_PAGE_SIZE, DOCUMENT_BULK_BATCH_SIZE
+from cape_document_manager.rank_similarity import Ranking, DEFAULT_RANKING
+from cape_document_manager.write_queue import queued_write
+from cape_document_manager.shards import shard_router, tenant_routed
+
+# Ranks the canonical question of an annotation above its paraphrases when they match as well
+CANONICAL_BOOST_RANKING = Ranking(boosts=(('canonical', True, 1.2),))
 
 
 @dataclass
@@ -35,6 +42,10 @@ class AnnotationAnswer(Indexable):
     document_id: str = field(default=AUTOFILL)
     page: int = field(default=AUTOFILL)
 
+    @staticmethod
+    def stable_id_field() -> Optional[str]:
+        return 'annotation_answer_id'
+
 
 @dataclass
 class AnnotationQuestion(Indexable):
@@ -45,6 +56,10 @@ class AnnotationQuestion(Indexable):
     document_id: str = field(default=AUTOFILL)
     page: int = field(default=AUTOFILL)
 
+    @staticmethod
+    def stable_id_field() -> Optional[str]:
+        return 'annotation_question_id'
+
 
 @dataclass
 class Annotation(Retrievable):
@@ -57,6 +72,10 @@ class Annotation(Retrievable):
     created: datetime = field(default_factory=datetime.now)
     modified: datetime = field(default_factory=datetime.now)
 
+    @staticmethod
+    def volatile_fields() -> Tuple[str, ...]:
+        return 'created', 'modified'
+
     @staticmethod
     def transformer(annotation: 'Annotation') -> Iterable[Indexable]:
         return iter(chain(annotation.questions.values(), annotation.answers.values()))
@@ -71,7 +90,21 @@ class Annotation(Retrievable):
 
 
 class AnnotationStore:
-    _retriever: Retriever = Retriever('annotationRetriever', transformations=[Annotation.transformer])
+    _retriever: Retriever = Retriever('annotationRetriever', transformations=[Annotation.transformer],
+                                      vocabulary_key='user_id')
+
+    @staticmethod
+    def warm_up():
+        "Connect and prepare the retriever now, e.g. when a server starts, rather than on first use"
+        AnnotationStore._retriever.warm_up()
+
+    @staticmethod
+    def move_to_shards(batch_size: int = DOCUMENT_BULK_BATCH_SIZE) -> Dict[str, int]:
+        """Move the annotations of the database the current thread is routed to, by default the main one,
+        to the shard of their user_id, e.g. once SHARDING_MODE is set, see Retriever.move_to_shards
+        :return: the number of moved annotations by user_id
+        """
+        return AnnotationStore._retriever.move_to_shards(shard_router, batch_size)
 
     @staticmethod
     def _modify_annotation(modified_annotation: Annotation):
@@ -80,24 +113,28 @@ class AnnotationStore:
 
     @staticmethod
     def _get_user_annotation(user_id: str, annotation_id: str) -> Annotation:
-        return next(AnnotationStore._retriever.get(UserException(ERROR_ANNOTATION_DOES_NOT_EXIST % annotation_id),
-                                                   **{'user_id': user_id, Annotation.unique_id_field(): annotation_id}))
+        "A copy of the annotation, which the edits can modify without touching the one kept in the object cache"
+        return deepcopy(next(AnnotationStore._retriever.get(
+            UserException(ERROR_ANNOTATION_DOES_NOT_EXIST % annotation_id),
+            **{'user_id': user_id, Annotation.unique_id_field(): annotation_id})))
 
     @staticmethod
     def _get_user_question_annotation(user_id: str, question_id: str) -> Annotation:
-        return next(AnnotationStore._retriever.get(
+        return deepcopy(next(AnnotationStore._retriever.get(
             UserException(ERROR_QUESTION_DOES_NOT_EXIST % question_id), user_id=user_id,
-            annotation_question_id=question_id))
+            annotation_question_id=question_id)))
 
     @staticmethod
     def _get_user_answer_annotation(user_id: str, answer_id: str) -> Annotation:
-        return next(AnnotationStore._retriever.get(
+        return deepcopy(next(AnnotationStore._retriever.get(
             UserException(ERROR_ANSWER_DOES_NOT_EXIST % answer_id),
-            **{'user_id': user_id, 'annotation_answer_id': answer_id}))
+            **{'user_id': user_id, 'annotation_answer_id': answer_id})))
 
     @staticmethod
+    @tenant_routed
     def similar_annotations(user_id: str, similar_query: str,
-                            document_ids: List[str] = (), saved_replies: Optional[bool] = None) -> List[dict]:
+                            document_ids: List[str] = (), saved_replies: Optional[bool] = None,
+                            ranking: Ranking = DEFAULT_RANKING, limit: Optional[int] = None) -> List[dict]:
         """
 
         :param user_id:
@@ -106,45 +143,81 @@ class AnnotationStore:
         :param saved_replies: If True only return saved replies (annotations without document_ids),
                               if False only return annotations with document_ids,
                               if None return both
+        :param ranking: how the questions and answers are ranked, e.g. CANONICAL_BOOST_RANKING
+        :param limit: maximum number of annotations, only these are loaded
         :return:
         """
-        selections_kwargs = [{'user_id': user_id}]
+        if document_ids and saved_replies is not True:
+            annotation_results: Iterable[SearchResult] = AnnotationStore._retriever.retrieve_grouped(
+                similar_query, 'document_id', document_ids, ranking=ranking, unique=True, limit=limit,
+                user_id=user_id)
+        else:
+            selection = {'user_id': user_id}
+            if saved_replies is True:
+                selection['document_id'] = None
+            elif saved_replies is False:
+                selection['document_id__ne'] = None
+            annotation_results: Iterable[SearchResult] = AnnotationStore._retriever.retrieve(
+                similar_query, limit=limit, ranking=ranking, unique=True, **selection)
+        similar_annotations = []
+        for annotation_result in annotation_results:  # the best match of each annotation
+            annotation_obj: Annotation = annotation_result.get_retrievable()
+            similar_annotations.append({
+                "answerText": random.choice(list(annotation_obj.answers.values())).content,
+                "confidence": annotation_result.matched_score,
+                "sourceType": "saved_reply" if annotation_obj.document_id is None else "annotation",
+                "sourceId": annotation_obj.unique_id,
+                "matchedQuestion": annotation_result.matched_content,
+                "page": annotation_obj.page,
+                "metadata": annotation_obj.metadata,
+            })
+        return similar_annotations
+
+    @staticmethod
+    def _annotation_entry(annotation: Annotation) -> dict:
+        return {"id": annotation.unique_id,
+                "canonicalQuestion": annotation.canonical.content,
+                "answers": [{
+                    "id": answer.annotation_answer_id,
+                    "answer": answer.content
+                } for answer in annotation.answers.values()],
+                "paraphraseQuestions": [{
+                    "id": question.annotation_question_id,
+                    "question": question.content
+                } for question in annotation.not_canonical],
+                "document_id": annotation.document_id,
+                "page": annotation.page,
+                "metadata": annotation.metadata,
+                "created": calendar.timegm(annotation.created.utctimetuple()),
+                "modified": calendar.timegm(annotation.modified.utctimetuple()),
+                }
 
+    @staticmethod
+    def _iter_annotations(user_id: str, search_term: str = None, annotation_ids: List[str] = (),
+                          document_ids: List[str] = (), pages: List[int] = (), saved_replies: bool = None,
+                          after: Optional[tuple] = None,
+                          limit: Optional[int] = None) -> Generator[Tuple[tuple, dict], None, None]:
+        selection = {'user_id': user_id}
         if saved_replies is True:
-            selections_kwargs[0]['document_id'] = None
+            selection['document_id'] = None
         elif document_ids:
-            selections_kwargs = [{'document_id': document_id, **selection}
-                                 for document_id in document_ids
-                                 for selection in selections_kwargs]
+            selection['document_id'] = list(document_ids)
         elif saved_replies is False:
-            selections_kwargs[0]['document_id__ne'] = None
-
-        annotation_results: Iterable[SearchResult] = roundrobin(*(
-            AnnotationStore._retriever.retrieve(similar_query, **selection) for selection in selections_kwargs))
-        seen = set()
-        seen_add = seen.add
-        similar_annotations = []
-        for annotation_result in annotation_results:
-            annotation_obj: Annotation = annotation_result.get_retrievable()
-            unique_id = annotation_obj.unique_id
-            if unique_id not in seen:
-                seen_add(unique_id)
-                similar_annotations.append({
-                    "answerText": random.choice(list(annotation_obj.answers.values())).content,
-                    "confidence": annotation_result.matched_score,
-                    "sourceType": "saved_reply" if annotation_obj.document_id is None else "annotation",
-                    "sourceId": unique_id,
-                    "matchedQuestion": annotation_result.matched_content,
-                    "page": annotation_obj.page,
-                    "metadata": annotation_obj.metadata,
-                })
-        return similar_annotations
+            selection['document_id__ne'] = None
+        if annotation_ids:
+            selection[Annotation.unique_id_field()] = list(annotation_ids)
+        if pages:
+            selection['page'] = list(pages)
+        for sort_key, annotation in AnnotationStore._retriever.get_sorted(search_term or '*', after, limit,
+                                                                          **selection):
+            yield sort_key, AnnotationStore._annotation_entry(annotation)
 
     @staticmethod
+    @tenant_routed
     def get_annotations(user_id: str, search_term: str = None, annotation_ids: List[str] = (),
                         document_ids: List[str] = (), pages: List[int] = (), saved_replies: bool = None) -> List[dict]:
         """
-        Get annotations
+        Get annotations, best match first with a search_term, otherwise oldest first
         :param user_id:
         :param search_term:
         :param annotation_ids:
@@ -155,44 +228,40 @@ class AnnotationStore:
                               if None return both
         :return:
         """
-        selections_kwargs = [{'user_id': user_id, 'phrase': search_term if search_term else '*'}]
-        if saved_replies is True:
-            selections_kwargs[0]['document_id'] = None
-        elif document_ids:
-            selections_kwargs = [{'document_id': document_id, **selection}
-                                 for document_id in document_ids
-                                 for selection in selections_kwargs]
-        elif saved_replies is False:
-            selections_kwargs[0]['document_id__ne'] = None
-        if annotation_ids:
-            selections_kwargs = [{Annotation.unique_id_field(): annotation_id, **selection}
-                                 for annotation_id in annotation_ids
-                                 for selection in selections_kwargs]
-        if pages:
-            selections_kwargs = [{'page': page, **selection}
-                                 for page in pages
-                                 for selection in selections_kwargs]
-        annotations: Iterable[Annotation] = roundrobin(*(
-            AnnotationStore._retriever.get(**selection) for selection in selections_kwargs))
-        return list(OrderedDict(
-            (annotation.unique_id, {"id": annotation.unique_id,
-                                    "canonicalQuestion": annotation.canonical.content,
-                                    "answers": [{
-                                        "id": answer.annotation_answer_id,
-                                        "answer": answer.content
-                                    } for answer in annotation.answers.values()],
-                                    "paraphraseQuestions": [{
-                                        "id": question.annotation_question_id,
-                                        "question": question.content
-                                    } for question in annotation.not_canonical],
-                                    "document_id": annotation.document_id,
-                                    "page": annotation.page,
-                                    "metadata": annotation.metadata,
-                                    "created": calendar.timegm(annotation.created.utctimetuple()),
-                                    "modified": calendar.timegm(annotation.modified.utctimetuple()),
-                                    }) for annotation in annotations).values())
+        return list(AnnotationStore.iter_annotations(user_id, search_term, annotation_ids, document_ids, pages,
+                                                     saved_replies))
+
+    @staticmethod
+    @tenant_routed
+    def iter_annotations(user_id: str, search_term: str = None, annotation_ids: List[str] = (),
+                         document_ids: List[str] = (), pages: List[int] = (), saved_replies: bool = None,
+                         cursor: Optional[str] = None) -> Generator[dict, None, None]:
+        """Same annotations as get_annotations, streamed from the database cursor,
+        starting after the cursor of a page of get_annotations_page when given."""
+        for _, entry in AnnotationStore._iter_annotations(user_id, search_term, annotation_ids, document_ids, pages,
+                                                          saved_replies,
+                                                          None if cursor is None else decode_cursor(cursor)):
+            yield entry
+
+    @staticmethod
+    @tenant_routed
+    def get_annotations_page(user_id: str, search_term: str = None, annotation_ids: List[str] = (),
+                             document_ids: List[str] = (), pages: List[int] = (), saved_replies: bool = None,
+                             page_size: int = DEFAULT_PAGE_SIZE, cursor: Optional[str] = None) -> dict:
+        """
+        One page of get_annotations, paginated on the sort keys of the annotations
+        :param page_size: maximum number of annotations in the page
+        :param cursor: the "nextCursor" of the previous page, None for the first page
+        :return: {"items": the annotations, "nextCursor": cursor of the next page, None on the last page}
+        """
+        return paginate(AnnotationStore._iter_annotations(user_id, search_term, annotation_ids, document_ids, pages,
+                                                          saved_replies,
+                                                          None if cursor is None else decode_cursor(cursor),
+                                                          page_size + 1), page_size)
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def create_annotation(user_id: str, question: str, answer: str, document_id: str = None, page: int = None,
                           metadata: dict = None):
         annotation_answer = AnnotationAnswer(content=answer)
@@ -205,12 +274,16 @@ class AnnotationStore:
                 "answerId": annotation_answer.annotation_answer_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def delete_annotation(user_id: str, annotation_id: str):
         annotation = AnnotationStore._get_user_annotation(user_id, annotation_id)
         AnnotationStore._retriever.delete_document(annotation)
         return {"annotationId": annotation_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def edit_canonical_question(user_id: str, annotation_id: str, question_text: str):
         annotation = AnnotationStore._get_user_annotation(user_id, annotation_id)
         annotation.canonical.content = question_text
@@ -218,6 +291,8 @@ class AnnotationStore:
         return {"annotationId": annotation_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def add_paraphrase_question(user_id: str, annotation_id: str, question_text: str):
         annotation = AnnotationStore._get_user_annotation(user_id, annotation_id)
         annotation_question = AnnotationQuestion(content=question_text)
@@ -226,6 +301,8 @@ class AnnotationStore:
         return {"questionId": annotation_question.annotation_question_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def delete_paraphrase_question(user_id: str, question_id: str):
         annotation = AnnotationStore._get_user_question_annotation(user_id, question_id)
         if annotation.canonical.annotation_question_id == question_id:
@@ -235,6 +312,8 @@ class AnnotationStore:
         return {"questionId": question_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def edit_paraphrase_question(user_id: str, question_id: str, question_text: str):
         annotation = AnnotationStore._get_user_question_annotation(user_id, question_id)
         if annotation.canonical.annotation_question_id == question_id:
@@ -244,6 +323,8 @@ class AnnotationStore:
         return {"questionId": question_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def add_answer(user_id: str, annotation_id: str, answer: str):
         annotation = AnnotationStore._get_user_annotation(user_id, annotation_id)
         annotation_answer = AnnotationAnswer(content=answer)
@@ -252,6 +333,8 @@ class AnnotationStore:
         return {"answerId": annotation_answer.annotation_answer_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def edit_answer(user_id: str, answer_id: str, answer_text: str):
         annotation = AnnotationStore._get_user_answer_annotation(user_id, answer_id)
         annotation.answers[answer_id].content = answer_text
@@ -259,6 +342,8 @@ class AnnotationStore:
         return {'answerId': answer_id}
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def delete_answer(user_id: str, answer_id: str):
         annotation = AnnotationStore._get_user_answer_annotation(user_id, answer_id)
         if len(annotation.answers) < 2:
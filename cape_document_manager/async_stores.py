@@ -0,0 +1,226 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Asyncio facades of DocumentStore and AnnotationStore.
+
+Every call runs on a bounded pool of ASYNC_WORKERS threads, with a read connection of the connection pool,
+so the event loop never waits on SQLite or on decoding. Generators of the stores become async generators,
+computing up to ASYNC_STREAM_BUFFER_SIZE results ahead of the consumer.
+Cancelling a read, or closing its async generator (aclose()), interrupts its running query,
+except for the queries routed to a shard (see shards), async generators then stop at their next result.
+A cancelled write which already started is left to complete, since stopping it halfway would only roll it back.
+"""
+
+import asyncio
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncGenerator, Callable, List, Optional
+from cape_document_manager.connections import connection_pool
+from cape_document_manager.document_manager_core import Retrievable, SearchResult
+from cape_document_manager.document_store import DocumentStore
+from cape_document_manager.annotation_store import AnnotationStore
+from cape_document_manager.document_manager_settings import ASYNC_WORKERS, ASYNC_STREAM_BUFFER_SIZE
+
+_END = object()
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    "The executor of the process, started on first call"
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(ASYNC_WORKERS, thread_name_prefix='cape-async')
+        return _executor
+
+
+class _BlockingCall:
+    """A call running on the executor with a read connection, whose query is interrupted when the call is cancelled.
+
+    :param interruptible: False for writes, which are only skipped when cancelled before they start
+    """
+
+    def __init__(self, interruptible: bool = True):
+        self.interruptible = interruptible
+        self.cancelled = threading.Event()
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        with connection_pool.reader() as connection:
+            with self._lock:
+                self._connection = connection
+            try:
+                yield connection
+            finally:
+                with self._lock:  # before the connection goes back to the pool and to another call
+                    self._connection = None
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._lock:
+            if self.interruptible and self._connection is not None:
+                self._connection.interrupt()
+
+
+async def _run(function: Callable, *args, interruptible: bool = True, **kwargs) -> Any:
+    call = _BlockingCall(interruptible)
+
+    def blocking_call():
+        if call.cancelled.is_set():
+            return None
+        with call.connection():
+            return function(*args, **kwargs)
+
+    try:
+        return await asyncio.get_event_loop().run_in_executor(_get_executor(), blocking_call)
+    except asyncio.CancelledError:
+        call.cancel()
+        raise
+
+
+async def _stream(function: Callable, *args, **kwargs) -> AsyncGenerator[Any, None]:
+    loop = asyncio.get_event_loop()
+    call = _BlockingCall()
+    items = asyncio.Queue()
+    room = threading.Semaphore(ASYNC_STREAM_BUFFER_SIZE)
+
+    def put(item: Any, error: Optional[BaseException] = None):
+        try:
+            loop.call_soon_threadsafe(items.put_nowait, (item, error))
+        except RuntimeError:  # the loop is closed, nobody is waiting for the items anymore
+            pass
+
+    def produce():
+        error = None
+        try:
+            with call.connection():
+                for item in function(*args, **kwargs):
+                    room.acquire()
+                    if call.cancelled.is_set():
+                        break
+                    put(item)
+        except Exception as exception:
+            error = exception
+        put(_END, error)
+
+    loop.run_in_executor(_get_executor(), produce)
+    try:
+        while True:
+            item, error = await items.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            room.release()
+            yield item
+    finally:
+        call.cancel()
+        room.release()  # the producer may be waiting for room
+
+
+class AsyncDocumentStore:
+    """Asyncio version of DocumentStore, see the module documentation and DocumentStore for the arguments."""
+
+    @staticmethod
+    async def create_document(*args, **kwargs) -> dict:
+        return await _run(DocumentStore.create_document, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def create_documents(*args, **kwargs) -> List[dict]:
+        return await _run(DocumentStore.create_documents, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def delete_document(*args, **kwargs) -> dict:
+        return await _run(DocumentStore.delete_document, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def get_documents(*args, **kwargs) -> List[dict]:
+        return await _run(DocumentStore.get_documents, *args, **kwargs)
+
+    @staticmethod
+    async def get_documents_page(*args, **kwargs) -> dict:
+        return await _run(DocumentStore.get_documents_page, *args, **kwargs)
+
+    @staticmethod
+    def iter_documents(*args, **kwargs) -> AsyncGenerator[dict, None]:
+        return _stream(DocumentStore.iter_documents, *args, **kwargs)
+
+    @staticmethod
+    def search_chunks(*args, **kwargs) -> AsyncGenerator[SearchResult, None]:
+        "Search results of DocumentStore.search_chunks, load their documents with get_retrievable"
+        return _stream(DocumentStore.search_chunks, *args, **kwargs)
+
+    @staticmethod
+    async def get_retrievable(search_result: SearchResult) -> Retrievable:
+        return await _run(search_result.get_retrievable)
+
+
+class AsyncAnnotationStore:
+    """Asyncio version of AnnotationStore, see the module documentation and AnnotationStore for the arguments."""
+
+    @staticmethod
+    async def similar_annotations(*args, **kwargs) -> List[dict]:
+        return await _run(AnnotationStore.similar_annotations, *args, **kwargs)
+
+    @staticmethod
+    async def get_annotations(*args, **kwargs) -> List[dict]:
+        return await _run(AnnotationStore.get_annotations, *args, **kwargs)
+
+    @staticmethod
+    async def get_annotations_page(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.get_annotations_page, *args, **kwargs)
+
+    @staticmethod
+    def iter_annotations(*args, **kwargs) -> AsyncGenerator[dict, None]:
+        return _stream(AnnotationStore.iter_annotations, *args, **kwargs)
+
+    @staticmethod
+    async def create_annotation(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.create_annotation, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def delete_annotation(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.delete_annotation, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def edit_canonical_question(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.edit_canonical_question, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def add_paraphrase_question(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.add_paraphrase_question, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def delete_paraphrase_question(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.delete_paraphrase_question, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def edit_paraphrase_question(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.edit_paraphrase_question, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def add_answer(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.add_answer, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def edit_answer(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.edit_answer, *args, interruptible=False, **kwargs)
+
+    @staticmethod
+    async def delete_answer(*args, **kwargs) -> dict:
+        return await _run(AnnotationStore.delete_answer, *args, interruptible=False, **kwargs)
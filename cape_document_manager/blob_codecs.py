@@ -0,0 +1,167 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pickle
+import struct
+import zlib
+import importlib
+from abc import ABC, abstractmethod
+from dataclasses import fields, is_dataclass, MISSING
+from typing import Any, Iterable, Dict, Optional, Sequence, Tuple
+
+# Blobs of versioned codecs start with this magic, zlib streams of the legacy format never start with a null byte
+_MAGIC = b'\x00CDM'
+_VERSION = struct.Struct('>B')
+_HEADER_LENGTH = struct.Struct('>I')
+
+
+class BlobCodec(ABC):
+    """Turns a Retrievable into the bytes stored in BlobData and back."""
+    version: int
+
+    @abstractmethod
+    def encode(self, obj: Any, transient_fields: Sequence[str] = ()) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, value: bytes) -> Any:
+        pass
+
+    def decode_sized(self, value: bytes) -> Tuple[Any, int]:
+        "Decoded object with an estimate of its size in memory, the length of its uncompressed pickle"
+        obj = self.decode(value)
+        return obj, len(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def decode_fields(self, value: bytes, field_names: Iterable[str]) -> Dict[str, Any]:
+        "Only the given top-level fields of the encoded object"
+        obj = self.decode(value)
+        return {field_name: getattr(obj, field_name) for field_name in field_names}
+
+
+class PickleZlibCodec(BlobCodec):
+    """The original format, a zlib compressed pickle without header, still read for blobs written before versioning."""
+    version = 0
+
+    def __init__(self, compression_level: int = 9):
+        self.compression_level = compression_level
+
+    def encode(self, obj: Any, transient_fields: Sequence[str] = ()) -> bytes:
+        return zlib.compress(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL), self.compression_level)
+
+    def decode(self, value: bytes) -> Any:
+        return pickle.loads(zlib.decompress(value))
+
+    def decode_sized(self, value: bytes) -> Tuple[Any, int]:
+        data = zlib.decompress(value)
+        return pickle.loads(data), len(data)
+
+
+class FieldsCodec(BlobCodec):
+    """Every top-level field is pickled in its own section, compressed with a fast zlib level when it is large enough,
+    after a header listing the class and the sections, so readers can decode some fields without the others.
+
+    Layout: magic, version byte, header length (uint32), pickled header, sections.
+    The header is (module, qualname, [(field name, section length, compressed)]).
+    Transient fields are not stored and get their dataclass default back when decoded.
+    """
+    version = 1
+
+    def __init__(self, compression_level: int = 1, min_compressed_size: int = 256):
+        self.compression_level = compression_level
+        self.min_compressed_size = min_compressed_size
+
+    def encode(self, obj: Any, transient_fields: Sequence[str] = ()) -> bytes:
+        sections_index = []
+        sections = []
+        for field_name, field_value in vars(obj).items():
+            if field_name in transient_fields:
+                continue
+            section = pickle.dumps(field_value, pickle.HIGHEST_PROTOCOL)
+            compressed = False
+            if len(section) >= self.min_compressed_size:
+                compressed_section = zlib.compress(section, self.compression_level)
+                if len(compressed_section) < len(section):
+                    section, compressed = compressed_section, True
+            sections_index.append((field_name, len(section), compressed))
+            sections.append(section)
+        header = pickle.dumps((type(obj).__module__, type(obj).__qualname__, sections_index),
+                              pickle.HIGHEST_PROTOCOL)
+        return b''.join([_MAGIC, _VERSION.pack(self.version), _HEADER_LENGTH.pack(len(header)), header, *sections])
+
+    @staticmethod
+    def _read_header(value: bytes):
+        header_start = len(_MAGIC) + _VERSION.size + _HEADER_LENGTH.size
+        header_end = header_start + _HEADER_LENGTH.unpack_from(value, len(_MAGIC) + _VERSION.size)[0]
+        module_name, qualname, sections_index = pickle.loads(value[header_start:header_end])
+        return module_name, qualname, sections_index, header_end
+
+    @staticmethod
+    def _decode_sections(value: bytes, sections_index, offset: int,
+                         field_names: Optional[set] = None) -> Tuple[Dict[str, Any], int]:
+        "Decoded fields with the total length of their uncompressed sections"
+        decoded = {}
+        size = 0
+        view = memoryview(value)
+        for field_name, length, compressed in sections_index:
+            if field_names is None or field_name in field_names:
+                section = view[offset:offset + length]
+                if compressed:
+                    section = zlib.decompress(section)
+                decoded[field_name] = pickle.loads(section)
+                size += len(section)
+            offset += length
+        return decoded, size
+
+    def decode(self, value: bytes) -> Any:
+        return self.decode_sized(value)[0]
+
+    def decode_sized(self, value: bytes) -> Tuple[Any, int]:
+        module_name, qualname, sections_index, offset = self._read_header(value)
+        cls = importlib.import_module(module_name)
+        for name in qualname.split('.'):
+            cls = getattr(cls, name)
+        obj = cls.__new__(cls)
+        decoded, size = self._decode_sections(value, sections_index, offset)
+        vars(obj).update(decoded)
+        if is_dataclass(cls):
+            for missing_field in fields(cls):
+                if missing_field.name in vars(obj):
+                    continue
+                if missing_field.default is not MISSING:
+                    setattr(obj, missing_field.name, missing_field.default)
+                elif missing_field.default_factory is not MISSING:
+                    setattr(obj, missing_field.name, missing_field.default_factory())
+        return obj, size
+
+    def decode_fields(self, value: bytes, field_names: Iterable[str]) -> Dict[str, Any]:
+        _, _, sections_index, offset = self._read_header(value)
+        return self._decode_sections(value, sections_index, offset, set(field_names))[0]
+
+
+_CODECS = {codec.version: codec for codec in (PickleZlibCodec(), FieldsCodec())}
+
+
+def register_codec(codec: BlobCodec):
+    "Make blobs written by a custom codec readable, its version must be unique and fit in a byte"
+    _CODECS[codec.version] = codec
+
+
+def codec_of(value: bytes) -> BlobCodec:
+    "Codec which wrote the blob, from its version header"
+    if not value.startswith(_MAGIC):
+        return _CODECS[PickleZlibCodec.version]
+    version = _VERSION.unpack_from(value, len(_MAGIC))[0]
+    if version not in _CODECS:
+        raise ValueError(f"Unknown blob codec version {version}")
+    return _CODECS[version]
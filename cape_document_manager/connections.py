@@ -0,0 +1,350 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import threading
+from weakref import WeakSet
+from contextlib import contextmanager
+from typing import Callable, Dict, Generator, Iterator, List, Optional, Tuple, Type, TypeVar
+from peewee import Model, InterfaceError
+from playhouse.sqlite_ext import SqliteExtDatabase
+from playhouse.pool import MaxConnectionsExceeded
+from cape_document_manager.document_manager_settings import SQLITE_MAX_READ_CONNECTIONS, SQLITE_POOL_TIMEOUT
+
+_READER = 'reader'
+_WRITER = 'writer'
+_pools: 'WeakSet[ConnectionPool]' = WeakSet()
+_routing = threading.local()
+_Item = TypeVar('_Item')
+
+
+class PooledSqliteDatabase(SqliteExtDatabase):
+    """SqliteExtDatabase whose connection can be lent to the current thread for a block, see ConnectionPool.
+    Threads outside of these blocks open a connection of their own, as with SqliteExtDatabase.
+    The first connection of the process to each database file after init(), e.g. of a shard,
+    creates the missing tables of the models bound to it."""
+
+    def __init__(self, *args, **kwargs):
+        self._lending = threading.local()
+        self._models: List[Type[Model]] = []
+        self._schema_lock = threading.Lock()
+        self._files_with_tables = set()
+        super().__init__(*args, **kwargs)
+
+    def init(self, database, **kwargs):
+        with self._schema_lock:
+            self._files_with_tables.clear()
+        super().init(database, **kwargs)
+
+    def bind(self, models: List[Type[Model]], *args, **kwargs):
+        self._models.extend(models)
+        super().bind(models, *args, **kwargs)
+
+    def _initialize_connection(self, conn: sqlite3.Connection):
+        super()._initialize_connection(conn)
+        database_file = conn.execute('PRAGMA database_list').fetchone()[2]
+        if database_file in self._files_with_tables:
+            return
+        with self._schema_lock:
+            if database_file not in self._files_with_tables:
+                self.create_tables(self._models)  # on conn, the connection of the thread from now on
+                self._files_with_tables.add(database_file)
+
+    def _lent_connections(self) -> List[sqlite3.Connection]:
+        "Connections of the current thread set aside by lent(), the last one is its connection while it is open"
+        connections = getattr(self._lending, 'connections', None)
+        if connections is None:
+            connections = self._lending.connections = []
+        return connections
+
+    def _connect(self) -> sqlite3.Connection:
+        connections = self._lent_connections()
+        return connections[-1] if connections else super()._connect()
+
+    def _close(self, conn: sqlite3.Connection):
+        connections = self._lent_connections()
+        if not connections or conn is not connections[-1]:  # lent connections are closed by their owner
+            super()._close(conn)
+
+    def open_connection(self, path: Optional[str] = None) -> sqlite3.Connection:
+        """New connection to the database, or to the file of another one with the same tables such as a shard,
+        with the pragmas and registered functions of the database, not used by any thread"""
+        if path is None:
+            return super()._connect()
+        connection = sqlite3.connect(path, timeout=self._timeout, isolation_level=None,
+                                     **self.connect_params)
+        try:
+            self._add_conn_hooks(connection)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    @contextmanager
+    def lent(self, connection: sqlite3.Connection) -> Generator[sqlite3.Connection, None, None]:
+        """Make connection the connection of the current thread for the block, which must not be in a transaction,
+        its previous connection being set aside until the end of the block"""
+        connections = self._lent_connections()
+        own_connection = not connections and not self.is_closed()
+        if own_connection:
+            connections.append(self.connection())
+        self.close()
+        connections.append(connection)
+        try:
+            self.connect()
+            yield connection
+        finally:
+            self.close()
+            connections.pop()
+            if connections:
+                self.connect()
+            if own_connection:
+                connections.pop()  # the thread's own connection again, closed by close() from now on
+
+
+class ConnectionPool:
+    """Connections of a PooledSqliteDatabase shared by the threads of a process: up to max_readers read connections,
+    and a single writer connection, so that the writers of the process wait in turn on a lock
+    instead of polling SQLite's write lock. Connections are opened by the database itself,
+    with the DB_CONFIG pragmas and the registered functions such as rank_similarity.
+
+    reader() and writer() lend a connection to the current thread for a block, every peewee query of the thread
+    then runs on it. Threads outside of these blocks keep using a connection of their own, opened by peewee.
+
+    :param database: the peewee database, initialized with check_same_thread=False
+    :param max_readers: maximum number of read connections, open or lent
+    :param timeout: seconds to wait for a read connection or for the writer connection
+    :param path: file of another database with the same tables, e.g. a shard, opened with the parameters of database
+    """
+
+    def __init__(self, database: PooledSqliteDatabase, max_readers: int = SQLITE_MAX_READ_CONNECTIONS,
+                 timeout: float = SQLITE_POOL_TIMEOUT, path: Optional[str] = None):
+        self.database = database
+        self.path = path
+        self.timeout = timeout
+        self._readers = threading.BoundedSemaphore(max_readers)
+        self._idle: List[sqlite3.Connection] = []
+        self._writer: Optional[sqlite3.Connection] = None
+        self._writer_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0  # incremented by close_all(), connections of older generations are closed on return
+        self.opened = 0
+        self.reused = 0
+        _pools.add(self)
+
+    @contextmanager
+    def _lent(self, connection: sqlite3.Connection, role: str) -> Generator[sqlite3.Connection, None, None]:
+        "Make connection the peewee connection of the current thread for the block"
+        previous = getattr(self._local, 'role', None), getattr(self._local, 'connection', None)
+        self._local.role, self._local.connection = role, connection
+        try:
+            with self.database.lent(connection):
+                yield connection
+        finally:
+            self._local.role, self._local.connection = previous
+
+    def _in_block(self, role: str) -> bool:
+        """Whether the current thread should keep its connection, to see its own uncommitted writes:
+        it is in a transaction, or its connection was lent by this pool for role or as the writer"""
+        return self.database.in_transaction() or (getattr(self._local, 'role', None) in (role, _WRITER) and
+                                                  not self.database.is_closed() and
+                                                  self.database.connection() is self._local.connection)
+
+    def _open(self) -> sqlite3.Connection:
+        connection = self.database.open_connection(self.path)
+        with self._lock:
+            self.opened += 1
+        return connection
+
+    def _checkout(self) -> Tuple[sqlite3.Connection, int]:
+        with self._lock:
+            generation = self._generation
+            if self._idle:
+                self.reused += 1
+                return self._idle.pop(), generation  # the most recently used, with the warmest page cache
+        return self._open(), generation
+
+    def _checkin(self, connection: sqlite3.Connection, generation: int):
+        if connection.in_transaction:
+            connection.rollback()
+        with self._lock:
+            if generation == self._generation:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    @contextmanager
+    def _reserved_reader(self) -> Generator[sqlite3.Connection, None, None]:
+        "Take a read connection out of the pool for the block, without lending it"
+        if not self._readers.acquire(timeout=self.timeout):
+            raise MaxConnectionsExceeded(f'No read connection available after {self.timeout} seconds')
+        try:
+            connection, generation = self._checkout()
+            try:
+                yield connection
+            finally:
+                self._checkin(connection, generation)
+        finally:
+            self._readers.release()
+
+    @contextmanager
+    def reader(self) -> Generator[sqlite3.Connection, None, None]:
+        """Lend a read connection of the pool to the current thread for the block,
+        threads already in a reader() or writer() block or in a transaction keep their connection"""
+        if self._in_block(_READER):
+            yield self.database.connection()
+            return
+        with self._reserved_reader() as connection:
+            with self._lent(connection, _READER):
+                yield connection
+
+    @contextmanager
+    def writer(self) -> Generator[sqlite3.Connection, None, None]:
+        """Lend the writer connection to the current thread for the block, one thread at a time,
+        threads already in a writer() block or in a transaction keep their connection"""
+        if self._in_block(_WRITER):
+            yield self.database.connection()
+            return
+        if not self._writer_lock.acquire(timeout=self.timeout):
+            raise MaxConnectionsExceeded(f'The writer connection is still busy after {self.timeout} seconds')
+        try:
+            if self._writer is None:
+                self._writer = self._open()
+            with self._lent(self._writer, _WRITER):
+                yield self._writer
+        finally:
+            if self._writer is not None and self._writer.in_transaction:
+                self._writer.rollback()
+            self._writer_lock.release()
+
+    def close_all(self):
+        "Close the idle connections and the writer connection, the lent ones are closed when they are returned"
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._generation += 1
+        for connection in idle:
+            connection.close()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'opened': self.opened, 'reused': self.reused, 'idle': len(self._idle)}
+
+
+# The database of the scout models and of ours, bound to it by tables.py
+database = PooledSqliteDatabase(None, regexp_function=True)
+connection_pool = ConnectionPool(database)
+
+
+def close_all_pools():
+    "Close the connections of every pool of the process, e.g. before their database files are replaced"
+    for pool in list(_pools):
+        pool.close_all()
+
+
+def current_pool() -> ConnectionPool:
+    "The pool of the database the queries of the current thread are routed to, by default the main database"
+    return getattr(_routing, 'pool', None) or connection_pool
+
+
+@contextmanager
+def _routing_to(pool: ConnectionPool):
+    if database.in_transaction():
+        raise InterfaceError('A transaction can not span databases, route the queries before it begins')
+    previous = getattr(_routing, 'pool', None)
+    _routing.pool = pool
+    try:
+        yield
+    finally:
+        _routing.pool = previous
+
+
+@contextmanager
+def routed(pool: ConnectionPool):
+    """Route the queries of the current thread to the database of pool for the block, on a read connection of pool,
+    write_transaction() taking its writer connection. Nothing changes when the thread is already routed there."""
+    if pool is current_pool():
+        yield
+        return
+    with _routing_to(pool):
+        with pool.reader():
+            yield
+
+
+def routed_steps(pool: ConnectionPool, items: Iterator[_Item]) -> Generator[_Item, None, None]:
+    """Iterate over items routed to the database of pool, e.g. a generator streaming a query:
+    every step runs on a read connection of pool kept until the iteration ends,
+    which is only lent to the current thread during the steps, so that the consumer is not routed."""
+    if pool is current_pool():
+        yield from items
+        return
+    with pool._reserved_reader() as connection:
+        try:
+            while True:
+                with _routing_to(pool), pool._lent(connection, _READER):
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        return
+                yield item
+        finally:
+            close = getattr(items, 'close', None)
+            if close is not None:
+                with _routing_to(pool), pool._lent(connection, _READER):
+                    close()
+
+
+@contextmanager
+def write_transaction():
+    """database.atomic() on the writer connection of the database the current thread is routed to, running
+    the after_commit() callbacks registered in it once the outermost one is committed. The outermost one begins
+    with BEGIN IMMEDIATE, so it holds the write lock of the database file from its start: the reads it makes can not
+    be outdated by the commit of another process. Nested in another write_transaction(), it is a savepoint
+    whose callbacks are dropped when it is rolled back."""
+    callbacks = getattr(_routing, 'after_commit', None)
+    outermost = callbacks is None
+    if outermost:
+        callbacks = _routing.after_commit = []
+    first_callback = len(callbacks)
+    try:
+        with current_pool().writer():
+            try:
+                with database.atomic('IMMEDIATE') as transaction:
+                    yield transaction
+            except BaseException:
+                del callbacks[first_callback:]
+                raise
+            if outermost:
+                _routing.after_commit = None
+                for callback in callbacks:  # still holding the writer, so in the order of the commits of the process
+                    callback()
+    finally:
+        if outermost:
+            _routing.after_commit = None
+
+
+def after_commit(callback: Callable[[], None]):
+    """Call callback once the outermost write_transaction() of the current thread is committed, never when
+    the transaction or the savepoint it was registered in is rolled back, e.g. to update files kept outside of
+    the database. Outside of a write_transaction(), it is called right away."""
+    callbacks = getattr(_routing, 'after_commit', None)
+    if callbacks is None:
+        callback()
+    else:
+        callbacks.append(callback)
@@ -12,25 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import re
-from typing import List, Callable, Iterable, Dict, Any, Union, Generator, Optional
-from peewee import ModelSelect, JOIN, fn
-from hashlib import sha256
+import threading
+import json
+import base64
 import pickle
-import zlib
+from weakref import WeakKeyDictionary
+from typing import List, Callable, Iterable, Dict, Any, Union, Generator, Optional, Set, Tuple
+from peewee import ModelSelect, Select, OperationalError, fn, Case, Entity, SQL, Tuple as RowValue
+from hashlib import sha256
+import numpy as np
 from dataclasses import dataclass, field, asdict
 from uuid import uuid4
 from cytoolz import compose
 from cape_document_manager.tables import Index, database, BlobData, Metadata, IndexDocument, Attachment, Document, \
-    DocumentSearch
-from functools import lru_cache
-from cape_document_manager.document_manager_settings import LOCAL_UNPICKLING_LRU_CACHE_MAX_SIZE
+    DocumentSearch, Embedding, Sequence, ReleasedBlob, Fingerprint, database_generation
+from cape_document_manager.document_manager_settings import OBJECT_CACHE_MAX_BYTES, OBJECT_CACHE_TTL, \
+    OBJECT_CACHE_COPY_ON_READ, SHARED_OBJECT_CACHE_FOLDER, SHARED_OBJECT_CACHE_MAX_BYTES, BLOB_COLLECTION_MODE, \
+    BLOB_COLLECTION_BATCH_SIZE, BLOB_COLLECTOR_INTERVAL, DOCUMENT_BULK_BATCH_SIZE, \
+    SQLITE_MAX_VARIABLE_NUMBER, VECTOR_INDEX_FOLDER, BLOB_CODEC, BLOB_COMPRESSION_LEVEL
+from cape_document_manager.vector_index import VectorIndex
+from cape_document_manager.object_cache import ObjectCache, SharedBlobCache
+from cape_document_manager.blob_codecs import BlobCodec, FieldsCodec, PickleZlibCodec, codec_of
+from cape_document_manager.rank_similarity import Ranking, DEFAULT_RANKING
+from cape_document_manager.query_planner import QueryPlanner, _NON_WORD_CHARS
+from cape_document_manager.vocabulary import Vocabulary
+from cape_document_manager.connections import ConnectionPool, current_pool, routed, write_transaction, after_commit
+from cape_document_manager.shards import ShardRouter, shard_router
 from itertools import cycle, islice
+from functools import partial
+from collections import OrderedDict
 
 AUTOFILL = "AUTO_FILL"
+_BLOB_CODEC = PickleZlibCodec() if BLOB_CODEC == 'pickle_zlib' else FieldsCodec(BLOB_COMPRESSION_LEVEL)
 _MAX_RETRIEVER_SCORE = 0.98
 _CASE_INVARIANT_NO_PUNCTUATION_SCORE = 0.99
-_NON_WORD_CHARS = re.compile('[^0-9a-zA-Z\s]')
+_DOCID_SEQUENCE = 'docid'
+_MAX_NEAREST_BATCHES = 3
 
 
 def roundrobin(*iterables):
@@ -48,16 +67,148 @@ def roundrobin(*iterables):
             nexts = cycle(islice(nexts, num_active))
 
 
+def chunked(iterable: Iterable, size: int) -> Generator[List, None, None]:
+    "chunked('ABCDE', 2) --> AB CD E"
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+def _subquery(query: ModelSelect, alias: str) -> SQL:
+    """query as a FROM clause entry named alias, whose columns are Entity(alias, column name).
+    It is rendered on its own: nested in a FROM clause, peewee 3.5 compiles the default model query
+    returned by scout searches to the docid alone, whatever its selected columns."""
+    query_sql, params = query.sql()
+    return SQL(f'({query_sql}) AS "{alias}"', params)
+
+
+def encode_cursor(sort_key: tuple) -> str:
+    "Opaque pagination cursor for the sort key of the last result of a page"
+    return base64.urlsafe_b64encode(json.dumps(list(sort_key)).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        sort_key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, UnicodeError):
+        raise ValueError(f"Invalid cursor {cursor}")
+    if not isinstance(sort_key, list) or not sort_key:
+        raise ValueError(f"Invalid cursor {cursor}")
+    return tuple(sort_key)
+
+
+def paginate(sorted_items: Iterable[tuple], page_size: int) -> dict:
+    """Page of the first page_size (sort key, item) pairs, given up to page_size + 1 of them.
+    :return: {"items": the items, "nextCursor": cursor of the next page, None on the last page}
+    """
+    sorted_items = list(sorted_items)
+    next_cursor = encode_cursor(sorted_items[page_size - 1][0]) if len(sorted_items) > page_size else None
+    return {"items": [item for _, item in sorted_items[:page_size]], "nextCursor": next_cursor}
+
+
+def _delete_orphan_blobs(content_hashes: List[str]) -> int:
+    "Delete the blobs of these hashes which no attachment points to, with one indexed lookup per hash"
+    return BlobData.delete().where(
+        (BlobData.hash << content_hashes) &
+        ~fn.EXISTS(Attachment.select(Attachment.id).where(Attachment.hash == BlobData.hash))).execute()
+
+
+def sweep_released_blobs(batch_size: int = BLOB_COLLECTION_BATCH_SIZE) -> int:
+    """Delete the released blobs of the current database which no attachment points to anymore,
+    batch_size hashes per transaction.
+    :return: the number of deleted blobs
+    """
+    number_of_deleted_blobs = 0
+    while True:
+        with write_transaction():
+            content_hashes = [content_hash for content_hash, in
+                              ReleasedBlob.select(ReleasedBlob.hash).limit(batch_size).tuples()]
+            if not content_hashes:
+                return number_of_deleted_blobs
+            for content_hashes_batch in chunked(content_hashes, SQLITE_MAX_VARIABLE_NUMBER):
+                number_of_deleted_blobs += _delete_orphan_blobs(content_hashes_batch)
+                ReleasedBlob.delete().where(ReleasedBlob.hash << content_hashes_batch).execute()
+
+
+class BlobCollector(threading.Thread):
+    """Daemon thread running sweep_released_blobs() on every database every interval seconds, off the request path."""
+    _started: Optional['BlobCollector'] = None
+    _start_lock = threading.Lock()
+
+    def __init__(self, interval: float = BLOB_COLLECTOR_INTERVAL, batch_size: int = BLOB_COLLECTION_BATCH_SIZE):
+        super().__init__(name='cape-blob-collector', daemon=True)
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stopped = threading.Event()
+
+    @staticmethod
+    def start_once() -> 'BlobCollector':
+        "The collector of this process, started on first call"
+        with BlobCollector._start_lock:
+            if BlobCollector._started is None or not BlobCollector._started.is_alive():
+                BlobCollector._started = BlobCollector()
+                BlobCollector._started.start()
+            return BlobCollector._started
+
+    def run(self):
+        try:
+            while not self._stopped.wait(self.interval):
+                for pool in shard_router.databases():
+                    try:
+                        with routed(pool):
+                            sweep_released_blobs(self.batch_size)
+                    except OperationalError:  # e.g. the database is locked, retried on the next interval
+                        pass
+        finally:
+            database.close()
+
+    def stop(self):
+        self._stopped.set()
+
+
 @dataclass
 class Retrievable:
     unique_id: str = field(default_factory=compose(str, uuid4))
 
     def dumps(self) -> bytes:
-        return zlib.compress(pickle.dumps(self, pickle.HIGHEST_PROTOCOL), 9)
+        return self.blob_codec().encode(self, self.transient_fields())
 
     @staticmethod
     def loads(value: bytes) -> Any:
-        return pickle.loads(zlib.decompress(value))
+        "Decoded with the codec that wrote the blob, whatever the current codec"
+        return codec_of(value).decode(value)
+
+    @staticmethod
+    def loads_sized(value: bytes) -> Tuple[Any, int]:
+        "Like loads() with an estimate of the size of the object in memory, see BlobCodec.decode_sized"
+        return codec_of(value).decode_sized(value)
+
+    @staticmethod
+    def loads_fields(value: bytes, field_names: Iterable[str]) -> Dict[str, Any]:
+        "Only the given top-level fields, without decoding the others when the codec allows it"
+        return codec_of(value).decode_fields(value, field_names)
+
+    @staticmethod
+    def blob_codec() -> BlobCodec:
+        return _BLOB_CODEC
+
+    @staticmethod
+    def transient_fields() -> Tuple[str, ...]:
+        "Fields which are not stored, they get their default value back when loaded"
+        return ()
+
+    @staticmethod
+    def volatile_fields() -> Tuple[str, ...]:
+        "Fields which change without the object changing, e.g. timestamps, left out of its fingerprint"
+        return ()
+
+    def fingerprint(self) -> str:
+        "Hash of the fields of the object, except the transient and volatile ones"
+        excluded_fields = set(self.transient_fields()) | set(self.volatile_fields())
+        return sha256(pickle.dumps([(field_name, value) for field_name, value in vars(self).items()
+                                    if field_name not in excluded_fields], pickle.HIGHEST_PROTOCOL)).hexdigest()
 
     @staticmethod
     def unique_id_field() -> str:
@@ -66,9 +217,26 @@ class Retrievable:
 
 @dataclass
 class Indexable:
-    """All the fields of this object will be converted to str(), content will be indexed."""
+    """All the fields of this object will be converted to str(), content will be indexed.
+    Except for the embedding field, which is stored as a float32 vector instead."""
     content: str
 
+    @staticmethod
+    def embedding_field() -> Optional[str]:
+        return None
+
+    @staticmethod
+    def stable_id_field() -> Optional[str]:
+        "Field identifying the indexable across versions of its object, lets upserts only rewrite what changed"
+        return None
+
+
+def _embedding_to_bytes(embedding: Any) -> Optional[bytes]:
+    "Raw float32 bytes of the embedding, None when there is no vector to store, e.g. empty string embeddings"
+    if embedding is None or isinstance(embedding, str):
+        return None
+    return np.asarray(embedding, dtype=np.float32).reshape(-1).tobytes()
+
 
 Transformer = Callable[[Retrievable], Iterable[Indexable]]
 
@@ -79,6 +247,10 @@ class SearchResult:
     matched_content: str
     matched_score: float  # higher is better
     _scout_result: Document
+    vector_score: Optional[float] = None  # cosine similarity to the query embedding, set by Retriever.rerank
+    group: Optional[str] = None  # value of the group_key, set by Retriever.retrieve_grouped
+    _retriever: Optional['Retriever'] = field(default=None, repr=False)  # which loads the retrievable
+    _pool: Optional[ConnectionPool] = field(default=None, repr=False)  # of the database the result comes from
 
     def __post_init__(self):
         # since retriever does stemming and tokenizing we want to return perfect score for 'perfect' matches
@@ -89,21 +261,44 @@ class SearchResult:
             self.matched_score = _CASE_INVARIANT_NO_PUNCTUATION_SCORE
 
     def get_retrievable(self) -> Retrievable:
-        return Retriever._local_loading_cache(self._scout_result.attachments[0].hash, _HiddenState(self._scout_result))
+        with routed(self._pool or current_pool()):
+            return self._retriever.load(self._scout_result.attachments[0])
 
     def get_indexable_string_fields(self) -> dict:
         return self._scout_result.get_metadata()
 
+    @property
+    def embedding(self) -> Optional[np.ndarray]:
+        """Read-only float32 view on the stored embedding, None when the indexable had no embedding."""
+        return SearchResult.load_embeddings([self])[0]
 
-@dataclass
-class _HiddenState:
-    state: Any
+    @staticmethod
+    def load_embeddings(search_results: List['SearchResult']) -> List[Optional[np.ndarray]]:
+        """Embeddings of all the search results, in order, with one query per SQLITE_MAX_VARIABLE_NUMBER results
+        of the same database."""
+        results_by_pool = OrderedDict()
+        for result in search_results:
+            results_by_pool.setdefault(result._pool or current_pool(), []).append(result)
+        vectors = {}
+        for pool, pool_results in results_by_pool.items():
+            with routed(pool):
+                for search_results_batch in chunked(pool_results, SQLITE_MAX_VARIABLE_NUMBER):
+                    vectors.update(((pool, docid), vector) for docid, vector in Embedding
+                                   .select(Embedding.document, Embedding.vector)
+                                   .where(Embedding.document << [result._scout_result.docid
+                                                                 for result in search_results_batch])
+                                   .tuples())
+        keys = [(result._pool or current_pool(), result._scout_result.docid) for result in search_results]
+        return [np.frombuffer(vectors[key], dtype=np.float32) if key in vectors else None for key in keys]
 
-    def __hash__(self):
-        return hash(None)
 
-    def __eq__(self, other: '_HiddenState'):
-        return True
+@dataclass
+class _RetrieverDatabase:
+    "What a Retriever keeps for each database it is used with, e.g. each shard"
+    generation: int
+    indexes: List[Index]
+    vocabulary: Vocabulary
+    vector_index: Optional[VectorIndex]
 
 
 class Retriever():
@@ -112,32 +307,112 @@ class Retriever():
     Integrations will typically use the existing Full text search or a new specialized one.
     """
 
-    def __init__(self, name: str, transformations: List[Transformer]):
-        """Initialize new retriever with the transformation functions where retrieval will be applied."""
+    def __init__(self, name: str, transformations: List[Transformer], vector_index: bool = False,
+                 cache: Optional[ObjectCache] = None, shared_cache: Optional[SharedBlobCache] = None,
+                 query_planner: Optional[QueryPlanner] = None, vocabulary_key: Optional[str] = None):
+        """Initialize new retriever with the transformation functions where retrieval will be applied.
+        With vector_index, the embeddings are also kept in a VectorIndex for retrieve_similar().
+        Loaded objects are kept in cache, by default an ObjectCache configured by the OBJECT_CACHE_* settings,
+        and their blobs in shared_cache, by default a SharedBlobCache when SHARED_OBJECT_CACHE_FOLDER is set.
+        Queries are compiled by query_planner, by default a QueryPlanner configured by the QUERY_* settings.
+        The term statistics of the chunks are kept in vocabulary, broken down by the metadata vocabulary_key.
+        Each database the retriever is routed to, such as the shard of a tenant, gets indexes, a vocabulary
+        and a vector index of its own."""
+        self.query_planner = query_planner if query_planner is not None else QueryPlanner()
+        self.cache = cache if cache is not None else ObjectCache(OBJECT_CACHE_MAX_BYTES, OBJECT_CACHE_TTL,
+                                                                 OBJECT_CACHE_COPY_ON_READ)
+        if shared_cache is None and SHARED_OBJECT_CACHE_FOLDER:
+            shared_cache = SharedBlobCache(os.path.join(SHARED_OBJECT_CACHE_FOLDER, name),
+                                           SHARED_OBJECT_CACHE_MAX_BYTES)
+        self.shared_cache = shared_cache
         self.transformations = transformations
         self.name = name
-        self.indexes = [Index.get_or_create(name=f'{name}-{idx}')[0] for idx, _ in enumerate(self.transformations)]
-
-    @staticmethod
-    @lru_cache(maxsize=LOCAL_UNPICKLING_LRU_CACHE_MAX_SIZE)
-    def _local_loading_cache(unique_hash: str, result: _HiddenState) -> Retrievable:
-        "Cache objects being unpickled"
-        return Retrievable.loads(result.state.attachments[0].blob.data)
-
-    @staticmethod
-    def _unique_everseen(results: Iterable[Indexable]) -> Generator[Retrievable, None, None]:
+        self.vocabulary_key = vocabulary_key
+        self.with_vector_index = vector_index
+        self._databases: 'WeakKeyDictionary[ConnectionPool, _RetrieverDatabase]' = WeakKeyDictionary()
+        self._initialization_lock = threading.RLock()
+
+    def _database(self) -> _RetrieverDatabase:
+        """Indexes, vocabulary and vector index of the database the current thread is routed to,
+        created on first use so that building a Retriever does not touch the database"""
+        pool = current_pool()
+        retriever_database = self._databases.get(pool)
+        if retriever_database is None or retriever_database.generation != database_generation():
+            with self._initialization_lock:
+                retriever_database = self._databases.get(pool)
+                if retriever_database is None or retriever_database.generation != database_generation():
+                    indexes = [Index.get_or_create(name=f'{self.name}-{idx}')[0]
+                               for idx, _ in enumerate(self.transformations)]
+                    vector_index_folder = VECTOR_INDEX_FOLDER if pool.path is None else pool.path + '-vectors'
+                    retriever_database = _RetrieverDatabase(
+                        database_generation(), indexes, Vocabulary(self.name, indexes, self.vocabulary_key),
+                        VectorIndex(os.path.join(vector_index_folder, self.name)) if self.with_vector_index else None)
+                    self._databases[pool] = retriever_database
+        return retriever_database
+
+    @property
+    def indexes(self) -> List[Index]:
+        "One index per transformation"
+        return self._database().indexes
+
+    @property
+    def vocabulary(self) -> Vocabulary:
+        return self._database().vocabulary
+
+    def warm_up(self):
+        "Connect, create the indexes and load the term statistics and vector index now rather than on first use"
+        self.vocabulary.ensure()
+        if self.with_vector_index:
+            len(self.vector_index)  # rebuilt when missing, then mapped
+
+    @property
+    def vector_index(self) -> Optional[VectorIndex]:
+        "The vector index, rebuilt from the stored embeddings when its files are missing"
+        vector_index = self._database().vector_index
+        if vector_index is not None and not vector_index.exists():
+            self.rebuild_vector_index()
+        return vector_index
+
+    def rebuild_vector_index(self):
+        vector_index = self._database().vector_index
+        vector_index.clear()
+        vector_index.create()  # exists from now on, even without any embedding to add
+        stored_embeddings = (Embedding
+                             .select(Embedding.document, Embedding.vector)
+                             .join(IndexDocument, on=(IndexDocument.document == Embedding.document))
+                             .where(IndexDocument.index << self.indexes)
+                             .tuples())
+        for embeddings_batch in chunked(stored_embeddings.iterator(), SQLITE_MAX_VARIABLE_NUMBER):
+            vector_index.add((docid for docid, _ in embeddings_batch),
+                             (np.frombuffer(vector, dtype=np.float32) for _, vector in embeddings_batch))
+
+    def load(self, attachment: Attachment) -> Retrievable:
+        "Object stored in the blob of the attachment, cached by content hash, sized by its uncompressed pickles"
+        def load_blob():
+            data = None if self.shared_cache is None else self.shared_cache.get(attachment.hash)
+            if data is None:
+                data = attachment.blob.data
+                if self.shared_cache is not None:
+                    self.shared_cache.put(attachment.hash, data)
+            return Retrievable.loads_sized(data)
+
+        return self.cache.get(attachment.hash, load_blob)
+
+    def _unique_everseen(self, results: Iterable[Indexable]) -> Generator[Retrievable, None, None]:
         "List unique elements, preserving order. Remember all elements ever seen."
         seen = set()
         seen_add = seen.add
         for result in results:
-            unique_hash = result.attachments[0].hash
-            if unique_hash not in seen:
-                seen_add(unique_hash)
-                yield Retriever._local_loading_cache(unique_hash, _HiddenState(result))
+            attachment = result.attachments[0]
+            if attachment.hash not in seen:
+                seen_add(attachment.hash)
+                yield self.load(attachment)
 
     def _indexable_object_to_dict(self, indexable_object: Indexable, original_object: Retrievable) -> Dict:
         indexable_object_dict = {}
         for key, value in asdict(indexable_object).items():
+            if key == indexable_object.embedding_field():
+                continue
             if value == AUTOFILL:
                 value = getattr(original_object, key)
             if value is None:  # elif would cause errors since original object can have None values
@@ -148,61 +423,589 @@ class Retriever():
     def _searchable_keys(self, keys: Dict[str, str]):
         return {key: (val if val is not None else '') for key, val in keys.items()}
 
-    def upsert_document(self, original_object: Retrievable):
-        self.delete_document(original_object)
-        original_content_bytes = original_object.dumps()
-        content_hash = sha256(original_content_bytes).hexdigest()
-        with database.atomic():
-            BlobData.get_or_create(hash=content_hash, data=original_content_bytes)
-            for transformation in self.transformations:
-                for indexable_chunk in transformation(original_object):
-                    indexable_dict = self._indexable_object_to_dict(indexable_chunk, original_object)
-                    for current_index in self.indexes:
-                        document = current_index.index(
-                            **{Retrievable.unique_id_field(): original_object.unique_id},
-                            **indexable_dict)
-                        Attachment.get_or_create(document=document, filename=content_hash, hash=content_hash,
-                                                 mimetype='application/octet-stream')
-
-    def _get_docids(self, original_object_or_id: Union[Retrievable, str]) -> ModelSelect:
-        unique_id = original_object_or_id if isinstance(original_object_or_id, str) else original_object_or_id.unique_id
+    def upsert_document(self, original_object: Retrievable) -> str:
+        return self.upsert_documents([original_object])[original_object.unique_id]
+
+    def _indexable_rows(self, original_object: Retrievable) -> Generator[tuple, None, None]:
+        """(index id, stable key, content, metadata, embedding bytes) of every row indexing the object,
+        the stable key is (stable_id_field, its value as stored) or None when the indexable has no stable id."""
+        for transformation in self.transformations:
+            for indexable_chunk in transformation(original_object):
+                indexable_dict = self._indexable_object_to_dict(indexable_chunk, original_object)
+                content = indexable_dict.pop('content')
+                indexable_dict[Retrievable.unique_id_field()] = original_object.unique_id
+                indexable_dict = {key: Metadata.value.db_value(value) for key, value in indexable_dict.items()}
+                embedding_bytes = None
+                if indexable_chunk.embedding_field() is not None:
+                    embedding_bytes = _embedding_to_bytes(getattr(indexable_chunk, indexable_chunk.embedding_field()))
+                stable_key = None
+                if indexable_chunk.stable_id_field() is not None:
+                    stable_key = (indexable_chunk.stable_id_field(), indexable_dict[indexable_chunk.stable_id_field()])
+                for current_index in self.indexes:
+                    yield current_index.id, stable_key, content, indexable_dict, embedding_bytes
+
+    def _stored_rows(self, unique_ids: Iterable[str]) -> Dict[str, Dict[int, list]]:
+        "[index id, content, metadata, embedding bytes, content hash] of the stored rows of the objects, by docid"
+        stored = {}
+        for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER):
+            for docid, unique_id, index_id in self._get_docids(*unique_ids_batch).select(
+                    Metadata.document_id, Metadata.value, IndexDocument.index).tuples():
+                stored.setdefault(unique_id, {})[docid] = [index_id, None, {}, None, None]
+        rows = {docid: row for object_rows in stored.values() for docid, row in object_rows.items()}
+        for docids_batch in chunked(list(rows), SQLITE_MAX_VARIABLE_NUMBER):
+            for docid, content in Document.select(Document.docid, Document.content).where(
+                    Document.docid << docids_batch).tuples():
+                rows[docid][1] = content
+            for docid, key, value in Metadata.select(Metadata.document_id, Metadata.key, Metadata.value).where(
+                    Metadata.document_id << docids_batch).tuples():
+                rows[docid][2][key] = value
+            for docid, vector in Embedding.select(Embedding.document, Embedding.vector).where(
+                    Embedding.document << docids_batch).tuples():
+                rows[docid][3] = bytes(vector)
+            for docid, content_hash in Attachment.select(Attachment.document_id, Attachment.hash).where(
+                    Attachment.document_id << docids_batch).tuples():
+                rows[docid][4] = content_hash
+        return stored
+
+    def upsert_documents(self, original_objects: Iterable[Retrievable]) -> Dict[str, str]:
+        """Bulk version of upsert_document, the whole call is a single transaction made of set-based statements.
+        Objects with the same fingerprint as their stored version are not written at all.
+        Stored objects whose indexables all have a stable id are re-indexed incrementally:
+        only the rows of the indexables which were added, changed or removed are written.
+
+        :return: the status ('created', 'updated' or 'unchanged') of every object by unique_id,
+                 objects sharing a unique_id are only written once, the last one wins
+        """
+        objects_by_id = OrderedDict((original_object.unique_id, original_object)
+                                    for original_object in original_objects)
+        if not objects_by_id:
+            return OrderedDict()
+        unique_ids = list(objects_by_id)
+        vector_index = self.vector_index  # rebuilt before our writes when missing
+        with write_transaction():
+            self.vocabulary.ensure()
+            fingerprints = {unique_id: original_object.fingerprint()
+                            for unique_id, original_object in objects_by_id.items()}
+            unchanged_ids = set()
+            for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER):
+                unchanged_ids.update(unique_id for unique_id, fingerprint in Fingerprint
+                                     .select(Fingerprint.unique_id, Fingerprint.fingerprint)
+                                     .where((Fingerprint.retriever == self.name) &
+                                            (Fingerprint.unique_id << unique_ids_batch))
+                                     .tuples()
+                                     if fingerprint == fingerprints[unique_id])
+            objects_by_id = OrderedDict((unique_id, original_object) for unique_id, original_object
+                                        in objects_by_id.items() if unique_id not in unchanged_ids)
+            stored = self._stored_rows(objects_by_id.keys())
+            blobs = {}
+            content_hashes = {}
+            for unique_id, original_object in objects_by_id.items():
+                original_content_bytes = original_object.dumps()
+                content_hashes[unique_id] = sha256(original_content_bytes).hexdigest()
+                blobs[content_hashes[unique_id]] = original_content_bytes
+            self._insert_rows(BlobData, [{'hash': content_hash, 'data': data} for content_hash, data in blobs.items()],
+                              ignore_conflicts=True)
+            released_hashes = set()
+            deleted_docids, kept_docids, changed_rows, new_rows = [], {}, [], []
+            for unique_id, original_object in objects_by_id.items():
+                rows = list(self._indexable_rows(original_object))
+                stored_rows = stored.get(unique_id, {})
+                released_hashes.update(stored_row[4] for stored_row in stored_rows.values())
+                new_keys = [(index_id, stable_key) for index_id, stable_key, _, _, _ in rows]
+                stable_fields = {stable_key[0] for _, stable_key in new_keys if stable_key is not None}
+                stored_keys = {}
+                for docid, (index_id, _, stored_metadata, _, _) in stored_rows.items():
+                    for stable_field in stable_fields & stored_metadata.keys():
+                        stored_keys.setdefault((index_id, (stable_field, stored_metadata[stable_field])),
+                                               []).append(docid)
+                incremental = (stored_rows and all(stable_key is not None for _, stable_key in new_keys) and
+                               len(set(new_keys)) == len(new_keys) and
+                               all(len(docids) == 1 for docids in stored_keys.values()))
+                if not incremental:
+                    deleted_docids.extend(stored_rows)
+                    new_rows.extend((unique_id, row) for row in rows)
+                    continue
+                matched_docids = set()
+                for row in rows:
+                    index_id, stable_key, content, indexable_dict, embedding_bytes = row
+                    docid = stored_keys.get((index_id, stable_key), [None])[0]
+                    if docid is None:
+                        new_rows.append((unique_id, row))
+                        continue
+                    matched_docids.add(docid)
+                    kept_docids.setdefault(unique_id, []).append(docid)
+                    _, stored_content, stored_metadata, stored_embedding, _ = stored_rows[docid]
+                    if (content, indexable_dict, embedding_bytes) != (stored_content, stored_metadata,
+                                                                      stored_embedding):
+                        changed_rows.append((docid, content, indexable_dict, embedding_bytes))
+                deleted_docids.extend(docid for docid in stored_rows if docid not in matched_docids)
+            self._delete_docids(deleted_docids, vector_index)
+            self._update_rows(changed_rows, vector_index)
+            for unique_id, docids in kept_docids.items():
+                for docids_batch in chunked(docids, SQLITE_MAX_VARIABLE_NUMBER):
+                    Attachment.update(hash=content_hashes[unique_id], filename=content_hashes[unique_id]).where(
+                        Attachment.document_id << docids_batch).execute()
+            self._insert_new_rows(new_rows, content_hashes, vector_index)
+            self._release_blobs(released_hashes - set(content_hashes.values()))
+            self._insert_rows(Fingerprint, [{'retriever': self.name, 'unique_id': unique_id,
+                                             'fingerprint': fingerprints[unique_id]} for unique_id in objects_by_id],
+                              replace=True)
+        return OrderedDict((unique_id, 'unchanged' if unique_id in unchanged_ids else
+                            'updated' if unique_id in stored else 'created')
+                           for unique_id in unique_ids)
+
+    def _insert_new_rows(self, new_rows: List[tuple], content_hashes: Dict[str, str],
+                         vector_index: Optional[VectorIndex]):
+        """Insert (unique_id, (index id, stable key, content, metadata, embedding bytes)) rows under new docids,
+        attached to the blob of their object in content_hashes, the caller holds the write transaction"""
+        # write_transaction() began with BEGIN IMMEDIATE, so we hold the write lock of the database: no other
+        # connection, of this process or another, can allocate docids until we commit.
+        # The docids of deleted rows are not handed out again, the vector index may still list them.
+        next_docid = max(Sequence.select(Sequence.value).where(Sequence.name == _DOCID_SEQUENCE).scalar() or 0,
+                         Document.select(fn.MAX(Document.docid)).scalar() or 0) + 1
+        documents, metadata, index_documents, attachments, embeddings = [], [], [], [], []
+        for unique_id, (index_id, _, content, indexable_dict, embedding_bytes) in new_rows:
+            documents.append({'docid': next_docid, 'content': content, 'identifier': None})
+            index_documents.append({'index': index_id, 'document': next_docid})
+            metadata.extend({'document': next_docid, 'key': key, 'value': value}
+                            for key, value in indexable_dict.items())
+            attachments.append({'document': next_docid, 'filename': content_hashes[unique_id],
+                                'hash': content_hashes[unique_id], 'mimetype': 'application/octet-stream'})
+            if embedding_bytes is not None:
+                embeddings.append({'document': next_docid, 'vector': embedding_bytes})
+            next_docid += 1
+        self._insert_rows(Document, documents)
+        self._insert_rows(IndexDocument, index_documents)
+        self._insert_rows(Metadata, metadata)
+        self._insert_rows(Attachment, attachments)
+        self._insert_rows(Embedding, embeddings)
+        if documents:
+            Sequence.replace(name=_DOCID_SEQUENCE, value=next_docid - 1).execute()
+        self.vocabulary.add(row['docid'] for row in documents)
+        self._add_vectors(vector_index, embeddings)
+
+    def _update_rows(self, changed_rows: List[tuple], vector_index: Optional[VectorIndex]):
+        "Rewrite the content, metadata and embedding of (docid, content, metadata, embedding bytes) rows"
+        if not changed_rows:
+            return
+        changed_docids = [docid for docid, _, _, _ in changed_rows]
+        self.vocabulary.remove(changed_docids)
+        for docid, content, _, _ in changed_rows:
+            Document.update(content=content).where(Document.docid == docid).execute()
+        for docids_batch in chunked(changed_docids, SQLITE_MAX_VARIABLE_NUMBER):
+            Metadata.delete().where(Metadata.document_id << docids_batch).execute()
+            Embedding.delete().where(Embedding.document << docids_batch).execute()
+        self._insert_rows(Metadata, [{'document': docid, 'key': key, 'value': value}
+                                     for docid, _, indexable_dict, _ in changed_rows
+                                     for key, value in indexable_dict.items()])
+        embeddings = [{'document': docid, 'vector': embedding_bytes}
+                      for docid, _, _, embedding_bytes in changed_rows if embedding_bytes is not None]
+        self._insert_rows(Embedding, embeddings)
+        self.vocabulary.add(changed_docids)
+        if vector_index is not None:
+            after_commit(partial(vector_index.remove, changed_docids))
+            self._add_vectors(vector_index, embeddings)
+
+    @staticmethod
+    def _add_vectors(vector_index: Optional[VectorIndex], embeddings: List[Dict]):
+        """Add the embedding rows to the vector index once the transaction is committed,
+        so that rolled back rows never get there"""
+        if vector_index is None or not embeddings:
+            return
+        vectors = np.stack([np.frombuffer(row['vector'], dtype=np.float32) for row in embeddings])
+        if vector_index.dimension not in (None, vectors.shape[1]):
+            raise ValueError(f"Expected embeddings of dimension {vector_index.dimension}, got {vectors.shape[1]}")
+        after_commit(partial(vector_index.add, [row['document'] for row in embeddings], vectors))
+
+    @staticmethod
+    def _insert_rows(model, rows: List[Dict], ignore_conflicts: bool = False, replace: bool = False):
+        "Multi-row INSERT statements, kept small enough to stay below SQLite's host parameter limit"
+        if not rows:
+            return
+        for rows_batch in chunked(rows, max(1, SQLITE_MAX_VARIABLE_NUMBER // len(rows[0]))):
+            query = model.insert_many(rows_batch)
+            if ignore_conflicts:
+                query = query.on_conflict_ignore()
+            elif replace:
+                query = query.on_conflict_replace()
+            query.execute()
+
+    def _get_docids(self, *original_objects_or_ids: Union[Retrievable, str]) -> ModelSelect:
+        unique_ids = [original_object_or_id if isinstance(original_object_or_id, str) else
+                      original_object_or_id.unique_id for original_object_or_id in original_objects_or_ids]
         where_clause = (Metadata.key == Retrievable.unique_id_field()) & (
-                Metadata.value == unique_id)
+                Metadata.value << unique_ids)
         return Metadata.select(Metadata.document_id).where(where_clause).join(
             IndexDocument, on=(IndexDocument.document_id == Metadata.document_id)).where(
             IndexDocument.index << self.indexes)
 
+    def existing_unique_ids(self, unique_ids: Iterable[str]) -> Set[str]:
+        "Set of the given unique_ids which are already stored, with one query per SQLITE_MAX_VARIABLE_NUMBER ids"
+        return {unique_id
+                for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER)
+                for unique_id, in self._get_docids(*unique_ids_batch).select(Metadata.value).distinct().tuples()}
+
     def delete_document(self, original_object_or_unique_id: Union[Retrievable, str]):
-        with database.atomic():
-            doc_ids = self._get_docids(original_object_or_unique_id)  # cached after 1st execution
-            rows_deleted = IndexDocument.delete().where(IndexDocument.document_id << doc_ids).execute()
-            if not rows_deleted:
+        self.delete_documents([original_object_or_unique_id])
+
+    def delete_documents(self, original_objects_or_unique_ids: Iterable[Union[Retrievable, str]]):
+        vector_index = self.vector_index  # rebuilt before our writes when missing
+        with write_transaction():
+            self.vocabulary.ensure()
+            unique_ids = [original_object_or_id if isinstance(original_object_or_id, str) else
+                          original_object_or_id.unique_id for original_object_or_id in original_objects_or_unique_ids]
+            # Materialized, since the rows the subquery joins on are deleted by the first statement
+            doc_ids = [doc_id
+                       for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER)
+                       for doc_id, in self._get_docids(*unique_ids_batch).tuples()]
+            for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER):
+                Fingerprint.delete().where((Fingerprint.retriever == self.name) &
+                                           (Fingerprint.unique_id << unique_ids_batch)).execute()
+            if not doc_ids:
                 return
-            Attachment.delete().where(Attachment.document_id << doc_ids).execute()
-            Document.delete().where(Document.docid << doc_ids).execute()
-            Metadata.delete().where(Metadata.document_id << doc_ids).execute()
-            BlobData.delete().where(
-                BlobData.hash << (BlobData
-                                  .select(BlobData.hash)
-                                  .join(Attachment, on=(BlobData.hash == Attachment.hash), join_type=JOIN.LEFT_OUTER)
-                                  .group_by(BlobData)
-                                  .having(fn.Count(Attachment.hash) == 0)
-                                  )).execute()
+            self._release_blobs(self._delete_docids(doc_ids, vector_index))
+
+    def _delete_docids(self, doc_ids: List[int], vector_index: Optional[VectorIndex]) -> Set[str]:
+        ":return: the hashes of the blobs the deleted rows pointed to"
+        released_hashes = set()
+        self.vocabulary.remove(doc_ids)
+        for doc_ids_batch in chunked(doc_ids, SQLITE_MAX_VARIABLE_NUMBER):
+            released_hashes.update(content_hash for content_hash, in Attachment
+                                   .select(Attachment.hash)
+                                   .where(Attachment.document_id << doc_ids_batch)
+                                   .tuples())
+            IndexDocument.delete().where(IndexDocument.document_id << doc_ids_batch).execute()
+            Attachment.delete().where(Attachment.document_id << doc_ids_batch).execute()
+            Document.delete().where(Document.docid << doc_ids_batch).execute()
+            Metadata.delete().where(Metadata.document_id << doc_ids_batch).execute()
+            Embedding.delete().where(Embedding.document << doc_ids_batch).execute()
+        if vector_index is not None and doc_ids:
+            after_commit(partial(vector_index.remove, list(doc_ids)))
+        return released_hashes
+
+    def _stored_key_values(self) -> List[str]:
+        "Distinct values of the vocabulary_key of the stored objects"
+        return [key_value for key_value, in Metadata
+                .select(Metadata.value)
+                .distinct()
+                .join(IndexDocument, on=(IndexDocument.document == Metadata.document))
+                .where((Metadata.key == self.vocabulary_key) & (IndexDocument.index << self.indexes))
+                .tuples()]
+
+    def _unique_ids_of(self, key_value: str, limit: int) -> List[str]:
+        "Unique ids of up to limit stored objects with this value of the vocabulary_key, oldest rows first"
+        key_metadata = Metadata.alias('key_metadata')
+        return [unique_id for unique_id, in Metadata
+                .select(Metadata.value)
+                .join(key_metadata, on=((key_metadata.document == Metadata.document) &
+                                        (key_metadata.key == self.vocabulary_key)))
+                .join_from(Metadata, IndexDocument, on=(IndexDocument.document == Metadata.document))
+                .where((Metadata.key == Retrievable.unique_id_field()) & (key_metadata.value == key_value) &
+                       (IndexDocument.index << self.indexes))
+                .group_by(Metadata.value)
+                .order_by(fn.MIN(Metadata.document))
+                .limit(limit)
+                .tuples()]
+
+    def _copy_to(self, unique_ids: List[str], target: ConnectionPool):
+        """Copy the stored rows of the objects, with their blobs, embeddings and fingerprints,
+        to the database of target in a single transaction, replacing the rows it already had for them.
+        The new docids follow the order of the copied ones, which orders the results with equal scores."""
+        stored = self._stored_rows(unique_ids)
+        content_hashes = {unique_id: next(iter(rows.values()))[4] for unique_id, rows in stored.items()}
+        blobs = {}
+        fingerprints = {}
+        for content_hashes_batch in chunked(set(content_hashes.values()), SQLITE_MAX_VARIABLE_NUMBER):
+            blobs.update(BlobData.select(BlobData.hash, BlobData.data).where(
+                BlobData.hash << content_hashes_batch).tuples())
+        for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER):
+            fingerprints.update(Fingerprint.select(Fingerprint.unique_id, Fingerprint.fingerprint).where(
+                (Fingerprint.retriever == self.name) & (Fingerprint.unique_id << unique_ids_batch)).tuples())
+        index_positions = {index.id: position for position, index in enumerate(self.indexes)}
+        with routed(target):
+            target_indexes = self.indexes
+            new_rows = [(unique_id, (target_indexes[index_positions[index_id]].id, None, content, metadata,
+                                     embedding_bytes))
+                        for _, unique_id, (index_id, content, metadata, embedding_bytes, _) in
+                        sorted((docid, unique_id, row) for unique_id, rows in stored.items()
+                               for docid, row in rows.items())]
+            vector_index = self.vector_index  # rebuilt before our writes when missing
+            with write_transaction():
+                self.vocabulary.ensure()
+                replaced_docids = [docid
+                                   for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER)
+                                   for docid, in self._get_docids(*unique_ids_batch).tuples()]
+                released_hashes = self._delete_docids(replaced_docids, vector_index)
+                self._insert_rows(BlobData, [{'hash': content_hash, 'data': bytes(data)}
+                                             for content_hash, data in blobs.items()], ignore_conflicts=True)
+                self._insert_new_rows(new_rows, content_hashes, vector_index)
+                self._release_blobs(released_hashes - set(content_hashes.values()))
+                self._insert_rows(Fingerprint, [{'retriever': self.name, 'unique_id': unique_id,
+                                                 'fingerprint': fingerprint}
+                                                for unique_id, fingerprint in fingerprints.items()], replace=True)
+
+    def move_to_shards(self, router: ShardRouter, batch_size: int = DOCUMENT_BULK_BATCH_SIZE,
+                       before_delete: Optional[Callable[[List[str], ConnectionPool], None]] = None) -> Dict[str, int]:
+        """Move the objects stored in the database the current thread is routed to (by default the main one)
+        to the database router gives the value of their vocabulary_key, e.g. the shard of their user_id,
+        batch_size objects at a time. Every batch is copied in a transaction of its target database,
+        then deleted from the current one, so that a move which stopped halfway can be run again.
+
+        :param before_delete: called with the unique_ids of every batch and the target pool, once they are copied
+        :return: the number of moved objects by value of the vocabulary_key
+        """
+        if self.vocabulary_key is None:
+            raise ValueError(f"Retriever {self.name} has no vocabulary_key to route its objects with")
+        moved = OrderedDict()
+        for key_value in self._stored_key_values():
+            with router.held(key_value) as target:
+                if target is current_pool():
+                    continue
+                moved[key_value] = 0
+                while True:
+                    unique_ids = self._unique_ids_of(key_value, batch_size)
+                    if not unique_ids:
+                        break
+                    self._copy_to(unique_ids, target)
+                    if before_delete is not None:
+                        before_delete(unique_ids, target)
+                    self.delete_documents(unique_ids)
+                    moved[key_value] += len(unique_ids)
+        return moved
+
+    def _invalidate(self, content_hashes: List[str]):
+        self.cache.invalidate(content_hashes)
+        if self.shared_cache is not None:
+            self.shared_cache.invalidate(content_hashes)
+
+    def _release_blobs(self, content_hashes: Iterable[str]):
+        """Drop these blobs from the caches, and from the database when no attachment points to them anymore,
+        right away or later on depending on BLOB_COLLECTION_MODE"""
+        for content_hashes_batch in chunked(content_hashes, SQLITE_MAX_VARIABLE_NUMBER):
+            self._invalidate(content_hashes_batch)
+            if BLOB_COLLECTION_MODE == 'immediate':
+                _delete_orphan_blobs(content_hashes_batch)
+            else:
+                self._insert_rows(ReleasedBlob, [{'hash': content_hash} for content_hash in content_hashes_batch],
+                                  ignore_conflicts=True)
+        if BLOB_COLLECTION_MODE == 'background':
+            BlobCollector.start_once()
+
+    @staticmethod
+    def rerank(search_results: List[SearchResult], query_embedding: Any, vector_weight: float) -> List[SearchResult]:
+        """Order the results by (1 - vector_weight) * lexical score + vector_weight * cosine similarity
+        between their embedding and the query embedding, with a single matrix-vector product.
+        Results without an embedding of the same dimension get a vector score of 0."""
+        query_vector = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        embeddings_matrix = np.zeros((len(search_results), len(query_vector)), dtype=np.float32)
+        for row, embedding in enumerate(SearchResult.load_embeddings(search_results)):
+            if embedding is not None and len(embedding) == len(query_vector):
+                embeddings_matrix[row] = embedding
+        norms = np.linalg.norm(embeddings_matrix, axis=1) * np.linalg.norm(query_vector)
+        vector_scores = np.divide(embeddings_matrix @ query_vector, norms, out=np.zeros_like(norms), where=norms > 0)
+        for search_result, vector_score in zip(search_results, vector_scores.tolist()):
+            search_result.vector_score = vector_score
+            search_result.matched_score = (1.0 - vector_weight) * search_result.matched_score + \
+                                          vector_weight * vector_score
+        return sorted(search_results, key=lambda search_result: search_result.matched_score, reverse=True)
+
+    def _matching_documents(self, keys: Dict[str, Any], docids: Optional[List[int]] = None) -> ModelSelect:
+        "Stored rows indexed by this retriever and matching keys, among docids when given"
+        query = DocumentSearch().search('*', index=self.indexes, **self._searchable_keys(keys))
+        return query if docids is None else query.where(Document.docid << docids)
+
+    def _matching_nearest(self, nearest: List[Tuple[int, float]], keys: Dict[str, Any]) -> 'OrderedDict[int, Document]':
+        "Stored rows of the (docid, score) pairs of the vector index which match keys, in the same order"
+        documents = {}
+        for docids_batch in chunked([docid for docid, _ in nearest], SQLITE_MAX_VARIABLE_NUMBER):
+            documents.update((document.docid, document) for document in self._matching_documents(
+                keys, docids_batch).select(Document.docid, Document.content))
+        return OrderedDict((docid, documents[docid]) for docid, _ in nearest if docid in documents)
+
+    def retrieve_similar(self, query_embedding: Any, limit: int, query: str = '', n_probe: Optional[int] = None,
+                         **keys) -> Generator[SearchResult, None, None]:
+        """Nearest chunks to the query embedding in the vector index, filtered by keys like retrieve().
+        The nearest entries of the index are checked against the stored rows a batch at a time, which leaves out
+        those not matching keys and those left behind, e.g. by a process stopped before updating the index.
+        When the rows matching keys are rare among them, the index is searched among those rows instead.
+        The cosine similarities are recomputed from the stored embeddings."""
+        documents = OrderedDict()
+        for batch_number, nearest in enumerate(self.vector_index.iter_nearest(query_embedding, 2 * limit, n_probe)):
+            documents.update(self._matching_nearest(nearest, keys))
+            if len(documents) >= limit:
+                break
+            if not documents or batch_number + 1 == _MAX_NEAREST_BATCHES:
+                allowed_docids = [docid for docid, in self._matching_documents(keys).select(Document.docid).tuples()]
+                documents = self._matching_nearest(
+                    self.vector_index.search(query_embedding, limit, allowed_docids, n_probe), {})
+                break
+        search_results = [SearchResult(original_query=query, matched_content=document.content,
+                                       matched_score=0.0, _scout_result=document,
+                                       _retriever=self, _pool=current_pool())
+                          for document in islice(documents.values(), limit)]
+        yield from self.rerank(search_results, query_embedding, vector_weight=1.0)
 
     def _query_to_phrase(self, query: str):
-        """Proxy a retriever by making a sqllite full-text search with optional tokens."""
-        return '"' + '" OR "'.join(re.sub(_NON_WORD_CHARS, "", query.lower().strip()).split()) + '"'
+        """Proxy a retriever by making a sqllite full-text search with optional tokens, see QueryPlanner."""
+        return self.query_planner.compile(query, self.vocabulary)
+
+    def retrieve(self, query: str, limit: Optional[int] = None, ranking: Ranking = DEFAULT_RANKING,
+                 unique: bool = False, **keys) -> Generator[SearchResult, None, None]:
+        """Best matches of the query first, filtered by keys.
+
+        :param limit: maximum number of results, applied by the query
+        :param ranking: ranking function, column weights and metadata boosts ordering the matches
+        :param unique: only the best matching chunk of each object, deduplicated by the query as well,
+                       so that the top results of many matching chunks cost as many rows as there are results
+        """
+        pool = current_pool()
+        matches = DocumentSearch().search(phrase=self._query_to_phrase(query), index=self.indexes, ranking=ranking,
+                                          **self._searchable_keys(keys))
+        if unique:
+            unique_sql, params = self._best_match_per_object(matches)
+            matches = Document.raw(f'{unique_sql} ORDER BY score, docid LIMIT ?', *params,
+                                   -1 if limit is None else limit)
+        else:
+            matches = matches.limit(limit)
+        yield from (
+            SearchResult(
+                original_query=query,
+                matched_content=result.content,
+                matched_score=ranking.matched_score(result.score) * _MAX_RETRIEVER_SCORE,
+                _scout_result=result,
+                _retriever=self,
+                _pool=pool)
+            for result in matches)
 
-    def retrieve(self, query: str, limit: Optional[int] = None, **keys) -> Generator[SearchResult, None, None]:
+    @staticmethod
+    def _best_match_per_object(matches: ModelSelect) -> Tuple[str, list]:
+        """SQL and parameters of the best scoring row of matches for each object, with its unique_id column,
+        numbered by ROW_NUMBER() over the rows of the same object so that SQLite skips the others."""
+        unique_id_metadata = Metadata.alias('unique_id_metadata')
+        matches = (matches
+                   .select(*matches._returning, unique_id_metadata.value.alias('unique_id'))
+                   .switch(Document)
+                   .join(unique_id_metadata, on=((unique_id_metadata.document == Document.docid) &
+                                                 (unique_id_metadata.key == Retrievable.unique_id_field())))
+                   .order_by())
+        matches_sql, params = matches.sql()
+        return (f'SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY unique_id ORDER BY score, docid) '
+                f'AS object_rank FROM ({matches_sql})) WHERE object_rank = 1', params)
+
+    def retrieve_grouped(self, query: str, group_key: str, group_values: Iterable[Optional[str]],
+                         limit_per_group: Optional[int] = None, ranking: Ranking = DEFAULT_RANKING,
+                         unique: bool = False, limit: Optional[int] = None,
+                         **keys) -> Generator[SearchResult, None, None]:
+        """Same results as roundrobin() over retrieve(query, limit_per_group, **{group_key: value}, **keys)
+        for each of the group values, with a single query instead of one per group value.
+        Matches are numbered per group by ROW_NUMBER(), which applies the limit per group,
+        and ordered by that number then by the position of their group in group_values.
+
+        :param unique: only the best matching chunk of each object, as for retrieve()
+        :param limit: maximum number of results over all the groups
+        """
+        group_values = list(OrderedDict.fromkeys('' if value is None else value for value in group_values))
+        if not group_values:
+            return
+        pool = current_pool()
+        group_metadata = Metadata.alias('group_metadata')
+        matches = DocumentSearch().search(phrase=self._query_to_phrase(query), index=self.indexes,
+                                          ranking=ranking, **self._searchable_keys(keys))
+        matches = (matches
+                   .select(*matches._returning, group_metadata.value.alias('group_value'),
+                           Case(group_metadata.value, [(value, position) for position, value in
+                                                       enumerate(group_values)]).alias('group_position'))
+                   .switch(Document)
+                   .join(group_metadata, on=((group_metadata.document == Document.docid) &
+                                             (group_metadata.key == group_key)))
+                   .where(group_metadata.value << group_values)
+                   .order_by())
+        matches_sql, params = self._best_match_per_object(matches) if unique else matches.sql()
+        numbered_sql = (f'SELECT *, ROW_NUMBER() OVER (PARTITION BY group_value ORDER BY score) AS group_rank '
+                        f'FROM ({matches_sql})')
+        if limit_per_group is not None:
+            numbered_sql = f'SELECT * FROM ({numbered_sql}) WHERE group_rank <= ?'
+            params.append(limit_per_group)
         yield from (
             SearchResult(
                 original_query=query,
                 matched_content=result.content,
-                matched_score=result.score * -_MAX_RETRIEVER_SCORE,
-                _scout_result=result)
+                matched_score=ranking.matched_score(result.score) * _MAX_RETRIEVER_SCORE,
+                _scout_result=result,
+                group=result.group_value,
+                _retriever=self,
+                _pool=pool)
             for result in
-            DocumentSearch().search(phrase=self._query_to_phrase(query), index=self.indexes, ranking='rank_similarity',
-                                    **self._searchable_keys(keys)).limit(limit))
+            Document.raw(f'{numbered_sql} ORDER BY group_rank, group_position LIMIT ?', *params,
+                         -1 if limit is None else limit))
+
+    def matching_unique_ids(self, phrase: str, ranking: Ranking = DEFAULT_RANKING, **keys) -> Select:
+        """Query of the unique_id and best score (lowest first) of the objects with a chunk matching the phrase,
+        without loading the objects."""
+        unique_id_metadata = Metadata.alias('unique_id_metadata')
+        matches = DocumentSearch().search(phrase=self._query_to_phrase(phrase), index=self.indexes,
+                                          ranking=ranking, **self._searchable_keys(keys))
+        matches = (matches
+                   .select(unique_id_metadata.value.alias('unique_id'), *matches._returning[-1:])  # the score
+                   .switch(Document)
+                   .join(unique_id_metadata, on=((unique_id_metadata.document == Document.docid) &
+                                                 (unique_id_metadata.key == Retrievable.unique_id_field())))
+                   .order_by()
+                   .limit(-1))  # keeps SQLite from flattening the subquery, matchinfo() cannot be aggregated
+        unique_id, score = Entity('matches', 'unique_id'), Entity('matches', 'score')
+        return (Select([_subquery(matches, 'matches')], [unique_id, fn.MIN(score).alias('score')])
+                .group_by(unique_id))
+
+    def get_sorted(self, phrase: str = '*', after: Optional[tuple] = None, limit: Optional[int] = None,
+                   **keys) -> Generator[Tuple[tuple, Retrievable], None, None]:
+        """Like get() but streamed straight from the database cursor and resumable,
+        yields (sort key, object) pairs ordered by sort key: the best score of the object when searching a phrase
+        and the docid of its oldest indexed chunk.
+        Values of the keys can be lists, which match any of their values.
+
+        :param after: only objects after this sort key, e.g. the sort key of the last object of the previous page
+        :param limit: maximum number of objects
+        """
+        for unique_hash, sort_key in self._sorted_hashes(phrase, after, limit, **keys):
+            yield sort_key, self.load(Attachment(hash=unique_hash))
+
+    def get_fields(self, field_names: Iterable[str], phrase: str = '*',
+                   **keys) -> Generator[Dict[str, Any], None, None]:
+        """Only the given top-level fields of the objects get_sorted() would return, in the same order,
+        decoded straight from their blobs without going through the cache."""
+        field_names = list(field_names)
+        for unique_hash, _ in self._sorted_hashes(phrase, **keys):
+            yield Retrievable.loads_fields(Attachment(hash=unique_hash).blob.data, field_names)
+
+    def _sorted_hashes(self, phrase: str = '*', after: Optional[tuple] = None, limit: Optional[int] = None,
+                       **keys) -> Generator[Tuple[str, tuple], None, None]:
+        "Blob hash and sort key of the objects of get_sorted()"
+        ranked = phrase != '*'
+        unique_id_metadata = Metadata.alias('unique_id_metadata')
+        matches = DocumentSearch().search(phrase=self._query_to_phrase(phrase) if ranked else phrase,
+                                          index=self.indexes, ranking='rank_similarity',
+                                          **self._searchable_keys(keys))
+        chunks = (matches
+                  .select(unique_id_metadata.value.alias('unique_id'), Document.docid.alias('docid'),
+                          Attachment.hash.alias('hash'), *(matches._returning[-1:] if ranked else []))
+                  .switch(Document)
+                  .join(unique_id_metadata, on=((unique_id_metadata.document == Document.docid) &
+                                                (unique_id_metadata.key == Retrievable.unique_id_field())))
+                  .switch(Document)
+                  .join(Attachment, on=(Attachment.document == Document.docid))
+                  .order_by()
+                  .limit(-1))  # keeps SQLite from flattening the subquery, matchinfo() cannot be aggregated
+        sort_key = ([fn.MIN(Entity('chunks', 'score'))] if ranked else []) + [fn.MIN(Entity('chunks', 'docid'))]
+        objects = (Select([_subquery(chunks, 'chunks')], [fn.MIN(Entity('chunks', 'hash')), *sort_key])
+                   .group_by(Entity('chunks', 'unique_id'))
+                   .order_by(*sort_key)
+                   .limit(limit))
+        if after is not None:
+            if len(after) != len(sort_key):
+                raise ValueError(f"Expected a sort key of {len(sort_key)} values, got {len(after)}")
+            objects = objects.having(RowValue(*sort_key) > RowValue(*after))
+        for unique_hash, *object_sort_key in objects.bind(database).tuples().iterator():
+            yield unique_hash, tuple(object_sort_key)
 
     def get(self, exception_to_raise_on_empty=None, **keys) -> Generator[Retrievable, None, None]:
         for key, value in keys.items():
@@ -215,4 +1018,4 @@ class Retriever():
         results = DocumentSearch().search(index=self.indexes, ranking='rank_similarity', **self._searchable_keys(keys))
         if exception_to_raise_on_empty is not None and len(results) == 0:
             raise exception_to_raise_on_empty
-        yield from Retriever._unique_everseen(results)
+        yield from self._unique_everseen(results)
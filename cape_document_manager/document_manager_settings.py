@@ -18,7 +18,47 @@ THIS_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__)))
 SPLITTER_WORDS_PER_CHUNK = int(os.getenv('CAPE_SPLITTER_WORDS_PER_CHUNK', int(5e2)))
 SPLITTER_WORDS_OVERLAP_BEFORE = int(os.getenv('CAPE_SPLITTER_WORDS_OVERLAP_BEFORE', int(5e1)))
 SPLITTER_WORDS_OVERLAP_AFTER = int(os.getenv('CAPE_SPLITTER_WORDS_OVERLAP_AFTER', int(5e1)))
-LOCAL_UNPICKLING_LRU_CACHE_MAX_SIZE = int(os.getenv('CAPE_LOCAL_UNPICKLING_LRU_CACHE_MAX_SIZE', int(5e4)))
+OBJECT_CACHE_MAX_BYTES = int(os.getenv('CAPE_OBJECT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+OBJECT_CACHE_TTL = float(os.getenv('CAPE_OBJECT_CACHE_TTL', 0)) or None  # seconds, 0 keeps objects until evicted
+OBJECT_CACHE_COPY_ON_READ = os.getenv('CAPE_OBJECT_CACHE_COPY_ON_READ', 'false').lower() == 'true'
+# e.g. /dev/shm/cape-object-cache to share the blobs between the processes of a host, disabled when empty
+SHARED_OBJECT_CACHE_FOLDER = os.getenv('CAPE_SHARED_OBJECT_CACHE_FOLDER', '')
+SHARED_OBJECT_CACHE_MAX_BYTES = int(os.getenv('CAPE_SHARED_OBJECT_CACHE_MAX_BYTES', 1024 * 1024 * 1024))
+# 'immediate' deletes released blobs on writes, 'deferred' leaves them to sweep_released_blobs(),
+# 'background' also sweeps them every BLOB_COLLECTOR_INTERVAL seconds in a thread of each process
+BLOB_COLLECTION_MODE = os.getenv('CAPE_BLOB_COLLECTION_MODE', 'immediate')
+BLOB_COLLECTION_BATCH_SIZE = int(os.getenv('CAPE_BLOB_COLLECTION_BATCH_SIZE', 500))
+BLOB_COLLECTOR_INTERVAL = float(os.getenv('CAPE_BLOB_COLLECTOR_INTERVAL', 60))
+EMBEDDING_BATCH_SIZE = int(os.getenv('CAPE_EMBEDDING_BATCH_SIZE', 64))
+DOCUMENT_BULK_BATCH_SIZE = int(os.getenv('CAPE_DOCUMENT_BULK_BATCH_SIZE', int(5e2)))
+DOCUMENT_PIPELINE_TASK_SIZE = int(os.getenv('CAPE_DOCUMENT_PIPELINE_TASK_SIZE', 16))
+DOCUMENT_PIPELINE_MAX_PENDING_TASKS_PER_WORKER = int(
+    os.getenv('CAPE_DOCUMENT_PIPELINE_MAX_PENDING_TASKS_PER_WORKER', 2))
+HYBRID_SEARCH_CANDIDATES = int(os.getenv('CAPE_HYBRID_SEARCH_CANDIDATES', 100))
+HYBRID_SEARCH_VECTOR_WEIGHT = float(os.getenv('CAPE_HYBRID_SEARCH_VECTOR_WEIGHT', 0.5))
+SQLITE_MAX_VARIABLE_NUMBER = int(os.getenv('CAPE_SQLITE_MAX_VARIABLE_NUMBER', 999))
+DEFAULT_PAGE_SIZE = int(os.getenv('CAPE_DEFAULT_PAGE_SIZE', 100))
+# 'fields' or 'pickle_zlib', the format of the original blobs, blobs of both formats can always be read
+BLOB_CODEC = os.getenv('CAPE_BLOB_CODEC', 'fields')
+BLOB_COMPRESSION_LEVEL = int(os.getenv('CAPE_BLOB_COMPRESSION_LEVEL', 1))
+# Longer search queries lose their stopwords then keep their rarest words in the index, 0 keeps them all
+QUERY_MAX_TERMS = int(os.getenv('CAPE_QUERY_MAX_TERMS', 32))
+# also remove the stopwords of the queries shorter than QUERY_MAX_TERMS
+QUERY_REMOVE_STOPWORDS = os.getenv('CAPE_QUERY_REMOVE_STOPWORDS', 'false').lower() == 'true'
+# Term statistics looked up by a process are cached this many seconds, its own writes refresh them right away
+VOCABULARY_CACHE_TTL = float(os.getenv('CAPE_VOCABULARY_CACHE_TTL', 60))
+VOCABULARY_CACHE_MAX_ENTRIES = int(os.getenv('CAPE_VOCABULARY_CACHE_MAX_ENTRIES', 100000))
+# Read connections kept by the connection pool of each process, and seconds a reader waits for one of them
+SQLITE_MAX_READ_CONNECTIONS = int(os.getenv('CAPE_SQLITE_MAX_READ_CONNECTIONS', 8))
+SQLITE_POOL_TIMEOUT = float(os.getenv('CAPE_SQLITE_POOL_TIMEOUT', 30))
+# Apply the document and annotation mutations of each process in a single writer thread, which commits
+# up to WRITE_QUEUE_MAX_BATCH_SIZE of them per transaction, waiting up to WRITE_QUEUE_MAX_DELAY seconds for more
+WRITE_QUEUE_ENABLED = os.getenv('CAPE_WRITE_QUEUE_ENABLED', 'false').lower() == 'true'
+WRITE_QUEUE_MAX_BATCH_SIZE = int(os.getenv('CAPE_WRITE_QUEUE_MAX_BATCH_SIZE', 64))
+WRITE_QUEUE_MAX_DELAY = float(os.getenv('CAPE_WRITE_QUEUE_MAX_DELAY', 0))
+# Threads running the calls of AsyncDocumentStore and AsyncAnnotationStore, and results streamed ahead of the consumer
+ASYNC_WORKERS = int(os.getenv('CAPE_ASYNC_WORKERS', SQLITE_MAX_READ_CONNECTIONS))
+ASYNC_STREAM_BUFFER_SIZE = int(os.getenv('CAPE_ASYNC_STREAM_BUFFER_SIZE', 16))
 
 DB_CONFIG = {
     # 'DATABASE': ':memory:',
@@ -28,3 +68,13 @@ DB_CONFIG = {
         'cache_size': int(os.getenv('CAPE_SQLITE_CACHE_SIZE', -1024 * 64))  # -kibibytes
     }
 }
+
+VECTOR_INDEX_FOLDER = os.getenv('CAPE_VECTOR_INDEX_FOLDER', DB_CONFIG['DATABASE'] + '-vectors')
+
+# 'none' keeps every tenant in DB_CONFIG['DATABASE'], 'tenant' gives each user_id a database file of its own
+# in SHARD_FOLDER, 'bucket' spreads the user_ids over SHARD_BUCKETS database files by hash
+SHARDING_MODE = os.getenv('CAPE_SHARDING_MODE', 'none')
+SHARD_BUCKETS = int(os.getenv('CAPE_SHARD_BUCKETS', 16))
+SHARD_FOLDER = os.getenv('CAPE_SHARD_FOLDER', DB_CONFIG['DATABASE'] + '-shards')
+# Shards whose connections each process keeps open, those of the least recently used ones in no use are closed beyond
+SHARD_MAX_OPEN = int(os.getenv('CAPE_SHARD_MAX_OPEN', 64))
@@ -12,21 +12,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import List, Dict, Iterable, Optional, Tuple, Any, Callable, Generator
+from typing import List, Dict, Iterable, Optional, Tuple, Any, Callable, Generator, Iterator, Sequence
+from collections import deque, OrderedDict
 
 from cape_splitter.splitter_core import Splitter
 
+from cape_document_manager.tables import DocumentCatalog, Metadata, IndexDocument
+from peewee import Case, fn, ModelSelect, Tuple as RowValue
 from cape_document_manager.document_manager_core import Retriever, Retrievable, Indexable, AUTOFILL, SearchResult, \
-    roundrobin
+    roundrobin, chunked, decode_cursor, paginate
+from cape_document_manager.rank_similarity import Ranking, DEFAULT_RANKING
+from cape_document_manager.connections import ConnectionPool, connection_pool, current_pool, routed, write_transaction
+from cape_document_manager.write_queue import queued_write
+from cape_document_manager.shards import shard_router, tenant_routed
 from cape_api_helpers.exceptions import UserException
 from cape_api_helpers.text_responses import *
 import calendar
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, InitVar, replace
+from copy import copy
 from datetime import datetime
+from itertools import chain, islice
 from hashlib import sha256
 
 from cape_document_manager.document_manager_settings import SPLITTER_WORDS_PER_CHUNK, SPLITTER_WORDS_OVERLAP_BEFORE, \
-    SPLITTER_WORDS_OVERLAP_AFTER
+    SPLITTER_WORDS_OVERLAP_AFTER, EMBEDDING_BATCH_SIZE, DOCUMENT_BULK_BATCH_SIZE, DOCUMENT_PIPELINE_TASK_SIZE, \
+    DOCUMENT_PIPELINE_MAX_PENDING_TASKS_PER_WORKER, HYBRID_SEARCH_CANDIDATES, HYBRID_SEARCH_VECTOR_WEIGHT, \
+    SQLITE_MAX_VARIABLE_NUMBER, DEFAULT_PAGE_SIZE
 
 
 @dataclass
@@ -42,6 +53,27 @@ class DocumentChunk(Indexable):
     user_id: str = field(default=AUTOFILL)
     document_id: str = field(default=AUTOFILL)
 
+    @property
+    def embedding_text(self) -> str:
+        return self.overlap_before + self.content + self.overlap_after
+
+    @staticmethod
+    def embedding_field() -> Optional[str]:
+        return 'embedding'
+
+    @staticmethod
+    def stable_id_field() -> Optional[str]:
+        return 'chunk_idx'
+
+
+def embed_chunks(chunks: Iterable[DocumentChunk], get_embeddings: Callable[[List[str]], Sequence[Any]],
+                 batch_size: int = EMBEDDING_BATCH_SIZE):
+    """Fill the embedding of the chunks, calling get_embeddings with up to batch_size texts at a time."""
+    for chunks_batch in chunked(chunks, batch_size):
+        embeddings = get_embeddings([chunk.embedding_text for chunk in chunks_batch])
+        for chunk, embedding in zip(chunks_batch, embeddings):
+            chunk.embedding = embedding
+
 
 @dataclass
 class DocumentRecord(Retrievable):
@@ -54,8 +86,12 @@ class DocumentRecord(Retrievable):
     created: datetime = field(default_factory=datetime.now)
     chunks: Dict[int, DocumentChunk] = field(default=dict)
     get_embedding: Callable[[str], Any] = field(default=len)
+    # When given, used instead of get_embedding to embed the chunks in batches, not stored with the record
+    get_embeddings: InitVar[Optional[Callable[[List[str]], Sequence[Any]]]] = None
+    # False leaves the embeddings to the caller, e.g. to batch them across documents
+    compute_embeddings: InitVar[bool] = True
 
-    def __post_init__(self):
+    def __post_init__(self, get_embeddings: Optional[Callable[[List[str]], Sequence[Any]]], compute_embeddings: bool):
         self.unique_id = str((self.user_id, self.document_id))
         spl = Splitter(["document_id"], [self.text], words_per_group=SPLITTER_WORDS_PER_CHUNK,
                        max_overlap_before=SPLITTER_WORDS_OVERLAP_BEFORE,
@@ -64,23 +100,135 @@ class DocumentRecord(Retrievable):
             group.idx:
                 DocumentChunk(chunk_idx=group.idx, content=group.text, overlap_before=group.overlap_before,
                               overlap_after=group.overlap_after, text_span=group.text_span,
-                              number_of_words=group.number_of_words,
-                              embedding=self.get_embedding(group.overlap_before + group.text + group.overlap_after))
+                              number_of_words=group.number_of_words)
             for doc_id in spl.document_groups
             for group in spl.document_groups[doc_id]
         }
+        if not compute_embeddings:
+            return
+        if get_embeddings is not None:
+            embed_chunks(self.chunks.values(), get_embeddings)
+        else:
+            for chunk in self.chunks.values():
+                chunk.embedding = self.get_embedding(chunk.embedding_text)
+
+    def dumps(self) -> bytes:
+        # the embeddings are stored once, as float32 vectors read through SearchResult.embedding
+        stored_record = copy(self)
+        stored_record.chunks = {idx: replace(chunk, embedding=None) for idx, chunk in self.chunks.items()}
+        return Retrievable.dumps(stored_record)
+
+    @staticmethod
+    def transient_fields() -> Tuple[str, ...]:
+        return 'get_embedding',
+
+    @staticmethod
+    def volatile_fields() -> Tuple[str, ...]:
+        return 'created',
 
     @staticmethod
     def transformer(document: 'DocumentRecord') -> Iterable[DocumentChunk]:
         return document.chunks.values()
 
 
+def build_document_records(documents_fields: List[dict],
+                           get_embeddings: Optional[Callable[[List[str]], Sequence[Any]]] = None,
+                           embedding_batch_size: int = EMBEDDING_BATCH_SIZE) -> List[DocumentRecord]:
+    """Split and embed documents, module level so that it can be sent to a worker process.
+    With get_embeddings, the chunks of all the documents are embedded together in batches of embedding_batch_size."""
+    if get_embeddings is None:
+        return [DocumentRecord(**fields) for fields in documents_fields]
+    records = [DocumentRecord(**fields, compute_embeddings=False) for fields in documents_fields]
+    embed_chunks(chain.from_iterable(record.chunks.values() for record in records), get_embeddings,
+                 embedding_batch_size)
+    return records
+
+
+# Fields of DocumentRecord kept in the DocumentCatalog
+_CATALOG_FIELDS = ('unique_id', 'user_id', 'document_id', 'title', 'origin', 'text', 'document_type', 'created')
+
+
 class DocumentStore:
-    _retriever: Retriever = Retriever('documentRetriever', transformations=[DocumentRecord.transformer])
+    _retriever: Retriever = Retriever('documentRetriever', transformations=[DocumentRecord.transformer],
+                                      vector_index=True, vocabulary_key='user_id')
+    _catalog_backfilled = False
 
     @staticmethod
-    def create_document(user_id: str, title: str, origin: str, text: str, document_type: str = 'text',
-                        document_id: Optional[str] = None, replace=False, get_embedding=None):
+    def _update_catalog(documents: Iterable[Dict[str, Any]]):
+        """Replace the catalog rows of the documents, given as dicts of their fields,
+        the caller holds the transaction of their upsert"""
+        documents_by_id = OrderedDict((document['unique_id'], document) for document in documents)
+        for unique_ids_batch in chunked(documents_by_id.keys(), SQLITE_MAX_VARIABLE_NUMBER):
+            DocumentCatalog.delete().where(DocumentCatalog.unique_id << unique_ids_batch).execute()
+        Retriever._insert_rows(DocumentCatalog, [{**{field_name: document[field_name]
+                                                     for field_name in _CATALOG_FIELDS if field_name != 'created'},
+                                                  'created': calendar.timegm(document['created'].utctimetuple())}
+                                                 for document in documents_by_id.values()])
+
+    @staticmethod
+    def backfill_catalog() -> int:
+        """Add the stored documents missing from the catalog, e.g. documents created before it existed.
+        :return: the number of documents added
+        """
+        missing_unique_ids = (Metadata
+                              .select(Metadata.value)
+                              .join(IndexDocument, on=(IndexDocument.document == Metadata.document))
+                              .where((Metadata.key == DocumentRecord.unique_id_field()) &
+                                     (IndexDocument.index << DocumentStore._retriever.indexes) &
+                                     Metadata.value.not_in(DocumentCatalog.select(DocumentCatalog.unique_id)))
+                              .group_by(Metadata.value)
+                              .order_by(fn.MIN(Metadata.document))
+                              .tuples())
+        number_of_documents = 0
+        for unique_ids_batch in chunked([unique_id for unique_id, in missing_unique_ids], DOCUMENT_BULK_BATCH_SIZE):
+            with write_transaction():
+                DocumentStore._update_catalog(
+                    next(DocumentStore._retriever.get_fields(_CATALOG_FIELDS,
+                                                             **{DocumentRecord.unique_id_field(): unique_id}))
+                    for unique_id in unique_ids_batch)
+            number_of_documents += len(unique_ids_batch)
+        return number_of_documents
+
+    @staticmethod
+    def warm_up():
+        "Connect and prepare the retriever and the catalog now, e.g. when a server starts, rather than on first use"
+        DocumentStore._retriever.warm_up()
+        DocumentStore._ensure_catalog()
+
+    @staticmethod
+    def move_to_shards(batch_size: int = DOCUMENT_BULK_BATCH_SIZE) -> Dict[str, int]:
+        """Move the documents of the database the current thread is routed to, by default the main one,
+        to the shard of their user_id, e.g. once SHARDING_MODE is set, see Retriever.move_to_shards
+        :return: the number of moved documents by user_id
+        """
+        DocumentStore.backfill_catalog()
+        return DocumentStore._retriever.move_to_shards(shard_router, batch_size, DocumentStore._move_catalog)
+
+    @staticmethod
+    def _move_catalog(unique_ids: List[str], target: ConnectionPool):
+        "Move the catalog rows of the documents to the database of target"
+        catalog_fields = [getattr(DocumentCatalog, field_name) for field_name in _CATALOG_FIELDS]
+        rows = [row for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER)
+                for row in DocumentCatalog.select(*catalog_fields).where(
+                    DocumentCatalog.unique_id << unique_ids_batch).order_by(DocumentCatalog.id).dicts()]
+        with routed(target), write_transaction():
+            for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER):
+                DocumentCatalog.delete().where(DocumentCatalog.unique_id << unique_ids_batch).execute()
+            Retriever._insert_rows(DocumentCatalog, rows)
+        with write_transaction():
+            for unique_ids_batch in chunked(unique_ids, SQLITE_MAX_VARIABLE_NUMBER):
+                DocumentCatalog.delete().where(DocumentCatalog.unique_id << unique_ids_batch).execute()
+
+    @staticmethod
+    def _ensure_catalog():
+        "Backfill the catalog of the main database once per process, shards never lack catalog rows"
+        if not DocumentStore._catalog_backfilled and current_pool() is connection_pool:
+            DocumentStore.backfill_catalog()
+            DocumentStore._catalog_backfilled = True
+
+    @staticmethod
+    def _document_fields(user_id: str, title: str, origin: str, text: str, document_type: str = 'text',
+                         document_id: Optional[str] = None, get_embedding=None) -> dict:
         if document_id is None:
             document_id = sha256(text.encode('utf-8')).hexdigest()
         fields = dict(user_id=user_id, title=title, document_id=document_id, origin=origin, text=text,
@@ -89,53 +237,269 @@ class DocumentStore:
             fields['get_embedding'] = DocumentStore.get_empty_embedding
         else:
             fields['get_embedding'] = get_embedding
-        document = DocumentRecord(**fields)
+        return fields
+
+    @staticmethod
+    def _document_records(user_id: str, documents: Iterable[dict], get_embedding=None, get_embeddings=None,
+                          embedding_batch_size: int = EMBEDDING_BATCH_SIZE,
+                          workers: Optional[int] = None) -> Iterator[DocumentRecord]:
+        """Build the records lazily and in order, in tasks of DOCUMENT_PIPELINE_TASK_SIZE documents
+        that run in a pool of worker processes when workers is given.
+        At most DOCUMENT_PIPELINE_MAX_PENDING_TASKS_PER_WORKER tasks per worker are in flight,
+        so reading the input and building records never runs far ahead of the caller."""
+        tasks = chunked((DocumentStore._document_fields(user_id, get_embedding=get_embedding, **document)
+                         for document in documents), DOCUMENT_PIPELINE_TASK_SIZE)
+        if not workers:
+            for task in tasks:
+                yield from build_document_records(task, get_embeddings, embedding_batch_size)
+            return
+        from concurrent.futures import ProcessPoolExecutor  # imports multiprocessing, only needed here
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = deque()
+            for task in tasks:
+                if len(pending) >= workers * DOCUMENT_PIPELINE_MAX_PENDING_TASKS_PER_WORKER:
+                    yield from pending.popleft().result()
+                pending.append(executor.submit(build_document_records, task, get_embeddings, embedding_batch_size))
+            while pending:
+                yield from pending.popleft().result()
+
+    @staticmethod
+    @tenant_routed
+    def create_document(user_id: str, title: str, origin: str, text: str, document_type: str = 'text',
+                        document_id: Optional[str] = None, replace=False, get_embedding=None, get_embeddings=None,
+                        embedding_batch_size: int = EMBEDDING_BATCH_SIZE):
+        fields = DocumentStore._document_fields(user_id, title, origin, text, document_type=document_type,
+                                                document_id=document_id, get_embedding=get_embedding)
+        document = build_document_records([fields], get_embeddings, embedding_batch_size)[0]
+        return DocumentStore._write_document(document, replace)
+
+    @staticmethod
+    @queued_write
+    def _write_document(document: DocumentRecord, replace: bool) -> dict:
         if not replace:
             docs = DocumentStore._retriever.get(**{DocumentRecord.unique_id_field(): document.unique_id})
             if list(docs):
-                raise UserException(ERROR_DOCUMENT_ALREADY_EXISTS % document_id)
-        DocumentStore._retriever.upsert_document(document)
+                raise UserException(ERROR_DOCUMENT_ALREADY_EXISTS % document.document_id)
+        with write_transaction():
+            if DocumentStore._retriever.upsert_document(document) != 'unchanged':
+                DocumentStore._update_catalog([vars(document)])
         return {"documentId": document.document_id}
 
+    @staticmethod
+    @tenant_routed
+    def create_documents(user_id: str, documents: Iterable[dict], replace=False, get_embedding=None,
+                         get_embeddings=None, embedding_batch_size: int = EMBEDDING_BATCH_SIZE,
+                         batch_size: int = DOCUMENT_BULK_BATCH_SIZE, workers: Optional[int] = None) -> List[dict]:
+        """
+        Bulk version of create_document, each batch is checked and written in a single transaction.
+        :param user_id:
+        :param documents: dicts with the arguments of create_document: title, origin, text
+                          and optionally document_type and document_id
+        :param replace:
+        :param get_embedding:
+        :param get_embeddings: embeds a list of texts at once, used instead of get_embedding,
+                               batches span the chunks of up to DOCUMENT_PIPELINE_TASK_SIZE documents
+        :param embedding_batch_size: maximum number of texts per get_embeddings call
+        :param batch_size: number of documents per transaction
+        :param workers: split and embed documents in this many worker processes while the calling process writes,
+                        get_embedding(s) must then be picklable (e.g. a module level function)
+        :return: one result per document, in order, with a "status" of "created", "updated" or "unchanged",
+                 or an "error" when the document already exists and replace is False
+        """
+        results = []
+        for records in chunked(DocumentStore._document_records(user_id, documents, get_embedding, get_embeddings,
+                                                               embedding_batch_size, workers), batch_size):
+            with write_transaction():
+                existing_ids = set() if replace else DocumentStore._retriever.existing_unique_ids(
+                    record.unique_id for record in records)
+                rejected = []
+                for record in records:
+                    rejected.append(record.unique_id in existing_ids)
+                    if not replace:  # a later document with the same id is rejected as if it already existed
+                        existing_ids.add(record.unique_id)
+                accepted_records = [record for record, is_rejected in zip(records, rejected) if not is_rejected]
+                statuses = DocumentStore._retriever.upsert_documents(accepted_records)
+                DocumentStore._update_catalog(vars(record) for record in accepted_records
+                                              if statuses[record.unique_id] != 'unchanged')
+                for record, is_rejected in zip(records, rejected):
+                    if is_rejected:
+                        results.append({"documentId": record.document_id,
+                                        "error": ERROR_DOCUMENT_ALREADY_EXISTS % record.document_id})
+                    else:
+                        results.append({"documentId": record.document_id, "status": statuses[record.unique_id]})
+        return results
+
     @staticmethod
     def _get_user_document(user_id: str, document_id: str) -> DocumentRecord:
         return next(DocumentStore._retriever.get(UserException(ERROR_DOCUMENT_DOES_NOT_EXIST % document_id),
                                                  **{'user_id': user_id, 'document_id': document_id}))
 
     @staticmethod
+    @tenant_routed
+    @queued_write
     def delete_document(user_id: str, document_id: str):
         document = DocumentStore._get_user_document(user_id, document_id)
-        DocumentStore._retriever.delete_document(document)
+        with write_transaction():
+            DocumentStore._retriever.delete_document(document)
+            DocumentCatalog.delete().where(DocumentCatalog.unique_id == document.unique_id).execute()
         return {'documentId': document_id}
 
     @staticmethod
-    def get_documents(user_id: str, search_term: str = None, document_ids: List[str] = ()):
-        selections_kwargs = [{'user_id': user_id, 'phrase': search_term if search_term else '*'}]
+    def _documents_query(user_id: str, search_term: str = None, document_ids: List[str] = (),
+                         include_text: bool = True) -> Tuple[ModelSelect, list]:
+        "Catalog query of the documents and its ordering, made of unique sort keys"
+        columns = [DocumentCatalog.document_id, DocumentCatalog.title, DocumentCatalog.origin,
+                   DocumentCatalog.document_type, DocumentCatalog.created]
+        if include_text:
+            columns.append(DocumentCatalog.text)
+        docs = DocumentCatalog.select(*columns).where(DocumentCatalog.user_id == user_id)
+        ordering = [DocumentCatalog.id]
+        if search_term:
+            matches = DocumentStore._retriever.matching_unique_ids(search_term, user_id=user_id).alias('matches')
+            docs = docs.join(matches, on=(DocumentCatalog.unique_id == matches.c.unique_id))
+            ordering.insert(0, matches.c.score)
         if document_ids:
-            selections_kwargs = [{'document_id': document_id, **selection}
-                                 for document_id in document_ids
-                                 for selection in selections_kwargs]
-        docs: Iterable[DocumentRecord] = roundrobin(*(DocumentStore._retriever.get(**selection)
-                                                      for selection in selections_kwargs))
-        return [{"id": doc.document_id,
+            document_ids = list(OrderedDict.fromkeys(document_ids))
+            docs = docs.where(DocumentCatalog.document_id << document_ids)
+            ordering.insert(0, Case(DocumentCatalog.document_id, [(document_id, position) for position, document_id
+                                                                  in enumerate(document_ids)]))
+        return docs, ordering
+
+    @staticmethod
+    @tenant_routed
+    def get_documents(user_id: str, search_term: str = None, document_ids: List[str] = (), include_text: bool = True,
+                      limit: Optional[int] = None, offset: int = 0) -> List[dict]:
+        """
+        List documents from the catalog, without loading them
+        :param user_id:
+        :param search_term: only documents with a chunk matching it, best match first
+        :param document_ids: only these documents, in this order
+        :param include_text: False leaves out the "text" of the documents
+        :param limit: maximum number of documents
+        :param offset: number of documents skipped
+        :return:
+        """
+        DocumentStore._ensure_catalog()
+        docs, ordering = DocumentStore._documents_query(user_id, search_term, document_ids, include_text)
+        docs = docs.order_by(*ordering)
+        if limit is not None or offset:
+            docs = docs.limit(-1 if limit is None else limit).offset(offset)
+        return [DocumentStore._catalog_entry(doc, include_text) for doc in docs]
+
+    @staticmethod
+    def _iter_documents(user_id: str, search_term: str = None, document_ids: List[str] = (),
+                        include_text: bool = True, after: Optional[tuple] = None,
+                        limit: Optional[int] = None) -> Generator[Tuple[tuple, dict], None, None]:
+        DocumentStore._ensure_catalog()
+        docs, ordering = DocumentStore._documents_query(user_id, search_term, document_ids, include_text)
+        docs = (docs
+                .select_extend(*(key.alias(f'sort_key_{idx}') for idx, key in enumerate(ordering)))
+                .order_by(*ordering)
+                .limit(limit))
+        if after is not None:
+            if len(after) != len(ordering):
+                raise ValueError(f"Expected a sort key of {len(ordering)} values, got {len(after)}")
+            docs = docs.where(RowValue(*ordering) > RowValue(*after))
+        for doc in docs.objects().iterator():  # flat attributes, named after the aliases
+            yield (tuple(getattr(doc, f'sort_key_{idx}') for idx in range(len(ordering))),
+                   DocumentStore._catalog_entry(doc, include_text))
+
+    @staticmethod
+    @tenant_routed
+    def iter_documents(user_id: str, search_term: str = None, document_ids: List[str] = (),
+                       include_text: bool = True, cursor: Optional[str] = None) -> Generator[dict, None, None]:
+        """Same documents as get_documents, streamed from the database cursor,
+        starting after the cursor of a page of get_documents_page when given."""
+        for _, entry in DocumentStore._iter_documents(user_id, search_term, document_ids, include_text,
+                                                      None if cursor is None else decode_cursor(cursor)):
+            yield entry
+
+    @staticmethod
+    @tenant_routed
+    def get_documents_page(user_id: str, search_term: str = None, document_ids: List[str] = (),
+                           include_text: bool = True, page_size: int = DEFAULT_PAGE_SIZE,
+                           cursor: Optional[str] = None) -> dict:
+        """
+        One page of get_documents, paginated on the sort keys of the documents so that every page is an indexed query
+        :param page_size: maximum number of documents in the page
+        :param cursor: the "nextCursor" of the previous page, None for the first page
+        :return: {"items": the documents, "nextCursor": cursor of the next page, None on the last page}
+        """
+        return paginate(DocumentStore._iter_documents(user_id, search_term, document_ids, include_text,
+                                                   None if cursor is None else decode_cursor(cursor),
+                                                   page_size + 1), page_size)
+
+    @staticmethod
+    def _catalog_entry(doc: DocumentCatalog, include_text: bool = True) -> dict:
+        entry = {"id": doc.document_id,
                  "title": doc.title,
                  "origin": doc.origin,
                  "text": doc.text,
                  "type": doc.document_type,
-                 "created": calendar.timegm(doc.created.utctimetuple()),
-                 } for doc in docs]
+                 "created": doc.created,
+                 }
+        if not include_text:
+            del entry["text"]
+        return entry
 
     @staticmethod
-    def search_chunks(user_id: str, query: str, document_ids: List[str] = (), limit_per_doc: Optional[int] = None) -> \
-            Generator[SearchResult, None, None]:
-        selections_kwargs = [{'user_id': user_id}]
-        if document_ids:
-            selections_kwargs = [{'document_id': document_id, **selection}
-                                 for document_id in document_ids
-                                 for selection in selections_kwargs]
-        search_results: Iterable[SearchResult] = roundrobin(*(
-            DocumentStore._retriever.retrieve(query=query, limit=limit_per_doc, **selection)
-            for selection in selections_kwargs))
+    @tenant_routed
+    def search_chunks(user_id: str, query: str, document_ids: List[str] = (), limit_per_doc: Optional[int] = None,
+                      mode: str = 'lexical', query_embedding: Any = None,
+                      vector_weight: float = HYBRID_SEARCH_VECTOR_WEIGHT,
+                      candidates: int = HYBRID_SEARCH_CANDIDATES,
+                      n_probe: Optional[int] = None,
+                      ranking: Ranking = DEFAULT_RANKING) -> Generator[SearchResult, None, None]:
+        """
+        Search document chunks
+        :param user_id:
+        :param query:
+        :param document_ids:
+        :param limit_per_doc:
+        :param mode: 'lexical' ranks by full text search score only,
+                     'hybrid' reranks the top candidates of the full text search with their embeddings,
+                     'vector' returns the nearest chunks to the query embedding, whatever their words
+        :param query_embedding: embedding of the query, required by the 'hybrid' and 'vector' modes
+        :param vector_weight: weight of the cosine similarity in the 'hybrid' score, the lexical score gets the rest
+        :param candidates: number of full text search results reranked per document in the 'hybrid' mode,
+                           number of results per document in the 'vector' mode when there is no limit_per_doc
+        :param n_probe: number of clusters scanned in the 'vector' mode, once the vector index is trained
+        :param ranking: full text search ranking of the 'lexical' and 'hybrid' modes, e.g. Ranking('bm25')
+        :return:
+        """
+        if mode not in ('lexical', 'hybrid', 'vector'):
+            raise ValueError(f"Unknown search mode {mode}")
+        if mode != 'lexical' and query_embedding is None:
+            raise ValueError(f"The '{mode}' mode requires a query_embedding")
+        if mode == 'vector':
+            selections_kwargs = [{'user_id': user_id}]
+            if document_ids:
+                selections_kwargs = [{'document_id': document_id, **selection}
+                                     for document_id in document_ids
+                                     for selection in selections_kwargs]
+            search_results: Iterable[SearchResult] = roundrobin(*(
+                DocumentStore._retriever.retrieve_similar(query_embedding, limit=limit_per_doc or candidates,
+                                                          query=query, n_probe=n_probe, **selection)
+                for selection in selections_kwargs))
+        elif not document_ids:
+            search_results = DocumentStore._retriever.retrieve(
+                query=query, limit=max(candidates, limit_per_doc or 0) if mode == 'hybrid' else limit_per_doc,
+                ranking=ranking, user_id=user_id)
+            if mode == 'hybrid':
+                search_results = islice(Retriever.rerank(list(search_results), query_embedding, vector_weight),
+                                        limit_per_doc)
+        elif mode == 'lexical':
+            search_results = DocumentStore._retriever.retrieve_grouped(query, 'document_id', document_ids,
+                                                                       limit_per_doc, ranking, user_id=user_id)
+        else:
+            results_per_document = OrderedDict((document_id, []) for document_id in document_ids)
+            for search_result in DocumentStore._retriever.retrieve_grouped(
+                    query, 'document_id', document_ids, max(candidates, limit_per_doc or 0), ranking,
+                    user_id=user_id):
+                results_per_document[search_result.group].append(search_result)
+            search_results = roundrobin(*(
+                islice(Retriever.rerank(document_results, query_embedding, vector_weight), limit_per_doc)
+                for document_results in results_per_document.values()))
         yield from search_results
 
     @staticmethod
@@ -0,0 +1,196 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import threading
+from hashlib import sha256
+from copy import deepcopy
+from time import monotonic
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Optional, Tuple
+
+_SHA256_HEX_DIGEST = re.compile('[0-9a-f]{64}')
+
+
+class ObjectCache:
+    """Least recently used cache of loaded objects, bounded by the total size of the objects in bytes.
+
+    :param max_bytes: budget, the least recently used objects are evicted beyond it, 0 disables the cache
+    :param ttl: seconds after which a cached object is loaded again, None to keep objects until evicted
+    :param copy_on_read: return a deep copy of the cached object, so that callers can modify what they get
+    """
+
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None, copy_on_read: bool = False):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.copy_on_read = copy_on_read
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, int, float]]' = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, load: Callable[[], Tuple[Any, int]]) -> Any:
+        """The cached object of key, otherwise the object returned by load() with its size, which is then cached."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and monotonic() - entry[2] > self.ttl:
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if entry is None:
+            obj, size = load()
+            if size <= self.max_bytes:
+                with self._lock:
+                    if key in self._entries:
+                        self._remove(key)
+                    self._entries[key] = (obj, size, monotonic())
+                    self._size += size
+                    while self._size > self.max_bytes:
+                        self._remove(next(iter(self._entries)))
+                        self.evictions += 1
+        else:
+            obj = entry[0]
+        return deepcopy(obj) if self.copy_on_read else obj
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._entries.pop(key)
+        self._size -= size
+
+    def invalidate(self, keys: Iterable[Hashable]):
+        with self._lock:
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self._size}
+
+
+class SharedBlobCache:
+    """Blobs shared by all the processes of a host, one file per blob named after its sha256 content hash,
+    e.g. in a /dev/shm folder. Files are written atomically and checked against their hash when read,
+    and since a content hash always names the same content, no process can read a stale blob.
+    Loaded Python objects cannot be shared between processes, so this tier saves reading and decompressing
+    the blob from the database while every process still decodes its own objects.
+
+    :param folder: where the files are kept, created when missing
+    :param max_bytes: the least recently used files are removed beyond this total size
+    """
+
+    def __init__(self, folder: str, max_bytes: int):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self._written_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, content_hash: str) -> Optional[str]:
+        "Path of the blob, None for keys which are not sha256 hex digests"
+        if not _SHA256_HEX_DIGEST.fullmatch(content_hash):
+            return None
+        return os.path.join(self.folder, content_hash)
+
+    def get(self, content_hash: str) -> Optional[bytes]:
+        path = self._path(content_hash)
+        data = None
+        if path is not None:
+            try:
+                with open(path, 'rb') as blob_file:
+                    data = blob_file.read()
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            if data is not None and sha256(data).hexdigest() != content_hash:
+                self._remove(path)
+                data = None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, content_hash: str, data: bytes):
+        path = self._path(content_hash)
+        if path is None or len(data) > self.max_bytes:
+            return
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary_path, 'wb') as blob_file:
+            blob_file.write(data)
+        os.replace(temporary_path, path)
+        with self._lock:
+            self._written_bytes += len(data)
+            sweep = self._written_bytes > self.max_bytes // 10
+            if sweep:
+                self._written_bytes = 0
+        if sweep:
+            self.sweep()
+
+    def sweep(self):
+        "Remove the least recently used files until the folder fits in max_bytes"
+        entries = []
+        for entry in os.scandir(self.folder):
+            try:
+                entry_stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+            with self._lock:
+                self.evictions += 1
+
+    @staticmethod
+    def _remove(path: str):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, content_hashes: Iterable[str]):
+        for content_hash in content_hashes:
+            path = self._path(content_hash)
+            if path is not None:
+                self._remove(path)
+
+    def clear(self):
+        for entry in os.scandir(self.folder):
+            self._remove(entry.path)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
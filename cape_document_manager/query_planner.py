@@ -0,0 +1,111 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+from typing import List, Dict, Iterable, FrozenSet, Optional
+from cape_document_manager.tables import DocumentVocabulary
+from cape_document_manager.vocabulary import Vocabulary, stems
+from cape_document_manager.document_manager_settings import QUERY_MAX_TERMS, QUERY_REMOVE_STOPWORDS, \
+    SQLITE_MAX_VARIABLE_NUMBER
+
+_NON_WORD_CHARS = re.compile(r'[^0-9a-zA-Z\s]')
+_QUOTED_OR_WORD = re.compile(r'"([^"]*)"|(\S+)')
+
+# English stopwords, without apostrophes since queries are stripped of them
+STOPWORDS = frozenset("""
+a about above after again against all am an and any are arent as at be because been before being below between both
+but by can cant cannot could couldnt did didnt do does doesnt doing dont down during each few for from further had
+hadnt has hasnt have havent having he hed hell hes her here heres hers herself him himself his how hows i id ill im
+ive if in into is isnt it its itself lets me more most mustnt my myself no nor not of off on once only or other ought
+our ours ourselves out over own same shant she shed shell shes should shouldnt so some such than that thats the their
+theirs them themselves then there theres these they theyd theyll theyre theyve this those through to too under until
+up very was wasnt we wed well were weve werent what whats when whens where wheres which while who whos whom why whys
+with wont would wouldnt you youd youll youre youve your yours yourself yourselves
+""".split())
+
+
+def _normalized(text: str) -> str:
+    return re.sub(_NON_WORD_CHARS, "", text.lower().strip())
+
+
+class QueryPlanner:
+    """Compiles a free text query into an FTS4 MATCH expression ORing its terms, as Retriever always did,
+    without duplicate words (same stem). Queries of more than max_terms terms also lose their stopwords,
+    then their most common words according to the document counts of the Vocabulary of the retriever when given,
+    otherwise of the whole index vocabulary,
+    so that a long pasted question does not scan most of the index.
+
+    Query syntax: "quoted words" match as a phrase, word* matches the words starting with word,
+    both are kept whatever their frequency. Any other character is ignored.
+
+    :param max_terms: maximum number of terms, 0 keeps them all
+    :param remove_stopwords: remove the stopwords of short queries as well
+    :param stopwords: words dropped from long queries, unless they only have stopwords
+    """
+
+    def __init__(self, max_terms: int = QUERY_MAX_TERMS, remove_stopwords: bool = QUERY_REMOVE_STOPWORDS,
+                 stopwords: Iterable[str] = STOPWORDS):
+        self.max_terms = max_terms
+        self.remove_stopwords = remove_stopwords
+        self.stopwords: FrozenSet[str] = frozenset(stopwords)
+
+    @staticmethod
+    def document_counts(stems: Iterable[str]) -> Dict[str, int]:
+        "Number of indexed chunks containing each stem, stems missing from the index are left out"
+        counts = {}
+        stems = list(stems)
+        for start in range(0, len(stems), SQLITE_MAX_VARIABLE_NUMBER - 1):
+            counts.update(DocumentVocabulary
+                          .select(DocumentVocabulary.term, DocumentVocabulary.documents)
+                          .where((DocumentVocabulary.col == '*') &
+                                 (DocumentVocabulary.term << stems[start:start + SQLITE_MAX_VARIABLE_NUMBER - 1]))
+                          .tuples())
+        return counts
+
+    def terms(self, query: str, vocabulary: Optional[Vocabulary] = None) -> List[str]:
+        "FTS terms of the query, in query order"
+        explicit_terms = {}  # term: position, of the phrases and prefixes then of all the kept terms
+        words = []  # (position, word)
+        for position, (quoted, word) in enumerate(_QUOTED_OR_WORD.findall(query)):
+            if quoted:
+                phrase = ' '.join(_normalized(quoted).split())
+                if phrase:
+                    explicit_terms.setdefault(f'"{phrase}"', position)
+            elif word.endswith('*') and _normalized(word):
+                explicit_terms.setdefault(f'"{_normalized(word)}*"', position)
+            elif _normalized(word):
+                words.append((position, _normalized(word)))
+        if words:
+            kept_words = {}  # stem: (position, word), first occurrence of each stem
+            for (position, word), stem in zip(words, stems([word for _, word in words])):
+                kept_words.setdefault(stem, (position, word))
+            too_many_terms = self.max_terms and len(kept_words) + len(explicit_terms) > self.max_terms
+            if (self.remove_stopwords or too_many_terms) and \
+                    (explicit_terms or any(word not in self.stopwords for _, word in kept_words.values())):
+                kept_words = {stem: (position, word) for stem, (position, word) in kept_words.items()
+                              if word not in self.stopwords}
+            number_of_words = max(self.max_terms - len(explicit_terms), 0) if self.max_terms else len(kept_words)
+            if len(kept_words) > number_of_words:
+                counts = (vocabulary.document_frequencies(kept_words) if vocabulary is not None else
+                          self.document_counts(kept_words))
+                rarest_first = sorted(kept_words, key=lambda stem: (not counts.get(stem), counts.get(stem, 0),
+                                                                    kept_words[stem][0]))
+                kept_words = {stem: kept_words[stem] for stem in rarest_first[:number_of_words]}
+            explicit_terms.update((f'"{word}"', position) for position, word in kept_words.values())
+        return sorted(explicit_terms, key=explicit_terms.get)
+
+    def compile(self, query: str, vocabulary: Optional[Vocabulary] = None) -> str:
+        "MATCH expression of the query"
+        terms = self.terms(query, vocabulary)
+        return ' OR '.join(terms) if terms else '""'
@@ -12,21 +12,128 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from peewee import fn
-from cape_document_manager.tables import database
+from math import log, sqrt
+from functools import lru_cache
+from dataclasses import dataclass
+from typing import Tuple
+from peewee import fn, Case
+from scout.models import Metadata
+from cape_document_manager.connections import database
 
-import pyximport
+_BM25_K1 = 1.2
+_BM25_B = 0.75
 
-importers = pyximport.install()
 
-from cape_document_manager._rank_similarity import register_rank_functions
+@lru_cache(maxsize=32)
+def _weighted_columns(raw_weights: tuple) -> tuple:
+    "(column, weight) pairs of the columns with a non zero weight, parsed once per distinct weights"
+    return tuple((col, float(weight)) for col, weight in enumerate(raw_weights) if float(weight) != 0.0)
 
-pyximport.uninstall(*importers)
-register_rank_functions(database)
 
+def _checked_match_info(py_match_info) -> memoryview:
+    "matchinfo(table, 'pcnalx') read in place as native unsigned ints, after checking that it holds all the terms"
+    match_info = memoryview(py_match_info).cast('I')
+    if len(match_info) < 3 or len(match_info) < 3 + 2 * match_info[1] + 3 * match_info[1] * match_info[0]:
+        raise ValueError("Expected matchinfo(table, 'pcnalx')")
+    return match_info
+
+
+def python_rank_similarity(py_match_info, *raw_weights) -> float:
+    "Pure Python equivalent of _rank_similarity.rank_similarity, used when the extension is not built"
+    match_info = _checked_match_info(py_match_info)
+    term_count, col_count, total_docs = match_info[0], match_info[1], match_info[2]
+    initial_position = 3 + col_count + col_count
+    pseudo_norm_doc = norm_query = component_sum = 0.0
+    for col, col_weight in _weighted_columns(raw_weights):
+        if col >= col_count:
+            break
+        for initial_row_col in range(initial_position + 3 * col, initial_position + 3 * col_count * term_count,
+                                     3 * col_count):
+            idf = log(total_docs / (1 + match_info[initial_row_col + 2]))
+            tfidf_doc = match_info[initial_row_col] * idf
+            component_sum += tfidf_doc * idf * col_weight
+            pseudo_norm_doc += tfidf_doc * tfidf_doc * col_weight
+            norm_query += idf * idf * col_weight
+    if pseudo_norm_doc == 0.0:
+        pseudo_norm_doc = norm_query
+    if component_sum == 0.0:  # weights ignored all the columns
+        return -0.0
+    return -component_sum / (sqrt(norm_query) * sqrt(pseudo_norm_doc))
+
+
+def python_rank_bm25(py_match_info, *raw_weights) -> float:
+    "Pure Python equivalent of _rank_similarity.rank_bm25, used when the extension is not built"
+    match_info = _checked_match_info(py_match_info)
+    term_count, col_count, total_docs = match_info[0], match_info[1], match_info[2]
+    initial_position = 3 + col_count + col_count
+    score = 0.0
+    for col, col_weight in _weighted_columns(raw_weights):
+        if col >= col_count:
+            break
+        average_length = match_info[3 + col]
+        length_norm = _BM25_K1 * (1.0 - _BM25_B)
+        if average_length > 0:
+            length_norm += _BM25_K1 * _BM25_B * match_info[3 + col_count + col] / average_length
+        for initial_row_col in range(initial_position + 3 * col, initial_position + 3 * col_count * term_count,
+                                     3 * col_count):
+            term_frequency = match_info[initial_row_col]
+            docs_with_hits = match_info[initial_row_col + 2]
+            idf = max(log((total_docs - docs_with_hits + 0.5) / (docs_with_hits + 0.5)), 1e-6)
+            score += col_weight * idf * term_frequency * (_BM25_K1 + 1.0) / (term_frequency + length_norm)
+    return -score
+
+
+try:  # built ahead of time by setup.py
+    from cape_document_manager._rank_similarity import rank_similarity as _compiled_rank_similarity, \
+        rank_bm25 as _compiled_rank_bm25
+except ImportError:
+    _compiled_rank_similarity = _compiled_rank_bm25 = None
+
+RANK_SIMILARITY_IMPLEMENTATION = 'python' if _compiled_rank_similarity is None else 'cython'
+database.register_function(_compiled_rank_similarity or python_rank_similarity, 'rank_similarity')
+database.register_function(_compiled_rank_bm25 or python_rank_bm25, 'rank_bm25')
+
+# Functions of matchinfo(table, 'pcnalx') and the column weights, lower scores rank first
+RANK_FUNCTIONS = {'rank_similarity': fn.rank_similarity, 'bm25': fn.rank_bm25}
 
-def rank_similarity(cls):
-    return fn.rank_similarity(fn.matchinfo(cls._meta.entity, 'pcnalx'), 1.0,
-                              0.0)  # we ignore the null 'identifier' column
 
+@dataclass(frozen=True)
+class Ranking:
+    """How full text search matches are scored and ordered.
 
+    :param function: 'rank_similarity', a tf-idf cosine similarity in [0, 1], or 'bm25', Okapi BM25
+    :param column_weights: weight of the content and identifier columns of the search table
+    :param boosts: (metadata key, value, factor) triples, the score of the matches with this metadata
+                   is multiplied by factor, e.g. ('canonical', True, 2.0) ranks canonical questions first
+    """
+    function: str = 'rank_similarity'
+    column_weights: Tuple[float, ...] = (1.0, 0.0)  # we ignore the null 'identifier' column
+    boosts: Tuple[Tuple[str, object, float], ...] = ()
+
+    def __post_init__(self):
+        if self.function not in RANK_FUNCTIONS:
+            raise ValueError(f"Unknown ranking function {self.function!r}, expected one of {sorted(RANK_FUNCTIONS)}")
+
+    def expression(self, cls):
+        "Score of the rows of cls, to order by ascending"
+        score = RANK_FUNCTIONS[self.function](fn.matchinfo(cls._meta.entity, 'pcnalx'), *self.column_weights)
+        for key, value, factor in self.boosts:
+            boosted = fn.EXISTS(Metadata.select().where((Metadata.document == cls.docid) & (Metadata.key == key) &
+                                                        (Metadata.value == Metadata.value.db_value(value))))
+            score = score * Case(None, [(boosted, factor)], 1.0)
+        return score
+
+    def matched_score(self, score: float) -> float:
+        """Score of a match in [0, 1], higher is better: BM25 scores are squashed with s / (1 + s)
+        and boosted similarities are capped at 1, which keeps the order of the matches."""
+        score = -score
+        if self.function == 'bm25':
+            return score / (1.0 + score)
+        return min(score, 1.0)
+
+
+DEFAULT_RANKING = Ranking()
+
+
+def rank_similarity(cls):
+    return DEFAULT_RANKING.expression(cls)
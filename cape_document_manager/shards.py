@@ -0,0 +1,177 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Per-tenant sharding of the stored objects by user_id.
+
+With SHARDING_MODE 'tenant' or 'bucket', the objects of every user_id live in the database file of its shard,
+with its own scout indexes, term statistics, vector index and writer connection, so that the searches of a tenant
+only match its own rows and tenants of different shards never wait on each other's writes.
+The calls of DocumentStore and AnnotationStore are routed to the shard of their user_id.
+Anything spanning tenants goes through ShardRouter.databases() explicitly, one database at a time,
+e.g. moving the objects of the main database to their shards once sharding is enabled:
+
+    for pool in shard_router.databases():
+        with routed(pool):
+            DocumentStore.move_to_shards()
+            AnnotationStore.move_to_shards()
+"""
+
+import os
+import inspect
+import threading
+from hashlib import sha256
+from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict
+from typing import Callable, Dict, Generator, Iterator, List, Optional
+from cape_document_manager.tables import database
+from cape_document_manager.connections import ConnectionPool, connection_pool, routed, routed_steps
+from cape_document_manager.document_manager_settings import SHARDING_MODE, SHARD_BUCKETS, SHARD_FOLDER, \
+    SHARD_MAX_OPEN
+
+_SHARD_EXTENSION = '.sqlite'
+
+
+class ShardRouter:
+    """Maps each user_id to the connection pool of the database holding its objects.
+
+    :param mode: 'none' keeps every user_id in the main database, 'tenant' gives each one a shard of its own,
+                 'bucket' spreads them over number_of_buckets shards by hash
+    :param folder: folder of the database files of the shards
+    :param number_of_buckets: number of shards of the 'bucket' mode, changing it requires moving the objects again
+    :param max_open: shards whose connections are kept open, those of the least recently used ones no thread holds
+                     are closed beyond
+    """
+
+    def __init__(self, mode: str = SHARDING_MODE, folder: str = SHARD_FOLDER, number_of_buckets: int = SHARD_BUCKETS,
+                 max_open: int = SHARD_MAX_OPEN):
+        if mode not in ('none', 'tenant', 'bucket'):
+            raise ValueError(f"Unknown sharding mode {mode!r}, expected 'none', 'tenant' or 'bucket'")
+        self.mode = mode
+        self.folder = folder
+        self.number_of_buckets = number_of_buckets
+        self.max_open = max_open
+        self._pools: 'OrderedDict[str, ConnectionPool]' = OrderedDict()  # least recently used first
+        self._holders: Dict[str, int] = {}  # number of blocks holding the pool of each shard
+        self._lock = threading.Lock()
+
+    def shard_name(self, user_id: str) -> Optional[str]:
+        "Name of the shard of user_id, None for the main database"
+        if self.mode == 'none':
+            return None
+        digest = sha256(user_id.encode('utf-8')).hexdigest()
+        if self.mode == 'tenant':
+            return f'tenant-{digest[:32]}'
+        return f'bucket-{int(digest[:16], 16) % self.number_of_buckets:04d}'
+
+    def shard_path(self, shard_name: str) -> str:
+        return os.path.join(self.folder, shard_name + _SHARD_EXTENSION)
+
+    def _evict(self) -> List[ConnectionPool]:
+        "Forget the least recently used pools beyond max_open that no thread holds, for the caller to close"
+        evicted = []
+        for shard_name in list(self._pools):
+            if len(self._pools) <= self.max_open:
+                break
+            if shard_name not in self._holders:
+                evicted.append(self._pools.pop(shard_name))
+        return evicted
+
+    def _close(self, evicted: List[ConnectionPool]):
+        for evicted_pool in evicted:  # outside of the lock, since it waits for their writer
+            evicted_pool.close_all()
+
+    @contextmanager
+    def held(self, user_id: str) -> Generator[ConnectionPool, None, None]:
+        """The pool of the database holding the objects of user_id, for the block.
+        The pool of a shard is not closed while a thread holds it, so that its file keeps a single pool and writer,
+        it is closed once released when more than max_open shards are open."""
+        shard_name = self.shard_name(user_id)
+        if shard_name is None:
+            yield connection_pool
+            return
+        with self._hold(shard_name) as pool:
+            yield pool
+
+    @contextmanager
+    def _hold(self, shard_name: str) -> Generator[ConnectionPool, None, None]:
+        with self._lock:
+            pool = self._pools.pop(shard_name, None)
+            if pool is None:
+                os.makedirs(self.folder, exist_ok=True)
+                pool = ConnectionPool(database, path=self.shard_path(shard_name))
+            self._pools[shard_name] = pool
+            self._holders[shard_name] = self._holders.get(shard_name, 0) + 1
+            evicted = self._evict()
+        self._close(evicted)
+        try:
+            yield pool
+        finally:
+            with self._lock:
+                self._holders[shard_name] -= 1
+                if not self._holders[shard_name]:
+                    del self._holders[shard_name]
+                evicted = self._evict()
+            self._close(evicted)
+
+    @contextmanager
+    def tenant(self, user_id: str):
+        "Route the queries of the current thread to the database of user_id for the block"
+        with self.held(user_id) as pool, routed(pool):
+            yield
+
+    def shard_names(self) -> List[str]:
+        "Names of the shards with a database file, whatever the current mode"
+        if not os.path.isdir(self.folder):
+            return []
+        return sorted(file_name[:-len(_SHARD_EXTENSION)] for file_name in os.listdir(self.folder)
+                      if file_name.endswith(_SHARD_EXTENSION))
+
+    def databases(self) -> Iterator[ConnectionPool]:
+        """Pools of the main database and of every shard, for the operations spanning tenants,
+        each one held until the next one is taken. The shards are listed before the first one is taken."""
+        shard_names = self.shard_names()
+        yield connection_pool
+        for shard_name in shard_names:
+            with self._hold(shard_name) as pool:
+                yield pool
+
+    def close_all(self):
+        "Close the connections of every shard, e.g. before their database files are replaced"
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), OrderedDict()
+        for pool in pools:
+            pool.close_all()
+
+
+shard_router = ShardRouter()
+
+
+def tenant_routed(function: Callable) -> Callable:
+    """Run the decorated store function, whose first argument is a user_id, on the database of that user_id.
+    Generator functions run on it one step at a time, so that their consumer is not routed between steps."""
+    if inspect.isgeneratorfunction(function):
+        @wraps(function)
+        def generator_wrapper(user_id: str, *args, **kwargs):
+            with shard_router.held(user_id) as pool:
+                yield from routed_steps(pool, function(user_id, *args, **kwargs))
+
+        return generator_wrapper
+
+    @wraps(function)
+    def wrapper(user_id: str, *args, **kwargs):
+        with shard_router.tenant(user_id):
+            return function(user_id, *args, **kwargs)
+
+    return wrapper
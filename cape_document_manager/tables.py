@@ -12,31 +12,165 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from cape_document_manager.document_manager_settings import DB_CONFIG
-from scout.models import database, Index, Attachment, BlobData, Document, Metadata, IndexDocument
+import shutil
+import sqlite3
+from cape_document_manager.document_manager_settings import DB_CONFIG, VECTOR_INDEX_FOLDER, SHARD_FOLDER
+from peewee import ForeignKeyField, BlobField, AutoField, TextField, IntegerField, DateTimeField, CompositeKey, SQL
+from playhouse.sqlite_ext import VirtualModel
+from datetime import datetime
+from scout.models import Index, Attachment, BlobData, Document, Metadata, IndexDocument, BaseModel
 from scout.search import DocumentSearch
 
-from cape_document_manager.rank_similarity import rank_similarity
+from cape_document_manager.connections import database, close_all_pools
+from cape_document_manager.rank_similarity import rank_similarity, Ranking
 
-_TABLES = [Attachment, BlobData, Document, Metadata, Index, IndexDocument]
+# for the ROW_NUMBER() window function of the searches limited per document
+MIN_SQLITE_VERSION = (3, 25, 0)
+if sqlite3.sqlite_version_info < MIN_SQLITE_VERSION:
+    raise RuntimeError(f"cape_document_manager requires SQLite {'.'.join(map(str, MIN_SQLITE_VERSION))} or newer, "
+                       f"Python's sqlite3 module is linked with SQLite {sqlite3.sqlite_version}")
+
+
+class Embedding(BaseModel):
+    """Embedding of an indexed `Document`, stored once as raw float32 bytes."""
+    document = ForeignKeyField(Document, primary_key=True, backref='embeddings')
+    vector = BlobField()
+
+    class Meta:
+        table_name = 'main_embedding'
+
+
+class Sequence(BaseModel):
+    """Last value handed out by a sequence, such as the docids of `Document`,
+    so that the values of deleted rows are never handed out again."""
+    name = TextField(primary_key=True)
+    value = IntegerField()
+
+    class Meta:
+        table_name = 'main_sequence'
+
+
+class DocumentCatalog(BaseModel):
+    """One row per stored document with the fields listed by `DocumentStore.get_documents`,
+    so that listings do not have to unpickle the documents. Ids follow the order of the last upserts."""
+    id = AutoField()
+    unique_id = TextField(unique=True)
+    user_id = TextField()
+    document_id = TextField()
+    title = TextField(null=True)
+    origin = TextField(null=True)
+    text = TextField(null=True)
+    document_type = TextField(null=True)
+    created = IntegerField()
+
+    class Meta:
+        table_name = 'main_document_catalog'
+        indexes = (
+            (('user_id', 'id'), False),
+            (('user_id', 'document_id'), False),
+        )
+
+
+class ReleasedBlob(BaseModel):
+    """Hash of a `BlobData` which lost an attachment, deleted by the blob collector when no attachment is left."""
+    hash = TextField(primary_key=True)
+    released = DateTimeField(default=datetime.now)
+
+    class Meta:
+        table_name = 'main_released_blob'
+
+
+class Fingerprint(BaseModel):
+    """Fingerprint of the last version of an object upserted by a `Retriever`, to skip upserts which change nothing."""
+    retriever = TextField()
+    unique_id = TextField()
+    fingerprint = TextField()
+
+    class Meta:
+        table_name = 'main_fingerprint'
+        primary_key = CompositeKey('retriever', 'unique_id')
+
+
+class DocumentVocabulary(VirtualModel):
+    """Read-only fts4aux view of the terms indexed in `Document`, as stemmed by its tokenizer,
+    with the number of documents and occurrences of each term per column, col is '*' for all the columns."""
+    term = TextField()
+    col = TextField()
+    documents = IntegerField()
+    occurrences = IntegerField()
+
+    class Meta:
+        database = database
+        table_name = 'main_document_vocabulary'
+        extension_module = SQL(f'fts4aux({Document._meta.table_name})')
+
+
+class TermStatistic(BaseModel):
+    """Number of chunks indexed by a `Retriever` containing each stemmed term, per value of its vocabulary key
+    (e.g. user_id), the empty term counting all the chunks. Maintained by `Vocabulary` as chunks are written."""
+    retriever = TextField()
+    key_value = TextField()
+    term = TextField()
+    documents = IntegerField()
+
+    class Meta:
+        table_name = 'main_term_statistic'
+        primary_key = CompositeKey('retriever', 'key_value', 'term')
+        indexes = (
+            (('retriever', 'term'), False),
+            (('retriever', 'key_value', 'documents'), False),
+        )
+
+
+# Lets blob collection check the attachments of a hash without scanning them all
+Attachment.add_index(Attachment.hash)
+
+_TABLES = [Attachment, BlobData, Document, Metadata, Index, IndexDocument, Embedding, Sequence, DocumentCatalog,
+           ReleasedBlob, Fingerprint, DocumentVocabulary, TermStatistic]
+# The scout models are declared with the database of scout, which can not lend its connections,
+# the first connection to each database file (e.g. a shard) creates the missing tables of the bound models
+database.bind(_TABLES)
+
+
+_generation = 0
+
+
+def database_generation() -> int:
+    "Number of resets of the database by init_db, rows cached before a reset are gone"
+    return _generation
+
+
+def _configure_db():
+    """Only set the parameters of the connections, which are opened on first use,
+    the first one creating the missing tables (see PooledSqliteDatabase)"""
+    # connections of the pool are lent to one thread at a time, but not always the same one
+    database.init(DB_CONFIG['DATABASE'], pragmas=DB_CONFIG['PRAGMAS'], check_same_thread=False)
 
 
 def init_db(reset_database=False):
-    """Create and/or initialize database"""
+    """Create and/or initialize database, otherwise done lazily by the first connection.
+    Resetting the database also deletes the shards."""
+    global _generation
+    close_all_pools()
     if not database.is_closed():
         database.close()
-    database.init(DB_CONFIG['DATABASE'], pragmas=DB_CONFIG['PRAGMAS'])
+    _configure_db()
     database.connect()
     if reset_database:
         database.drop_tables(_TABLES, safe=True)
+        _generation += 1
+        shutil.rmtree(VECTOR_INDEX_FOLDER, ignore_errors=True)
+        shutil.rmtree(SHARD_FOLDER, ignore_errors=True)
     database.create_tables(_TABLES)
 
 
-init_db()
+_configure_db()
 
 
 def get_rank_expression(self, ranking):
-    if ranking == 'rank_similarity':
+    if isinstance(ranking, Ranking):
+        return ranking.expression(Document)
+    elif ranking == 'rank_similarity':
         return rank_similarity(Document)
     else:
         return self._get_rank_expression(ranking)
@@ -0,0 +1,416 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Benchmarks, not collected by pytest.
+
+Usage: CAPE_SQLITE_PATH=/tmp/benchmark.sqlite python -m cape_document_manager.test.benchmarks [benchmark_name ...]
+Every benchmark resets the configured database.
+"""
+
+import sys
+import random
+import subprocess
+from statistics import median
+from time import perf_counter
+from typing import List
+from hashlib import sha256
+from concurrent.futures import ThreadPoolExecutor
+from cape_document_manager.tables import init_db, database
+from cape_document_manager.document_store import DocumentStore, build_document_records
+from cape_document_manager.annotation_store import AnnotationStore
+from cape_document_manager.query_planner import QueryPlanner, STOPWORDS
+from cape_document_manager.vocabulary import stems
+from cape_document_manager.connections import connection_pool, routed
+from cape_document_manager.shards import shard_router
+from cape_document_manager import write_queue
+from cape_document_manager.write_queue import WriteQueue
+from cape_document_manager.blob_codecs import PickleZlibCodec, FieldsCodec
+from cape_document_manager.document_manager_core import roundrobin
+from cape_document_manager.document_manager_settings import DOCUMENT_BULK_BATCH_SIZE, WRITE_QUEUE_ENABLED
+from cape_document_manager.rank_similarity import python_rank_similarity, _compiled_rank_similarity, \
+    python_rank_bm25, _compiled_rank_bm25
+
+_LOGIN = 'benchmark@bla.com'
+
+
+def _random_texts(number_of_texts: int, words_per_text: int = 300, vocabulary_size: int = 5000,
+                  seed: int = 0) -> List[str]:
+    rng = random.Random(seed)
+    vocabulary = ['word%d' % idx for idx in range(vocabulary_size)]
+    return [' '.join(rng.choice(vocabulary) for _ in range(words_per_text)) for _ in range(number_of_texts)]
+
+
+def _zipf_texts(number_of_texts: int, words_per_text: int = 300, vocabulary_size: int = 5000,
+                seed: int = 0) -> List[str]:
+    "Texts with a Zipf distribution of words, the stopwords being the most frequent ones"
+    rng = random.Random(seed)
+    vocabulary = sorted(STOPWORDS) + ['word%d' % idx for idx in range(vocabulary_size)]
+    weights = [1.0 / rank for rank in range(1, len(vocabulary) + 1)]
+    return [' '.join(rng.choices(vocabulary, weights, k=words_per_text)) for _ in range(number_of_texts)]
+
+
+def _report(name: str, seconds: float, operations: int, unit: str):
+    print(f'{name:<40} {seconds:>9.3f}s {operations / seconds:>12.1f} {unit}/sec')
+
+
+def benchmark_bulk_ingestion(number_of_documents: int = 2000, batch_size: int = DOCUMENT_BULK_BATCH_SIZE):
+    """Documents per second of create_document in a loop versus create_documents."""
+    texts = _random_texts(number_of_documents)
+
+    init_db(reset_database=True)
+    start = perf_counter()
+    for idx, text in enumerate(texts):
+        DocumentStore.create_document(_LOGIN, 'Title of doc %d' % idx, 'benchmark', text)
+    _report('create_document', perf_counter() - start, number_of_documents, 'docs')
+
+    init_db(reset_database=True)
+    start = perf_counter()
+    DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text}
+                                            for idx, text in enumerate(texts)), batch_size=batch_size)
+    _report(f'create_documents(batch_size={batch_size})', perf_counter() - start, number_of_documents, 'docs')
+
+
+def benchmark_idempotent_resync(number_of_documents: int = 2000, batch_size: int = DOCUMENT_BULK_BATCH_SIZE):
+    """Documents per second of the first create_documents versus pushing the same documents again with replace."""
+    documents = [{'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text, 'document_id': str(idx)}
+                 for idx, text in enumerate(_random_texts(number_of_documents))]
+    init_db(reset_database=True)
+    start = perf_counter()
+    DocumentStore.create_documents(_LOGIN, documents, batch_size=batch_size)
+    _report('create_documents, first sync', perf_counter() - start, number_of_documents, 'docs')
+    start = perf_counter()
+    results = DocumentStore.create_documents(_LOGIN, documents, replace=True, batch_size=batch_size)
+    _report('create_documents, unchanged re-sync', perf_counter() - start, number_of_documents, 'docs')
+    assert all(result['status'] == 'unchanged' for result in results)
+    for document in documents[::10]:
+        document['text'] += ' changed'
+    start = perf_counter()
+    DocumentStore.create_documents(_LOGIN, documents, replace=True, batch_size=batch_size)
+    _report('create_documents, 10% changed re-sync', perf_counter() - start, number_of_documents, 'docs')
+
+
+def _cpu_bound_embedding(text: str) -> int:
+    "Stands in for a real embedding model, module level so that worker processes can unpickle it"
+    digest = text.encode('utf-8')
+    for _ in range(20000):
+        digest = sha256(digest).digest()
+    return digest[0]
+
+
+def benchmark_parallel_ingestion(number_of_documents: int = 500, workers: int = 4):
+    """Documents per second of create_documents with an expensive embedding function, serial versus workers."""
+    texts = _random_texts(number_of_documents)
+    for number_of_workers in (None, workers):
+        init_db(reset_database=True)
+        start = perf_counter()
+        DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text}
+                                                for idx, text in enumerate(texts)),
+                                       get_embedding=_cpu_bound_embedding, workers=number_of_workers)
+        _report(f'create_documents(workers={number_of_workers})', perf_counter() - start, number_of_documents, 'docs')
+
+
+def benchmark_multi_document_search(number_of_documents: int = 300, limit_per_doc: int = 3, repeats: int = 5):
+    """Latency of search_chunks restricted to n document_ids, one query per document versus a single query."""
+    init_db(reset_database=True)
+    results = DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark',
+                                                       'text': text}
+                                                      for idx, text in enumerate(_random_texts(number_of_documents))))
+    all_document_ids = [result['documentId'] for result in results]
+    query = ' '.join(_random_texts(1, words_per_text=3, seed=1))
+    for number_of_document_ids in (1, 10, 100, number_of_documents):
+        document_ids = all_document_ids[:number_of_document_ids]
+        start = perf_counter()
+        for _ in range(repeats):
+            list(roundrobin(*(DocumentStore._retriever.retrieve(query, limit=limit_per_doc, user_id=_LOGIN,
+                                                                document_id=document_id)
+                              for document_id in document_ids)))
+        _report(f'one query per document (n={number_of_document_ids})', perf_counter() - start, repeats, 'searches')
+        start = perf_counter()
+        for _ in range(repeats):
+            list(DocumentStore.search_chunks(_LOGIN, query, document_ids=document_ids, limit_per_doc=limit_per_doc))
+        _report(f'single query (n={number_of_document_ids})', perf_counter() - start, repeats, 'searches')
+
+
+def benchmark_blob_codecs(number_of_documents: int = 200, words_per_text: int = 5000):
+    """Encode and decode throughput and size of the document blobs, original pickle+zlib-9 format versus fields."""
+    records = build_document_records([dict(user_id=_LOGIN, document_id=str(idx), title='Title of doc %d' % idx,
+                                           origin='benchmark', text=text, document_type='text')
+                                      for idx, text in enumerate(_random_texts(number_of_documents, words_per_text))])
+    for codec in (PickleZlibCodec(), FieldsCodec()):
+        name = type(codec).__name__
+        start = perf_counter()
+        values = [codec.encode(record, record.transient_fields()) for record in records]
+        _report(f'{name} encode', perf_counter() - start, number_of_documents, 'docs')
+        start = perf_counter()
+        for value in values:
+            codec.decode(value)
+        _report(f'{name} decode', perf_counter() - start, number_of_documents, 'docs')
+        start = perf_counter()
+        for value in values:
+            codec.decode_fields(value, ['title', 'created'])
+        _report(f'{name} decode title and created', perf_counter() - start, number_of_documents, 'docs')
+        print(f'{name} size: {sum(map(len, values)) / number_of_documents / 1024:.1f} KiB/doc')
+
+
+def benchmark_rank_similarity(number_of_rows: int = 100000, number_of_documents: int = 2000, repeats: int = 5):
+    """Ranking cost per matched row of the compiled and pure Python rank_similarity,
+    called directly on matchinfo blobs and inside a full text search matching every chunk."""
+    from cape_document_manager.test.test_rank_similarity import random_match_info
+
+    rng = random.Random(0)
+    match_infos = [random_match_info(rng, rng.randint(1, 5), 2) for _ in range(number_of_rows)]
+    implementations = [('python', python_rank_similarity)]
+    if _compiled_rank_similarity is not None:
+        implementations.insert(0, ('cython', _compiled_rank_similarity))
+    calls = [('rank_similarity', name, function) for name, function in implementations] + \
+            [('bm25', 'cython', _compiled_rank_bm25), ('bm25', 'python', python_rank_bm25)]
+    for function_name, name, function in calls:
+        if function is None:
+            continue
+        start = perf_counter()
+        for match_info in match_infos:
+            function(match_info, 1.0, 0.0)
+        _report(f'{name} {function_name} call', perf_counter() - start, number_of_rows, 'rows')
+
+    init_db(reset_database=True)
+    DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text}
+                                            for idx, text in enumerate(_random_texts(number_of_documents,
+                                                                                     vocabulary_size=50))))
+    query = ' '.join(_random_texts(1, words_per_text=3, vocabulary_size=50, seed=1))
+    number_of_matches = sum(1 for _ in DocumentStore._retriever.retrieve(query, limit=None, user_id=_LOGIN))
+    try:
+        for name, function in implementations:
+            database.register_function(function, 'rank_similarity')
+            start = perf_counter()
+            for _ in range(repeats):
+                list(DocumentStore.search_chunks(_LOGIN, query, limit_per_doc=1))
+            _report(f'{name} search ({number_of_matches} matches)', perf_counter() - start,
+                    repeats * number_of_matches, 'rows')
+    finally:
+        database.register_function(_compiled_rank_similarity or python_rank_similarity, 'rank_similarity')
+
+
+def benchmark_similar_annotations(number_of_annotations: int = 2000, limit: int = 5, repeats: int = 5):
+    """Latency of a similar_annotations query matching most annotations: loading every matching row
+    and deduplicating in Python, versus the top annotations only, deduplicated by the query."""
+    init_db(reset_database=True)
+    questions = _random_texts(number_of_annotations, words_per_text=8, vocabulary_size=20)
+    for idx, question in enumerate(questions):
+        annotation = AnnotationStore.create_annotation(_LOGIN, question, 'Answer %d' % idx)
+        AnnotationStore.add_paraphrase_question(_LOGIN, annotation['annotationId'], question[::-1])
+    query = ' '.join(_random_texts(1, words_per_text=3, vocabulary_size=20, seed=1))
+    start = perf_counter()
+    for _ in range(repeats):
+        AnnotationStore._retriever.cache.clear()
+        seen = set()
+        for search_result in AnnotationStore._retriever.retrieve(query, user_id=_LOGIN):
+            seen.add(search_result.get_retrievable().unique_id)
+    _report(f'every match ({len(seen)} annotations)', perf_counter() - start, repeats, 'searches')
+    for top_k in (limit, None):
+        start = perf_counter()
+        for _ in range(repeats):
+            AnnotationStore._retriever.cache.clear()
+            AnnotationStore.similar_annotations(_LOGIN, query, limit=top_k)
+        _report(f'similar_annotations(limit={top_k})', perf_counter() - start, repeats, 'searches')
+
+
+def benchmark_long_queries(number_of_documents: int = 2000, number_of_queries: int = 20, words_per_query: int = 200):
+    """Latency of searches with long pasted questions, every word ORed versus the default QueryPlanner."""
+    init_db(reset_database=True)
+    DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text}
+                                            for idx, text in enumerate(_zipf_texts(number_of_documents))))
+    queries = _zipf_texts(number_of_queries, words_per_text=words_per_query, seed=1)
+    default_planner = DocumentStore._retriever.query_planner
+    try:
+        for name, planner in (('every word', QueryPlanner(max_terms=0)), ('default planner', default_planner)):
+            DocumentStore._retriever.query_planner = planner
+            start = perf_counter()
+            for query in queries:
+                planner.compile(query)
+            _report(f'{name} compile', perf_counter() - start, number_of_queries, 'queries')
+            start = perf_counter()
+            for query in queries:
+                list(DocumentStore.search_chunks(_LOGIN, query, limit_per_doc=10))
+            _report(f'{name} search', perf_counter() - start, number_of_queries, 'searches')
+    finally:
+        DocumentStore._retriever.query_planner = default_planner
+
+
+def benchmark_term_statistics(number_of_documents: int = 2000, number_of_lookups: int = 200,
+                              terms_per_lookup: int = 50):
+    """Document frequency lookups from the FTS index vocabulary (fts4aux) versus the cached retriever Vocabulary."""
+    init_db(reset_database=True)
+    start = perf_counter()
+    DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text}
+                                            for idx, text in enumerate(_zipf_texts(number_of_documents))))
+    _report('ingestion with term statistics', perf_counter() - start, number_of_documents, 'documents')
+    vocabulary = DocumentStore._retriever.vocabulary
+    lookups = [stems(text.lower().split()) for text in _zipf_texts(number_of_lookups, terms_per_lookup, seed=1)]
+    start = perf_counter()
+    for terms in lookups:
+        QueryPlanner.document_counts(terms)
+    _report('fts4aux lookups', perf_counter() - start, number_of_lookups, 'lookups')
+    vocabulary.clear_cache()
+    start = perf_counter()
+    for terms in lookups:
+        vocabulary.document_frequencies(terms)
+    _report('vocabulary lookups, cold cache', perf_counter() - start, number_of_lookups, 'lookups')
+    start = perf_counter()
+    for terms in lookups:
+        vocabulary.document_frequencies(terms)
+    _report('vocabulary lookups, warm cache', perf_counter() - start, number_of_lookups, 'lookups')
+    start = perf_counter()
+    for _ in range(number_of_lookups):
+        vocabulary.top_terms(20, key_value=_LOGIN)
+    _report('top terms of the user', perf_counter() - start, number_of_lookups, 'queries')
+
+
+def benchmark_concurrent_reads(number_of_documents: int = 2000, number_of_requests: int = 400,
+                               words_per_query: int = 5):
+    """Search throughput of a threaded server: a connection opened per request, a connection kept by each thread,
+    or the pooled read connections."""
+    init_db(reset_database=True)
+    DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text}
+                                            for idx, text in enumerate(_zipf_texts(number_of_documents))))
+    queries = _zipf_texts(number_of_requests, words_per_text=words_per_query, seed=1)
+
+    def connection_per_request(query: str):
+        database.connect()
+        try:
+            list(DocumentStore.search_chunks(_LOGIN, query, limit_per_doc=10))
+        finally:
+            database.close()
+
+    def thread_connection(query: str):
+        list(DocumentStore.search_chunks(_LOGIN, query, limit_per_doc=10))
+
+    def pooled_reader(query: str):
+        with connection_pool.reader():
+            list(DocumentStore.search_chunks(_LOGIN, query, limit_per_doc=10))
+
+    for number_of_threads in (1, 4, 8):
+        for name, handle_request in (('connection per request', connection_per_request),
+                                     ('connection per thread', thread_connection),
+                                     ('pooled reader', pooled_reader)):
+            with ThreadPoolExecutor(number_of_threads) as executor:
+                start = perf_counter()
+                list(executor.map(handle_request, queries))
+                _report(f'{name} ({number_of_threads} threads)', perf_counter() - start, number_of_requests,
+                        'searches')
+
+
+def benchmark_concurrent_writes(number_of_annotations: int = 400, number_of_threads: int = 16):
+    """Throughput of concurrent annotation edits, each in its own transaction versus grouped by the write queue."""
+    for name, max_delay in (('transaction per edit', None), ('write queue', 0.0), ('write queue, 2ms delay', 0.002)):
+        init_db(reset_database=True)
+        annotation_ids = [AnnotationStore.create_annotation(_LOGIN, f'Question {idx}', 'Answer')['annotationId']
+                          for idx in range(number_of_annotations)]
+        queue = None
+        if max_delay is not None:
+            queue = WriteQueue(max_delay=max_delay)
+            queue.start()
+            WriteQueue._started = queue
+        write_queue.WRITE_QUEUE_ENABLED = queue is not None
+        try:
+            with ThreadPoolExecutor(number_of_threads) as executor:
+                start = perf_counter()
+                list(executor.map(lambda annotation_id: AnnotationStore.add_answer(_LOGIN, annotation_id, 'Another'),
+                                  annotation_ids))
+                _report(name, perf_counter() - start, number_of_annotations, 'edits')
+        finally:
+            write_queue.WRITE_QUEUE_ENABLED = WRITE_QUEUE_ENABLED
+            if queue is not None:
+                queue.stop()
+                queue.join()
+                print(f'{"":40}{queue.mutations / queue.transactions:>10.1f} edits/transaction')
+
+
+def benchmark_sharding(number_of_documents: int = 4000, number_of_small_tenants: int = 20,
+                       documents_per_small_tenant: int = 20, number_of_queries: int = 50):
+    """Search latency of small tenants next to a big one, in the main database versus in a shard per tenant,
+    and throughput of moving the documents of the main database to their shards."""
+    init_db(reset_database=True)
+    DocumentStore.create_documents(_LOGIN, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark', 'text': text}
+                                            for idx, text in enumerate(_zipf_texts(number_of_documents))))
+    small_tenants = ['tenant%d@bla.com' % idx for idx in range(number_of_small_tenants)]
+    for tenant_number, user_id in enumerate(small_tenants):
+        DocumentStore.create_documents(user_id, ({'title': 'Title of doc %d' % idx, 'origin': 'benchmark',
+                                                  'text': text}
+                                                 for idx, text in enumerate(_zipf_texts(documents_per_small_tenant,
+                                                                                        seed=tenant_number + 1))))
+    queries = [' '.join(query.split()[:5]) for query in _zipf_texts(number_of_queries, seed=-1)]
+
+    def search(name: str):
+        for user_ids, tenants in ((small_tenants, 'small tenants'), ([_LOGIN], 'big tenant')):
+            start = perf_counter()
+            for query_number, query in enumerate(queries):
+                list(DocumentStore.search_chunks(user_ids[query_number % len(user_ids)], query, limit_per_doc=10))
+            _report(f'{name}, {tenants}', perf_counter() - start, number_of_queries, 'searches')
+
+    search('main database')
+    shard_router.mode = 'tenant'
+    try:
+        start = perf_counter()
+        with routed(connection_pool):
+            DocumentStore.move_to_shards()
+        _report('move to shards', perf_counter() - start,
+                number_of_documents + number_of_small_tenants * documents_per_small_tenant, 'docs')
+        search('shard per tenant')
+    finally:
+        shard_router.mode = 'none'
+        shard_router.close_all()
+
+
+_IMPORT_SCRIPT = """
+from time import perf_counter
+start = perf_counter()
+from cape_document_manager.document_store import DocumentStore
+from cape_document_manager.annotation_store import AnnotationStore
+imported = perf_counter()
+DocumentStore.warm_up()
+AnnotationStore.warm_up()
+print(imported - start, perf_counter() - imported)
+"""
+
+
+def benchmark_import_time(repeats: int = 10):
+    """Time to import the stores in a fresh interpreter, then to warm them up, as for a worker fork or a CLI tool."""
+    init_db(reset_database=True)
+    timings = [tuple(map(float, subprocess.run([sys.executable, '-c', _IMPORT_SCRIPT], check=True,
+                                               stdout=subprocess.PIPE, universal_newlines=True).stdout.split()))
+               for _ in range(repeats)]
+    print(f'{"import (median)":<40} {median(imported for imported, _ in timings) * 1000:>9.1f}ms')
+    print(f'{"warm_up (median)":<40} {median(warm_up for _, warm_up in timings) * 1000:>9.1f}ms')
+
+
+BENCHMARKS = {
+    'bulk_ingestion': benchmark_bulk_ingestion,
+    'parallel_ingestion': benchmark_parallel_ingestion,
+    'idempotent_resync': benchmark_idempotent_resync,
+    'multi_document_search': benchmark_multi_document_search,
+    'blob_codecs': benchmark_blob_codecs,
+    'rank_similarity': benchmark_rank_similarity,
+    'similar_annotations': benchmark_similar_annotations,
+    'long_queries': benchmark_long_queries,
+    'term_statistics': benchmark_term_statistics,
+    'concurrent_reads': benchmark_concurrent_reads,
+    'concurrent_writes': benchmark_concurrent_writes,
+    'import_time': benchmark_import_time,
+    'sharding': benchmark_sharding,
+}
+
+if __name__ == '__main__':
+    for benchmark_name in sys.argv[1:] or BENCHMARKS:
+        print(f'--- {benchmark_name}')
+        BENCHMARKS[benchmark_name]()
@@ -14,8 +14,12 @@
 
 import pytest
 from cape_api_helpers.exceptions import UserException
-from cape_document_manager.tables import init_db
-from cape_document_manager.annotation_store import AnnotationStore
+from time import sleep
+from cape_document_manager.tables import init_db, BlobData, ReleasedBlob
+from cape_document_manager import document_manager_core
+from cape_document_manager.document_manager_core import sweep_released_blobs, BlobCollector
+from cape_document_manager.annotation_store import AnnotationStore, CANONICAL_BOOST_RANKING
+from cape_document_manager.rank_similarity import Ranking
 from pprint import pprint
 from collections import OrderedDict
 
@@ -172,6 +176,145 @@ def test_saved_reply():
     assert annotations[0]["sourceType"] != annotations[1]["sourceType"]
 
 
+
+def test_ranking():
+    init_db(reset_database=True)
+    annotation = AnnotationStore.create_annotation('user', 'How tall is the Eiffel tower in Paris?', '324 metres')
+    AnnotationStore.add_paraphrase_question('user', annotation['annotationId'], 'Eiffel tower height')
+    AnnotationStore.create_annotation('user', 'Where is the Eiffel tower?', 'Paris')
+    default_results = AnnotationStore.similar_annotations('user', 'tall tower height')
+    assert default_results[0]['matchedQuestion'] == 'How tall is the Eiffel tower in Paris?'
+    boosted_results = AnnotationStore.similar_annotations('user', 'tall tower height', ranking=CANONICAL_BOOST_RANKING)
+    assert [result['sourceId'] for result in boosted_results] == [result['sourceId'] for result in default_results]
+    assert boosted_results[0]['confidence'] > default_results[0]['confidence']
+
+    bm25_results = AnnotationStore.similar_annotations('user', 'tall tower height', ranking=Ranking('bm25'))
+    assert bm25_results[0]['matchedQuestion'] == 'Eiffel tower height'
+    # a single query ranks the canonical question above its better matching paraphrase
+    bm25_boosted_results = AnnotationStore.similar_annotations(
+        'user', 'tall tower height', ranking=Ranking('bm25', boosts=(('canonical', True, 5.0),)))
+    assert bm25_boosted_results[0]['matchedQuestion'] == 'How tall is the Eiffel tower in Paris?'
+    assert bm25_boosted_results[0]['sourceId'] == annotation['annotationId']
+    assert all(0.0 <= result['confidence'] < 1.0 for result in bm25_boosted_results)
+
+
+def test_similar_annotations_limit():
+    init_db(reset_database=True)
+    annotation_ids = []
+    for idx in range(20):
+        annotation = AnnotationStore.create_annotation('user', f'What is the capital of country {idx}?',
+                                                       f'City {idx}', document_id=f'doc{idx % 3}')
+        AnnotationStore.add_paraphrase_question('user', annotation['annotationId'], f'Capital of country {idx}?')
+        annotation_ids.append(annotation['annotationId'])
+    for document_ids in ((), ('doc0', 'doc1', 'doc2')):
+        all_results = AnnotationStore.similar_annotations('user', 'capital of the country', document_ids=document_ids)
+        assert sorted(result['sourceId'] for result in all_results) == sorted(annotation_ids)  # one per annotation
+        stats = AnnotationStore._retriever.cache.stats
+        top_results = AnnotationStore.similar_annotations('user', 'capital of the country', document_ids=document_ids,
+                                                          limit=3)
+        loads = AnnotationStore._retriever.cache.stats
+        assert loads['hits'] + loads['misses'] - stats['hits'] - stats['misses'] == 3
+        assert [(result['sourceId'], result['matchedQuestion'], result['confidence']) for result in top_results] == \
+               [(result['sourceId'], result['matchedQuestion'], result['confidence']) for result in all_results[:3]]
+    grouped_results = AnnotationStore.similar_annotations('user', 'capital of the country',
+                                                          document_ids=['doc1', 'doc0'])
+    assert [result['sourceId'] in annotation_ids[1::3] for result in grouped_results[:4]] == [True, False, True, False]
+
+
+def test_annotation_pagination():
+    init_db(reset_database=True)
+    for idx in range(7):
+        AnnotationStore.create_annotation(LOGIN, 'What is question %d?' % idx, 'Answer %d' % idx,
+                                          document_id=None if idx % 3 == 0 else 'doc%d' % (idx % 2), page=idx)
+    for filters in ({}, {'search_term': 'question'}, {'document_ids': ['doc0', 'doc1']}, {'saved_replies': True},
+                    {'pages': [1, 2, 5]}):
+        annotations = AnnotationStore.get_annotations(LOGIN, **filters)
+        assert list(AnnotationStore.iter_annotations(LOGIN, **filters)) == annotations
+        paginated_annotations = []
+        page = AnnotationStore.get_annotations_page(LOGIN, page_size=2, **filters)
+        paginated_annotations.extend(page['items'])
+        while page['nextCursor'] is not None:
+            page = AnnotationStore.get_annotations_page(LOGIN, page_size=2, cursor=page['nextCursor'], **filters)
+            paginated_annotations.extend(page['items'])
+        assert paginated_annotations == annotations
+    assert len(AnnotationStore.get_annotations(LOGIN)) == 7
+    assert len(AnnotationStore.get_annotations(LOGIN, document_ids=['doc0', 'doc1'])) == 4
+    assert len(AnnotationStore.get_annotations(LOGIN, saved_replies=True)) == 3
+    assert [annotation['page'] for annotation in AnnotationStore.get_annotations(LOGIN, pages=[1, 2, 5])] == [1, 2, 5]
+
+
+def test_incremental_reindexing():
+    init_db(reset_database=True)
+    annotation_id = AnnotationStore.create_annotation(LOGIN, 'What is the question?', 'The answer')['annotationId']
+    for idx in range(5):
+        AnnotationStore.add_paraphrase_question(LOGIN, annotation_id, 'Paraphrase %d?' % idx)
+    stored_rows = AnnotationStore._retriever._stored_rows([annotation_id])[annotation_id]
+
+    question_id = AnnotationStore.add_paraphrase_question(LOGIN, annotation_id, 'Another paraphrase?')['questionId']
+    new_stored_rows = AnnotationStore._retriever._stored_rows([annotation_id])[annotation_id]
+    assert len(new_stored_rows) == len(stored_rows) + 1
+    assert all(new_stored_rows[docid][:4] == stored_row[:4] for docid, stored_row in stored_rows.items())
+    assert BlobData.select().count() == 1  # the previous version of the annotation is released
+
+    AnnotationStore.edit_paraphrase_question(LOGIN, question_id, 'Edited paraphrase?')
+    edited_stored_rows = AnnotationStore._retriever._stored_rows([annotation_id])[annotation_id]
+    assert edited_stored_rows.keys() == new_stored_rows.keys()
+    assert [row[1] for row in edited_stored_rows.values()].count('Edited paraphrase?') == 1
+    assert len(AnnotationStore.get_annotations(LOGIN, search_term='edited')) == 1
+    assert len(AnnotationStore.get_annotations(LOGIN, search_term='another')) == 0
+
+    AnnotationStore.delete_paraphrase_question(LOGIN, question_id)
+    assert AnnotationStore._retriever._stored_rows([annotation_id])[annotation_id].keys() == stored_rows.keys()
+    assert AnnotationStore.get_annotations(LOGIN)[0]['paraphraseQuestions'][-1]['question'] == 'Paraphrase 4?'
+
+
+def test_blob_collection(monkeypatch):
+    init_db(reset_database=True)
+    annotation_id = AnnotationStore.create_annotation(LOGIN, 'What is collected?', 'Blobs')['annotationId']
+    AnnotationStore.add_answer(LOGIN, annotation_id, 'Released blobs')
+    assert BlobData.select().count() == 1
+
+    monkeypatch.setattr(document_manager_core, 'BLOB_COLLECTION_MODE', 'deferred')
+    AnnotationStore.add_answer(LOGIN, annotation_id, 'Orphan blobs')
+    assert BlobData.select().count() == 2
+    assert ReleasedBlob.select().count() == 1
+    assert sweep_released_blobs() == 1
+    assert BlobData.select().count() == 1
+    assert ReleasedBlob.select().count() == 0
+
+    AnnotationStore.delete_annotation(LOGIN, annotation_id)
+    collector = BlobCollector(interval=0.01)
+    collector.start()
+    try:
+        for _ in range(100):
+            if BlobData.select().count() == 0:
+                break
+            sleep(0.01)
+    finally:
+        collector.stop()
+        collector.join()
+    assert BlobData.select().count() == 0
+
+
+def test_failed_edit(monkeypatch):
+    init_db(reset_database=True)
+    annotation_id = AnnotationStore.create_annotation(LOGIN, 'What is cached?', 'Annotations')['annotationId']
+    AnnotationStore.get_annotations(LOGIN)
+
+    def failing_upsert(annotation):
+        raise RuntimeError('Write failed')
+
+    monkeypatch.setattr(AnnotationStore._retriever, 'upsert_document', failing_upsert)
+    with pytest.raises(RuntimeError):
+        AnnotationStore.edit_canonical_question(LOGIN, annotation_id, 'What is corrupted?')
+    with pytest.raises(RuntimeError):
+        AnnotationStore.add_answer(LOGIN, annotation_id, 'Corrupted')
+    monkeypatch.undo()
+    annotation, = AnnotationStore.get_annotations(LOGIN)
+    assert annotation['canonicalQuestion'] == 'What is cached?'
+    assert [answer['answer'] for answer in annotation['answers']] == ['Annotations']
+
+
 if __name__ == '__main__':
     print("Launching single test")
     test_saved_reply()
@@ -0,0 +1,85 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import threading
+from peewee import OperationalError
+from cape_document_manager.tables import database
+from cape_document_manager.async_stores import AsyncDocumentStore, AsyncAnnotationStore, _run, _stream
+from cape_document_manager.document_store import DocumentStore
+from cape_document_manager.annotation_store import AnnotationStore
+from cape_document_manager.test.test_document_store import reset_db, _LOGIN, _DOCUMENT_TEXTS
+
+_ENDLESS_QUERY = 'WITH RECURSIVE numbers(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM numbers) ' \
+                 'SELECT COUNT(*) FROM numbers'
+
+
+def _run_until_complete(coroutine):
+    "asyncio.run() of Python 3.7"
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_stores(reset_db):
+    async def main():
+        await AsyncDocumentStore.create_documents(_LOGIN, ({'title': 'doc %d' % idx, 'origin': 'test', 'text': text}
+                                                            for idx, text in enumerate(_DOCUMENT_TEXTS)))
+        created = await AsyncAnnotationStore.create_annotation(_LOGIN, 'Who are the Normans?', 'Vikings')
+        assert await AsyncDocumentStore.get_documents(_LOGIN) == DocumentStore.get_documents(_LOGIN)
+        assert [document async for document in AsyncDocumentStore.iter_documents(_LOGIN)] == \
+               DocumentStore.get_documents(_LOGIN)
+        search_results = [result async for result in AsyncDocumentStore.search_chunks(_LOGIN, 'Normans')]
+        assert [result.matched_content for result in search_results] == \
+               [result.matched_content for result in DocumentStore.search_chunks(_LOGIN, 'Normans')]
+        document = await AsyncDocumentStore.get_retrievable(search_results[0])
+        assert document.title == 'doc 0'
+        similar = await AsyncAnnotationStore.similar_annotations(_LOGIN, 'Normans')
+        assert similar[0]['sourceId'] == created['annotationId']
+        assert [annotation['id'] async for annotation in AsyncAnnotationStore.iter_annotations(_LOGIN)] == \
+               [annotation['id'] for annotation in AnnotationStore.get_annotations(_LOGIN)]
+
+    _run_until_complete(main())
+
+
+def test_cancellation(reset_db):
+    interrupted = threading.Event()
+
+    def endless_query():
+        try:
+            database.execute_sql(_ENDLESS_QUERY).fetchone()
+        except OperationalError:
+            interrupted.set()
+            raise
+
+    def endless_stream():
+        yield 'first'
+        endless_query()
+
+    async def main():
+        query = asyncio.ensure_future(_run(endless_query))
+        await asyncio.sleep(0.2)  # the event loop keeps running while the query does
+        assert not query.done()
+        query.cancel()
+        assert await asyncio.get_event_loop().run_in_executor(None, interrupted.wait, 5)
+        interrupted.clear()
+        stream = _stream(endless_stream)
+        assert await stream.__anext__() == 'first'
+        await asyncio.sleep(0.1)
+        await stream.aclose()
+        assert await asyncio.get_event_loop().run_in_executor(None, interrupted.wait, 5)
+
+    _run_until_complete(main())
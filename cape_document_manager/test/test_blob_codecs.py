@@ -0,0 +1,54 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import zlib
+import pytest
+from cape_document_manager.blob_codecs import PickleZlibCodec, FieldsCodec, codec_of
+from cape_document_manager.document_manager_core import Retrievable
+from cape_document_manager.document_store import DocumentRecord
+from cape_document_manager.annotation_store import Annotation
+from cape_document_manager.test.test_document_store import _DOCUMENT_TEXTS
+
+
+def _embed(text: str):
+    return [float(len(text))]
+
+
+def test_fields_codec():
+    document = DocumentRecord(user_id='bla@bla.com', document_id='doc', title='Title', origin='test',
+                              text=' '.join(_DOCUMENT_TEXTS), document_type='text', get_embedding=_embed)
+    value = document.dumps()
+    assert isinstance(codec_of(value), FieldsCodec)
+    loaded = Retrievable.loads(value)
+    assert isinstance(loaded, DocumentRecord)
+    assert loaded.unique_id == document.unique_id
+    assert loaded.created == document.created
+    assert [chunk.content for chunk in loaded.chunks.values()] == [chunk.content for chunk in document.chunks.values()]
+    assert all(chunk.embedding is None for chunk in loaded.chunks.values())  # stored as float32 vectors instead
+    assert loaded.get_embedding is len  # transient, back to its default
+    assert Retrievable.loads_fields(value, ['title', 'document_id']) == {'title': 'Title', 'document_id': 'doc'}
+    _, size = Retrievable.loads_sized(value)
+    assert size > len(value)  # the uncompressed sections, the text compresses well
+
+
+def test_legacy_blobs():
+    annotation = Annotation(user_id='bla@bla.com', metadata={'custom': 'testing'}, answers={}, questions={})
+    legacy_value = PickleZlibCodec().encode(annotation)
+    assert isinstance(codec_of(legacy_value), PickleZlibCodec)
+    assert Retrievable.loads(legacy_value) == annotation
+    assert Retrievable.loads_sized(legacy_value) == (annotation, len(zlib.decompress(legacy_value)))
+    assert Retrievable.loads_fields(legacy_value, ['metadata']) == {'metadata': {'custom': 'testing'}}
+    assert Retrievable.loads(annotation.dumps()) == annotation
+    with pytest.raises(ValueError):
+        codec_of(b'\x00CDM\xff')
@@ -0,0 +1,76 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from playhouse.pool import MaxConnectionsExceeded
+from cape_document_manager.tables import database
+from cape_document_manager.connections import ConnectionPool, connection_pool, write_transaction
+from cape_document_manager.annotation_store import AnnotationStore
+from cape_document_manager.test.test_document_store import reset_db
+
+_LOGIN = 'bla@bla.com'
+
+
+def test_readers(reset_db):
+    AnnotationStore.create_annotation(_LOGIN, 'Who are the Normans?', 'Vikings')
+    own_connection = database.connection()
+    opened = connection_pool.stats['opened']
+    for _ in range(3):
+        with connection_pool.reader() as connection:
+            assert database.connection() is connection is not own_connection
+            with connection_pool.reader() as nested_connection:
+                assert nested_connection is connection
+            # pragmas and functions of the database are set on pooled connections
+            assert database.execute_sql('PRAGMA journal_mode').fetchone()[0] == 'wal'
+            assert AnnotationStore.similar_annotations(_LOGIN, 'Normans')[0]['answerText'] == 'Vikings'
+        assert database.connection() is own_connection
+    assert connection_pool.stats['opened'] == opened + 1
+
+    pool = ConnectionPool(database, max_readers=1, timeout=0.01)
+    with pool.reader():
+        with pytest.raises(MaxConnectionsExceeded):
+            with ThreadPoolExecutor(1) as executor:
+                executor.submit(lambda: pool.reader().__enter__()).result()
+    pool.close_all()
+
+
+def test_writer(reset_db):
+    with write_transaction():
+        writer_connection = database.connection()
+        # the write lock of the database is taken as the transaction begins, before its first write
+        with pytest.raises(sqlite3.OperationalError):
+            sqlite3.connect(database.database, timeout=0, isolation_level=None).execute('BEGIN IMMEDIATE')
+        AnnotationStore.create_annotation(_LOGIN, 'Who are the Normans?', 'Vikings')
+        # the writer sees its uncommitted writes, the readers of the other threads do not
+        assert len(AnnotationStore.get_annotations(_LOGIN)) == 1
+        with connection_pool.reader() as connection:
+            assert connection is writer_connection
+        with ThreadPoolExecutor(1) as executor:
+            assert executor.submit(lambda: len(AnnotationStore.get_annotations(_LOGIN))).result() == 0
+    assert len(AnnotationStore.get_annotations(_LOGIN)) == 1
+
+    # the writes of concurrent threads queue on the writer connection instead of failing on a locked database
+    barrier = threading.Barrier(8)
+
+    def create_annotations(thread_number: int):
+        barrier.wait()
+        for annotation_number in range(5):
+            AnnotationStore.create_annotation(_LOGIN, f'Question {thread_number} {annotation_number}', 'Answer')
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(create_annotations, range(8)))
+    assert len(AnnotationStore.get_annotations(_LOGIN)) == 41
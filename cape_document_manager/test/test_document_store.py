@@ -12,10 +12,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import sys
+import subprocess
 import pytest
 from cape_api_helpers.exceptions import UserException
-from cape_document_manager.tables import init_db
+from cape_document_manager.tables import init_db, DocumentCatalog
 from cape_document_manager.document_store import DocumentStore, DocumentRecord, DocumentChunk
+from cape_document_manager.document_manager_core import SearchResult, roundrobin
+from cape_document_manager.connections import write_transaction, after_commit
 from pprint import pprint
 
 _DOCUMENT_TEXTS = [
@@ -147,6 +152,47 @@ def test_simple_search(reset_db):
     assert DocumentStore.get_documents(_LOGIN, search_term='one')[0]['text'] == _DOCUMENT_TEXTS[3]
 
 
+def test_document_listing(reset_db):
+    document_ids = [DocumentStore.create_document(_LOGIN, 'Title of doc %d' % idx, 'test', doc_text)['documentId']
+                    for idx, doc_text in enumerate(_DOCUMENT_TEXTS)]
+    documents = DocumentStore.get_documents(_LOGIN)
+    assert [document['id'] for document in documents] == document_ids
+    assert [document['text'] for document in documents] == _DOCUMENT_TEXTS
+    assert DocumentStore.get_documents(_LOGIN, document_ids=document_ids[::-1]) == documents[::-1]
+    assert DocumentStore.get_documents(_LOGIN, limit=3, offset=2) == documents[2:5]
+    assert DocumentStore.get_documents(_LOGIN, include_text=False, offset=8) == [
+        {key: value for key, value in documents[8].items() if key != 'text'}]
+    assert DocumentStore.get_documents('someone else') == []
+
+    # documents stored before the catalog existed are added to it
+    DocumentCatalog.delete().execute()
+    DocumentStore._catalog_backfilled = False
+    assert DocumentStore.get_documents(_LOGIN) == documents
+    assert DocumentStore.backfill_catalog() == 0
+
+
+def test_document_pagination(reset_db):
+    for idx, doc_text in enumerate(_DOCUMENT_TEXTS):
+        DocumentStore.create_document(_LOGIN, 'Title of doc %d' % idx, 'test', doc_text)
+    for search_term in (None, 'one of the two'):
+        documents = DocumentStore.get_documents(_LOGIN, search_term=search_term)
+        assert list(DocumentStore.iter_documents(_LOGIN, search_term=search_term)) == documents
+        paginated_documents = []
+        cursor = None
+        while True:
+            page = DocumentStore.get_documents_page(_LOGIN, search_term=search_term, page_size=2, cursor=cursor)
+            assert len(page['items']) <= 2
+            paginated_documents.extend(page['items'])
+            cursor = page['nextCursor']
+            if cursor is None:
+                break
+            assert list(DocumentStore.iter_documents(_LOGIN, search_term=search_term, cursor=cursor)) == \
+                   documents[len(paginated_documents):]
+        assert paginated_documents == documents
+    with pytest.raises(ValueError):
+        DocumentStore.get_documents_page(_LOGIN, cursor='not a cursor')
+
+
 def test_chunk_search(reset_db):
     get_embeddings_function = len  # in prod this would be the embedding generation function
 
@@ -167,7 +213,6 @@ def test_chunk_search(reset_db):
     # Reader workers can make an extra SQL query to retrieve the fields of DocumentChunk as strings
     # {'chunk_idx': '0',
     # 'document_id': 'dd5c8526091ce0e937a062da23833808b4e54d9ce41cdc101173265b6a718bbd',
-    # 'embedding': '742',
     # 'number_of_words': '113',
     # 'overlap_after': '',  #empty because there is no text after this chunk
     # 'overlap_before': '', #empty because there is no text before this chunk
@@ -176,7 +221,13 @@ def test_chunk_search(reset_db):
     #              "'dd5c8526091ce0e937a062da23833808b4e54d9ce41cdc101173265b6a718bbd')",
     # 'user_id': 'bla@bla.com'}
     fields = matched_results[0].get_indexable_string_fields()
-    assert fields['embedding'] == str(len(matched_results[0].matched_content))  # in prod would be string of an array
+    assert 'embedding' not in fields
+
+    # and the embeddings as float32 numpy arrays, for one result or for all the results with a single SQL query
+    assert matched_results[0].embedding.tolist() == [len(matched_results[0].matched_content)]  # in prod a vector
+    embeddings = SearchResult.load_embeddings(matched_results)
+    assert [embedding.tolist() for embedding in embeddings] == [[len(result.matched_content)]
+                                                                for result in matched_results]
 
     # Only if absolutely necessary but should not be used when machine reading
     # you can retrieve the full DocumentRecord object
@@ -186,6 +237,7 @@ def test_chunk_search(reset_db):
     assert document_record.text == _DOCUMENT_TEXTS[0]
     assert isinstance(next(iter(document_record.chunks.values())), DocumentChunk)
     assert len(document_record.chunks) == 1
+    assert next(iter(document_record.chunks.values())).embedding is None  # stored once, see embeddings above
 
     # pprint(document_record)
 
@@ -223,6 +275,219 @@ def test_limit_results(reset_db):
     assert all_matched_results[0].matched_content == limited_matched_results[0].matched_content
     assert all_matched_results[1].matched_content == limited_matched_results[1].matched_content
 
+
+def test_multi_document_search(reset_db):
+    document_ids = [DocumentStore.create_document(_LOGIN, 'Title of doc %d' % idx, 'test', doc_text)['documentId']
+                    for idx, doc_text in enumerate(_DOCUMENT_TEXTS)][::-1]
+    for limit_per_doc in (None, 1, 2):
+        # one query for all the documents, in the same order as one query per document
+        matched_results = list(DocumentStore.search_chunks(_LOGIN, 'one of the two', document_ids=document_ids,
+                                                           limit_per_doc=limit_per_doc))
+        expected_results = list(roundrobin(*(
+            DocumentStore._retriever.retrieve('one of the two', limit=limit_per_doc, user_id=_LOGIN,
+                                              document_id=document_id) for document_id in document_ids)))
+        assert len(matched_results) > 1
+        assert [(result.matched_content, result.matched_score) for result in matched_results] == \
+               [(result.matched_content, result.matched_score) for result in expected_results]
+        assert [result.group for result in matched_results] == \
+               [result.get_retrievable().document_id for result in matched_results]
+
+
+def test_replace_document(reset_db):
+    document_id = DocumentStore.create_document(_LOGIN, 'Title', 'test', _DOCUMENT_TEXTS[0], document_id='doc',
+                                                get_embedding=len)['documentId']
+    unique_id = str((_LOGIN, document_id))
+    stored_rows = DocumentStore._retriever._stored_rows([unique_id])[unique_id]
+    DocumentStore.create_document(_LOGIN, 'New title', 'test', _DOCUMENT_TEXTS[0], document_id='doc',
+                                  get_embedding=len, replace=True)
+    assert DocumentStore._retriever._stored_rows([unique_id])[unique_id].keys() == stored_rows.keys()
+    assert DocumentStore.get_documents(_LOGIN)[0]['title'] == 'New title'
+    DocumentStore.create_document(_LOGIN, 'New title', 'test', _DOCUMENT_TEXTS[1], document_id='doc',
+                                  get_embedding=len, replace=True)
+    matched_results = list(DocumentStore.search_chunks(_LOGIN, _DOCUMENT_TEXTS[1]))
+    assert matched_results[0].matched_content == _DOCUMENT_TEXTS[1]
+    assert matched_results[0].embedding.tolist() == [len(_DOCUMENT_TEXTS[1])]
+    assert len(list(DocumentStore.search_chunks(_LOGIN, 'normans'))) == 0
+
+
+def test_create_documents(reset_db):
+    documents = [{'title': 'Title of doc %d' % idx, 'origin': 'test', 'text': doc_text}
+                 for idx, doc_text in enumerate(_DOCUMENT_TEXTS)]
+    created = DocumentStore.create_documents(_LOGIN, documents, batch_size=4)
+    assert [result['status'] for result in created] == ['created'] * len(_DOCUMENT_TEXTS)
+    assert created[0]['documentId'] == DocumentStore.create_document(_LOGIN, 'first doc', 'test', _DOCUMENT_TEXTS[0],
+                                                                     replace=True)['documentId']
+    assert len(DocumentStore.get_documents(_LOGIN)) == len(_DOCUMENT_TEXTS)
+    assert len(DocumentStore.get_documents(_LOGIN, search_term='normans')) == 1
+
+    created = DocumentStore.create_documents(_LOGIN, [{'title': 'new doc', 'origin': 'test', 'text': 'new text'},
+                                                      documents[1],
+                                                      {'title': 'new doc', 'origin': 'test', 'text': 'new text'}])
+    assert created[0]['status'] == 'created'
+    assert 'error' in created[1] and 'error' in created[2]
+
+    created = DocumentStore.create_documents(_LOGIN, documents[:2], replace=True)
+    assert [result['status'] for result in created] == ['updated', 'unchanged']  # only the first doc was renamed
+    assert len(DocumentStore.get_documents(_LOGIN)) == len(_DOCUMENT_TEXTS) + 1
+    assert len(list(DocumentStore.search_chunks(_LOGIN, 'who were the normans?', limit_per_doc=1))) == 1
+
+    DocumentStore.delete_document(_LOGIN, created[0]['documentId'])
+    assert len(DocumentStore.get_documents(_LOGIN, search_term='normans')) == 0
+
+
+def test_unchanged_documents(reset_db):
+    documents = [{'title': 'Title of doc %d' % idx, 'origin': 'test', 'text': doc_text, 'document_id': str(idx)}
+                 for idx, doc_text in enumerate(_DOCUMENT_TEXTS)]
+    DocumentStore.create_documents(_LOGIN, documents)
+    listed_documents = DocumentStore.get_documents(_LOGIN)
+    created = DocumentStore.create_documents(_LOGIN, documents, replace=True)
+    assert [result['status'] for result in created] == ['unchanged'] * len(_DOCUMENT_TEXTS)
+    assert DocumentStore.get_documents(_LOGIN) == listed_documents  # same created timestamps and order
+
+    documents[3]['text'] += ' One more sentence.'
+    created = DocumentStore.create_documents(_LOGIN, documents, replace=True)
+    assert [result['status'] for result in created].count('updated') == 1
+    assert created[3]['status'] == 'updated'
+    # embeddings are part of the fingerprint
+    created = DocumentStore.create_documents(_LOGIN, documents[:1], replace=True, get_embedding=len)
+    assert created[0]['status'] == 'updated'
+
+
+def test_create_documents_in_worker_processes(reset_db):
+    documents = [{'title': 'Title of doc %d' % idx, 'origin': 'test', 'text': doc_text, 'document_id': str(idx)}
+                 for idx, doc_text in enumerate(_DOCUMENT_TEXTS)]
+    created = DocumentStore.create_documents(_LOGIN, documents, get_embedding=len, batch_size=2, workers=2)
+    assert [result['documentId'] for result in created] == [document['document_id'] for document in documents]
+    assert len(DocumentStore.get_documents(_LOGIN)) == len(_DOCUMENT_TEXTS)
+    matched_results = list(DocumentStore.search_chunks(_LOGIN, 'who were the normans?'))
+    assert matched_results[0].get_retrievable().document_id == '0'
+
+
+def test_batched_embeddings(reset_db):
+    batches = []
+
+    def get_embeddings(texts):
+        batches.append(texts)
+        return [len(text) for text in texts]
+
+    DocumentStore.create_document(_LOGIN, 'first doc', 'test', _DOCUMENT_TEXTS[0], get_embeddings=get_embeddings)
+    assert batches == [[_DOCUMENT_TEXTS[0]]]
+    documents = [{'title': 'Title of doc %d' % idx, 'origin': 'test', 'text': doc_text}
+                 for idx, doc_text in enumerate(_DOCUMENT_TEXTS[1:])]
+    DocumentStore.create_documents(_LOGIN, documents, get_embeddings=get_embeddings, embedding_batch_size=3)
+    assert [len(batch) for batch in batches[1:]] == [3, 3, 2]
+    assert next(DocumentStore.search_chunks(_LOGIN, 'normans')).embedding.tolist() == [len(_DOCUMENT_TEXTS[0])]
+
+
+def test_hybrid_search(reset_db):
+    def get_embeddings(texts):
+        return [[text.count('Norman'), text.count('Amazon')] for text in texts]
+
+    DocumentStore.create_documents(_LOGIN, [{'title': 'Title of doc %d' % idx, 'origin': 'test', 'text': doc_text}
+                                            for idx, doc_text in enumerate(_DOCUMENT_TEXTS)],
+                                   get_embeddings=get_embeddings)
+    lexical_results = list(DocumentStore.search_chunks(_LOGIN, 'the largest'))
+    hybrid_results = list(DocumentStore.search_chunks(_LOGIN, 'the largest', mode='hybrid',
+                                                      query_embedding=[0.0, 1.0], vector_weight=1.0))
+    assert len(hybrid_results) == len(lexical_results)
+    assert hybrid_results[0].matched_content.startswith('The Amazon rainforest')
+    assert hybrid_results[0].vector_score == pytest.approx(1.0)
+    assert hybrid_results[0].matched_score > hybrid_results[1].matched_score
+
+    hybrid_results = list(DocumentStore.search_chunks(_LOGIN, 'the largest', mode='hybrid', query_embedding=[1.0, 0.0],
+                                                      vector_weight=0.5, limit_per_doc=1))
+    assert len(hybrid_results) == 1
+    assert hybrid_results[0].matched_content.startswith('The Normans')
+    with pytest.raises(ValueError):
+        list(DocumentStore.search_chunks(_LOGIN, 'the largest', mode='hybrid'))
+
+
+def test_vector_search(reset_db):
+    def get_embeddings(texts):
+        return [[text.count('Norman'), text.count('Amazon'), 1.0] for text in texts]
+
+    created = DocumentStore.create_documents(_LOGIN, [{'title': 'Title of doc %d' % idx, 'origin': 'test',
+                                                       'text': doc_text}
+                                                      for idx, doc_text in enumerate(_DOCUMENT_TEXTS)],
+                                             get_embeddings=get_embeddings)
+    # no lexical overlap with any chunk
+    matched_results = list(DocumentStore.search_chunks(_LOGIN, 'jungle', mode='vector', query_embedding=[0, 1, 0]))
+    assert len(matched_results) == len(_DOCUMENT_TEXTS)
+    assert matched_results[0].matched_content.startswith('The Amazon rainforest')
+    assert matched_results[0].matched_score > matched_results[1].matched_score
+
+    matched_results = list(DocumentStore.search_chunks(_LOGIN, 'jungle', mode='vector', query_embedding=[0, 1, 0],
+                                                       document_ids=[created[0]['documentId']]))
+    assert len(matched_results) == 1 and matched_results[0].matched_content.startswith('The Normans')
+    assert list(DocumentStore.search_chunks('another user', 'jungle', mode='vector', query_embedding=[0, 1, 0])) == []
+
+    DocumentStore.delete_document(_LOGIN, created[1]['documentId'])
+    matched_results = list(DocumentStore.search_chunks(_LOGIN, 'jungle', mode='vector', query_embedding=[0, 1, 0],
+                                                       limit_per_doc=1))
+    assert not matched_results[0].matched_content.startswith('The Amazon rainforest')
+
+    DocumentStore._retriever.vector_index.clear()  # rebuilt from the stored embeddings
+    assert len(DocumentStore._retriever.vector_index) == len(_DOCUMENT_TEXTS) - 1
+
+
+def test_vector_index_consistency(reset_db):
+    def get_embeddings(texts):
+        return [[text.count('Norman'), text.count('Amazon'), 1.0] for text in texts]
+
+    def create(text, title='Title of doc'):
+        return DocumentStore.create_documents(_LOGIN, [{'title': title, 'origin': 'test', 'text': text}],
+                                              get_embeddings=get_embeddings)[0]['documentId']
+
+    DocumentStore.create_documents(_LOGIN, [{'title': 'No embedding', 'origin': 'test', 'text': 'Not embedded.'}])
+    vector_index = DocumentStore._retriever.vector_index
+    assert vector_index.exists() and len(vector_index) == 0  # created empty, not rebuilt by every write
+
+    normans_id = create(_DOCUMENT_TEXTS[0])
+    with pytest.raises(RuntimeError):
+        with write_transaction():
+            create(_DOCUMENT_TEXTS[1], 'Rolled back')
+            raise RuntimeError()
+    assert len(vector_index) == 1
+    # the docids of the rolled back and of the deleted rows are not reused by the next ones
+    DocumentStore.delete_document(_LOGIN, create(_DOCUMENT_TEXTS[1]))
+    create(_DOCUMENT_TEXTS[2])
+    matched_results = list(DocumentStore.search_chunks(_LOGIN, 'jungle', mode='vector', query_embedding=[0, 1, 0],
+                                                       limit_per_doc=1))
+    assert len(matched_results) == 1 and not matched_results[0].matched_content.startswith('The Amazon rainforest')
+    matched_results = list(DocumentStore.search_chunks(_LOGIN, 'jungle', mode='vector', query_embedding=[1, 0, 0],
+                                                       document_ids=[normans_id], limit_per_doc=1))
+    assert len(matched_results) == 1 and matched_results[0].matched_content.startswith('The Normans')
+
+
+def test_after_commit(reset_db):
+    called = []
+    after_commit(lambda: called.append('now'))
+    with write_transaction():
+        after_commit(lambda: called.append('committed'))
+        with pytest.raises(RuntimeError):
+            with write_transaction():
+                after_commit(lambda: called.append('rolled back'))
+                raise RuntimeError()
+        assert called == ['now']
+    with pytest.raises(RuntimeError):
+        with write_transaction():
+            after_commit(lambda: called.append('rolled back'))
+            raise RuntimeError()
+    assert called == ['now', 'committed']
+
+
+def test_lazy_initialization(tmpdir):
+    database_path = str(tmpdir.join('lazy.sqlite'))
+    script = ('import os\n'
+              'from cape_document_manager.document_store import DocumentStore\n'
+              'from cape_document_manager.annotation_store import AnnotationStore\n'
+              f'assert not os.path.exists({database_path!r})\n'
+              'DocumentStore.warm_up()\n'
+              'AnnotationStore.warm_up()\n'
+              f'assert os.path.exists({database_path!r})\n')
+    subprocess.run([sys.executable, '-c', script], check=True, env=dict(os.environ, CAPE_SQLITE_PATH=database_path))
+
+
 if __name__ == '__main__':
     print("Launching single test")
     test_limit_results(reset_db())
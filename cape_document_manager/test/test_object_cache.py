@@ -0,0 +1,95 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from time import sleep
+from hashlib import sha256
+from cape_document_manager.tables import init_db
+from cape_document_manager.object_cache import ObjectCache, SharedBlobCache
+from cape_document_manager.annotation_store import AnnotationStore
+
+
+def test_byte_budget():
+    cache = ObjectCache(max_bytes=100)
+    assert cache.get('a', lambda: (['a'], 60)) == ['a']
+    assert cache.get('a', lambda: (['not loaded'], 60)) == ['a']
+    cache.get('b', lambda: (['b'], 30))
+    cache.get('a', lambda: (['not loaded'], 60))  # a is now more recently used than b
+    cache.get('c', lambda: (['c'], 30))
+    assert cache.stats == {'hits': 2, 'misses': 3, 'evictions': 1, 'entries': 2, 'bytes': 90}
+    assert cache.get('b', lambda: (['b reloaded'], 30)) == ['b reloaded']
+    cache.get('too big', lambda: (['too big'], 101))
+    assert cache.stats['bytes'] <= 100
+    cache.invalidate(['c', 'unknown'])
+    assert cache.get('c', lambda: (['c reloaded'], 30)) == ['c reloaded']
+
+
+def test_ttl_and_copy_on_read():
+    cache = ObjectCache(max_bytes=100, ttl=0.01, copy_on_read=True)
+    cache.get('a', lambda: (['a'], 1)).append('modified')
+    assert cache.get('a', lambda: (['not loaded'], 1)) == ['a']
+    sleep(0.02)
+    assert cache.get('a', lambda: (['a reloaded'], 1)) == ['a reloaded']
+
+
+def test_retriever_invalidation():
+    init_db(reset_database=True)
+    AnnotationStore._retriever.cache.clear()
+    annotation_id = AnnotationStore.create_annotation('bla@bla.com', 'What is cached?', 'Objects')['annotationId']
+    assert AnnotationStore.get_annotations('bla@bla.com')[0]['answers'][0]['answer'] == 'Objects'
+    assert AnnotationStore._retriever.cache.stats['entries'] == 1
+    AnnotationStore.delete_annotation('bla@bla.com', annotation_id)
+    assert AnnotationStore._retriever.cache.stats['entries'] == 0
+
+
+def test_shared_blob_cache(tmpdir):
+    first_process_cache = SharedBlobCache(str(tmpdir), max_bytes=1000)
+    second_process_cache = SharedBlobCache(str(tmpdir), max_bytes=1000)
+    data = b'blob' * 50
+    content_hash = sha256(data).hexdigest()
+    assert second_process_cache.get(content_hash) is None
+    first_process_cache.put(content_hash, data)
+    assert second_process_cache.get(content_hash) == data
+    first_process_cache.put('not a content hash', data)
+    assert first_process_cache.get('not a content hash') is None
+
+    # corrupted files are never returned
+    with open(tmpdir.join(content_hash), 'wb') as blob_file:
+        blob_file.write(b'corrupted')
+    assert second_process_cache.get(content_hash) is None
+    assert not tmpdir.join(content_hash).exists()
+
+    for idx in range(10):
+        other_data = b'other blob %d' % idx * 20
+        first_process_cache.put(sha256(other_data).hexdigest(), other_data)
+    first_process_cache.sweep()
+    assert sum(blob_file.size() for blob_file in tmpdir.listdir()) <= 1000
+    assert first_process_cache.stats['evictions'] > 0
+
+
+def test_retriever_shared_cache(tmpdir):
+    init_db(reset_database=True)
+    retriever = AnnotationStore._retriever
+    retriever.shared_cache = SharedBlobCache(str(tmpdir), max_bytes=10 ** 6)
+    try:
+        annotation_id = AnnotationStore.create_annotation('bla@bla.com', 'What is shared?', 'Blobs')['annotationId']
+        retriever.cache.clear()
+        AnnotationStore.get_annotations('bla@bla.com')
+        assert len(tmpdir.listdir()) == 1
+        retriever.cache.clear()  # as in another process
+        assert AnnotationStore.get_annotations('bla@bla.com')[0]['answers'][0]['answer'] == 'Blobs'
+        assert retriever.shared_cache.stats['hits'] == 1
+        AnnotationStore.delete_annotation('bla@bla.com', annotation_id)
+        assert len(tmpdir.listdir()) == 0
+    finally:
+        retriever.shared_cache = None
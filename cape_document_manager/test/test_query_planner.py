@@ -0,0 +1,59 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cape_document_manager.query_planner import QueryPlanner
+from cape_document_manager.document_store import DocumentStore
+from cape_document_manager.test.test_document_store import reset_db, _LOGIN, _DOCUMENT_TEXTS
+
+
+def test_query_syntax(reset_db):
+    planner = QueryPlanner()
+    assert planner.compile("Who were the Normans?") == '"who" OR "were" OR "the" OR "normans"'
+    assert planner.compile("What's the time?") == '"whats" OR "the" OR "time"'
+    assert planner.compile("Running, runs and run") == '"running" OR "and"'
+    assert planner.compile('The "Norman conquest" of Engl* ') == '"the" OR "norman conquest" OR "of" OR "engl*"'
+    assert planner.compile('"unbalanced quote') == '"unbalanced" OR "quote"'
+    assert planner.compile('?! ""') == '""'
+    assert QueryPlanner(remove_stopwords=True).compile("Who were the Normans?") == '"normans"'
+    assert QueryPlanner(remove_stopwords=True).compile("Who were they?") == '"who" OR "were" OR "they"'
+
+
+def test_long_queries(reset_db):
+    DocumentStore.create_documents(_LOGIN, ({'title': 'doc %d' % idx, 'origin': 'test', 'text': text}
+                                            for idx, text in enumerate(_DOCUMENT_TEXTS)))
+    planner = QueryPlanner(max_terms=3)
+    counts = planner.document_counts(['norman', 'european', 'the', 'nonexistingword'])
+    assert counts['the'] > counts['european'] == counts['norman'] == 1 and 'nonexistingword' not in counts
+    # stopwords go first, then the most common words, then words missing from the index
+    assert planner.compile('the Normans of the European Union in Europe, a nonexistingword for the union') == \
+           '"normans" OR "european" OR "union"'
+    assert planner.compile('"the normans" of Europe in the nonexistingword european union') == \
+           '"the normans" OR "european" OR "union"'
+    DocumentStore._retriever.query_planner = planner
+    try:
+        results = list(DocumentStore.search_chunks(_LOGIN, ' '.join(_DOCUMENT_TEXTS[0].split()[:100])))
+    finally:
+        DocumentStore._retriever.query_planner = QueryPlanner()
+    assert results[0].matched_content.startswith('The Normans')
+
+
+def test_phrase_search(reset_db):
+    DocumentStore.create_documents(_LOGIN, ({'title': 'doc %d' % idx, 'origin': 'test', 'text': text}
+                                            for idx, text in enumerate(_DOCUMENT_TEXTS)))
+    assert len(list(DocumentStore.search_chunks(_LOGIN, 'the european union'))) > 1
+    phrase_results = list(DocumentStore.search_chunks(_LOGIN, '"european union"'))
+    assert len(phrase_results) == 1 and 'European Union' in phrase_results[0].matched_content
+    assert list(DocumentStore.search_chunks(_LOGIN, '"union european"')) == []
+    prefix_results = list(DocumentStore.search_chunks(_LOGIN, 'oxyg*'))
+    assert len(prefix_results) == 1 and 'Oxygen' in prefix_results[0].matched_content
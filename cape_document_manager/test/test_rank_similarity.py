@@ -0,0 +1,84 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import random
+from array import array
+import pytest
+from cape_document_manager.tables import database
+from cape_document_manager.rank_similarity import python_rank_similarity, _compiled_rank_similarity, \
+    python_rank_bm25, _compiled_rank_bm25, Ranking
+from cape_document_manager.document_store import DocumentStore
+from cape_document_manager.test.test_document_store import reset_db, _LOGIN, _DOCUMENT_TEXTS
+
+
+def random_match_info(rng: random.Random, term_count: int, col_count: int) -> bytes:
+    "A matchinfo(table, 'pcnalx') blob"
+    total_docs = rng.randint(1, 1000)
+    values = [term_count, col_count, total_docs]
+    values += [rng.randint(1, 50) for _ in range(2 * col_count)]  # average and current lengths of the columns
+    for _ in range(term_count * col_count):
+        docs_with_hits = rng.randint(0, total_docs)
+        values += [rng.randint(0, 5), rng.randint(0, 20), docs_with_hits]
+    return array('I', values).tobytes()
+
+
+@pytest.mark.skipif(_compiled_rank_similarity is None, reason="the _rank_similarity extension is not built")
+def test_python_rank_similarity_equivalence():
+    rng = random.Random(0)
+    for _ in range(1000):
+        match_info = random_match_info(rng, rng.randint(0, 6), rng.randint(1, 3))
+        weights = rng.choice([(1.0, 0.0), (1.0, 1.0), (0.0, 0.0), (2.0, 0.5, 1.0)])
+        assert python_rank_similarity(match_info, *weights) == pytest.approx(
+            _compiled_rank_similarity(match_info, *weights))
+        assert python_rank_bm25(match_info, *weights) == pytest.approx(_compiled_rank_bm25(match_info, *weights))
+
+
+def test_python_rank_similarity():
+    assert python_rank_similarity(random_match_info(random.Random(0), 0, 2), 1.0, 0.0) == 0.0
+    with pytest.raises(ValueError):
+        python_rank_similarity(random_match_info(random.Random(0), 3, 2)[:-4], 1.0, 0.0)
+
+
+def test_search_with_python_rank_similarity(reset_db):
+    DocumentStore.create_documents(_LOGIN, ({'title': 'doc %d' % idx, 'origin': 'test', 'text': text}
+                                            for idx, text in enumerate(_DOCUMENT_TEXTS)))
+    searched_ranking = list(DocumentStore.search_chunks(_LOGIN, 'the first oxygen law', limit_per_doc=2))
+    database.register_function(python_rank_similarity, 'rank_similarity')
+    try:
+        python_ranking = list(DocumentStore.search_chunks(_LOGIN, 'the first oxygen law', limit_per_doc=2))
+    finally:
+        database.register_function(_compiled_rank_similarity or python_rank_similarity, 'rank_similarity')
+    assert len(searched_ranking) > 1
+    assert [result.matched_content for result in python_ranking] == \
+           [result.matched_content for result in searched_ranking]
+    assert [result.matched_score for result in python_ranking] == \
+           pytest.approx([result.matched_score for result in searched_ranking])
+
+
+def test_bm25_ranking(reset_db):
+    with pytest.raises(ValueError):
+        Ranking('tf-idf')
+    DocumentStore.create_documents(_LOGIN, ({'title': 'doc %d' % idx, 'origin': 'test', 'text': text}
+                                            for idx, text in enumerate(_DOCUMENT_TEXTS)))
+    similarity_results = list(DocumentStore.search_chunks(_LOGIN, 'the first oxygen law'))
+    bm25_results = list(DocumentStore.search_chunks(_LOGIN, 'the first oxygen law', ranking=Ranking('bm25')))
+    assert sorted(result.matched_content for result in bm25_results) == \
+           sorted(result.matched_content for result in similarity_results)
+    bm25_scores = [result.matched_score for result in bm25_results]
+    assert bm25_scores == sorted(bm25_scores, reverse=True)
+    assert all(0.0 <= score < 1.0 for score in bm25_scores)
+    # chunks are only indexed in the content column, weighting the identifier column alone matches with a 0 score
+    identifier_results = list(DocumentStore.search_chunks(_LOGIN, 'oxygen',
+                                                          ranking=Ranking('bm25', column_weights=(0.0, 1.0))))
+    assert identifier_results and all(result.matched_score == 0.0 for result in identifier_results)
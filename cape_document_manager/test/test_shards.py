@@ -0,0 +1,167 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+import pytest
+from peewee import InterfaceError
+from cape_document_manager import write_queue
+from cape_document_manager.tables import database, DocumentCatalog, Document
+from cape_document_manager.connections import routed, write_transaction
+from cape_document_manager.shards import ShardRouter, shard_router
+from cape_document_manager.write_queue import WriteQueue
+from cape_document_manager.document_store import DocumentStore
+from cape_document_manager.annotation_store import AnnotationStore
+from cape_document_manager.test.test_document_store import reset_db, _DOCUMENT_TEXTS
+
+_LOGIN = 'bla@bla.com'
+_OTHER_LOGIN = 'other@bla.com'
+
+
+@pytest.fixture
+def sharded(reset_db, monkeypatch):
+    monkeypatch.setattr(shard_router, 'mode', 'tenant')
+    yield shard_router
+    shard_router.close_all()
+
+
+def _get_embeddings(texts):
+    return [[text.count('Norman'), text.count('Amazon'), 1.0] for text in texts]
+
+
+def _create(user_id: str):
+    DocumentStore.create_documents(user_id, [{'title': f'Title of doc {idx}', 'origin': 'test', 'text': doc_text}
+                                             for idx, doc_text in enumerate(_DOCUMENT_TEXTS)],
+                                   get_embeddings=_get_embeddings)
+    AnnotationStore.create_annotation(user_id, 'Who are the Normans?', f'Vikings of {user_id}')
+
+
+def _snapshot(user_id: str) -> tuple:
+    "What the stores return for user_id"
+    lexical_results = DocumentStore.search_chunks(user_id, 'Normans', limit_per_doc=1)
+    vector_results = DocumentStore.search_chunks(user_id, 'jungle', mode='vector', query_embedding=[0, 1, 0])
+    return ([(document['id'], document['title'], document['created']) for document in
+             DocumentStore.get_documents(user_id)],
+            [(result.matched_content, result.get_retrievable().document_id) for result in lexical_results],
+            # equal scores come in any order
+            sorted((result.matched_score, result.matched_content, list(result.embedding)) for result in vector_results),
+            [annotation['answerText'] for annotation in AnnotationStore.similar_annotations(user_id, 'Normans')])
+
+
+def test_shard_names():
+    assert ShardRouter('none').shard_name(_LOGIN) is None
+    tenant_router = ShardRouter('tenant', folder='/shards')
+    assert tenant_router.shard_name(_LOGIN) != tenant_router.shard_name(_OTHER_LOGIN)
+    assert tenant_router.shard_path(tenant_router.shard_name(_LOGIN)).startswith('/shards/tenant-')
+    bucket_router = ShardRouter('bucket', number_of_buckets=4)
+    assert {bucket_router.shard_name(f'user {idx}') for idx in range(100)} == \
+           {'bucket-0000', 'bucket-0001', 'bucket-0002', 'bucket-0003'}
+    with pytest.raises(ValueError):
+        ShardRouter('user')
+
+
+
+def test_held_pools(tmpdir):
+    router = ShardRouter('tenant', folder=str(tmpdir), max_open=1)
+    try:
+        with router.held(_LOGIN) as pool:
+            with router.held(_OTHER_LOGIN) as other_pool:
+                with router.held(_LOGIN) as same_pool:
+                    assert same_pool is pool  # held pools are not evicted, whatever max_open
+            with router.held(_OTHER_LOGIN) as new_pool:
+                assert new_pool is not other_pool  # evicted once released
+            with router.tenant(_LOGIN), write_transaction():
+                DocumentCatalog.select().count()
+                assert pool._writer is not None
+        assert list(router._pools) == [router.shard_name(_LOGIN)] and not router._holders
+        assert [pool for pool in router.databases()][1] is pool
+    finally:
+        router.close_all()
+
+def test_tenant_shards(sharded):
+    _create(_LOGIN)
+    _create(_OTHER_LOGIN)
+    assert len(sharded.shard_names()) == 2
+    assert Document.select().count() == 0  # nothing left in the main database
+    for user_id, other_user_id in ((_LOGIN, _OTHER_LOGIN), (_OTHER_LOGIN, _LOGIN)):
+        with sharded.tenant(user_id):
+            assert DocumentCatalog.select().where(DocumentCatalog.user_id == other_user_id).count() == 0
+        documents, lexical, vector, answers = _snapshot(user_id)
+        assert len(documents) == len(_DOCUMENT_TEXTS) and lexical[0][0].startswith('The Normans')
+        assert vector[-1][1].startswith('The Amazon rainforest') and vector[-1][2][1] > 0
+        assert answers == [f'Vikings of {user_id}']
+
+    # the consumer of a generator is not routed between its steps
+    documents = DocumentStore.iter_documents(_LOGIN)
+    other_documents = DocumentStore.iter_documents(_OTHER_LOGIN)
+    for document, other_document in zip(documents, other_documents):
+        assert document['id'] == other_document['id']
+        assert len(DocumentStore.get_documents(_OTHER_LOGIN)) == len(_DOCUMENT_TEXTS)
+
+    DocumentStore.delete_document(_LOGIN, DocumentStore.get_documents(_LOGIN)[0]['id'])
+    assert len(DocumentStore.get_documents(_LOGIN)) == len(_DOCUMENT_TEXTS) - 1
+    assert len(DocumentStore.get_documents(_OTHER_LOGIN)) == len(_DOCUMENT_TEXTS)
+
+    # a transaction can not span databases
+    with database.atomic():
+        with pytest.raises(InterfaceError):
+            DocumentStore.get_documents(_LOGIN)
+
+
+def test_queued_writes(sharded, monkeypatch):
+    monkeypatch.setattr(write_queue, 'WRITE_QUEUE_ENABLED', True)
+    queue = WriteQueue(max_batch_size=8, max_delay=0.01)
+    queue.start()
+    monkeypatch.setattr(WriteQueue, '_started', queue)
+    user_ids = [f'user {idx % 4}' for idx in range(32)]
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda user_id: AnnotationStore.create_annotation(user_id, 'Question', 'Answer'), user_ids))
+    assert len(sharded.shard_names()) == 4
+    assert all(len(AnnotationStore.get_annotations(f'user {idx}')) == 8 for idx in range(4))
+    queue.stop()
+    queue.join()
+
+
+def test_move_to_shards(reset_db, monkeypatch):
+    _create(_LOGIN)
+    _create(_OTHER_LOGIN)
+    snapshots = {user_id: _snapshot(user_id) for user_id in (_LOGIN, _OTHER_LOGIN)}
+    DocumentCatalog.delete().where(DocumentCatalog.user_id == _OTHER_LOGIN).execute()  # backfilled before moving
+
+    monkeypatch.setattr(shard_router, 'mode', 'tenant')
+    try:
+        for pool in shard_router.databases():
+            with routed(pool):
+                assert DocumentStore.move_to_shards(batch_size=1) == {_LOGIN: len(_DOCUMENT_TEXTS),
+                                                                      _OTHER_LOGIN: len(_DOCUMENT_TEXTS)}
+                assert AnnotationStore.move_to_shards() == {_LOGIN: 1, _OTHER_LOGIN: 1}
+        assert Document.select().count() == DocumentCatalog.select().count() == 0
+        assert {user_id: _snapshot(user_id) for user_id in (_LOGIN, _OTHER_LOGIN)} == snapshots
+        # moving again moves nothing, and each shard keeps its tenants when mapped to the same database
+        for pool in shard_router.databases():
+            with routed(pool):
+                assert DocumentStore.move_to_shards() == AnnotationStore.move_to_shards() == {}
+    finally:
+        shard_router.close_all()
+
+    # back to the main database
+    monkeypatch.setattr(shard_router, 'mode', 'none')
+    moved_documents, moved_annotations = {}, {}
+    for pool in islice(shard_router.databases(), 1, None):
+        with routed(pool):
+            moved_documents.update(DocumentStore.move_to_shards())
+            moved_annotations.update(AnnotationStore.move_to_shards())
+    assert moved_documents == {_LOGIN: len(_DOCUMENT_TEXTS), _OTHER_LOGIN: len(_DOCUMENT_TEXTS)}
+    assert moved_annotations == {_LOGIN: 1, _OTHER_LOGIN: 1}
+    assert {user_id: _snapshot(user_id) for user_id in (_LOGIN, _OTHER_LOGIN)} == snapshots
@@ -0,0 +1,74 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+from cape_document_manager.vector_index import VectorIndex
+
+
+@pytest.fixture()
+def vector_index(tmpdir):
+    return VectorIndex(str(tmpdir.join('test')))
+
+
+def test_brute_force_search(vector_index):
+    vectors = np.random.RandomState(0).randn(500, 16)
+    vector_index.add(range(500), vectors)
+    assert len(vector_index) == 500
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = np.argsort(-(normalized @ normalized[42]))[:10].tolist()
+    nearest = vector_index.search(vectors[42], 10)
+    assert [docid for docid, _ in nearest] == expected
+    assert nearest[0] == (42, pytest.approx(1.0))
+
+    assert [docid for docid, _ in vector_index.search(vectors[42], 10, allowed_ids=[1, 2, 3])] != []
+    assert {docid for docid, _ in vector_index.search(vectors[42], 10, allowed_ids=[1, 2, 3])} == {1, 2, 3}
+
+    vector_index.remove([42])
+    assert 42 not in [docid for docid, _ in vector_index.search(vectors[42], 10)]
+    # another instance sees the same files
+    assert len(VectorIndex(vector_index.path)) == 499
+
+    with pytest.raises(ValueError):
+        vector_index.add([1000], [[1.0, 2.0]])
+
+
+def test_ivf_search(vector_index):
+    random_state = np.random.RandomState(0)
+    centers = random_state.randn(8, 32) * 10
+    vectors = np.concatenate([center + random_state.randn(100, 32) for center in centers])
+    vector_index.add(range(len(vectors)), vectors)
+    vector_index.train(8)
+    exact = vector_index.search(vectors[0], 5)
+    approximate = vector_index.search(vectors[0], 5, n_probe=1)
+    assert [docid for docid, _ in approximate] == [docid for docid, _ in exact]
+
+    vector_index.add([10000], [centers[3]])  # assigned to its cluster on insertion
+    assert vector_index.search(centers[3], 1, n_probe=1)[0][0] == 10000
+
+    vector_index.clear()
+    assert len(vector_index) == 0 and vector_index.search(vectors[0], 5) == []
+    assert not vector_index.exists()
+    vector_index.create()
+    assert vector_index.exists() and len(vector_index) == 0
+
+
+def test_iter_nearest(vector_index):
+    vectors = np.random.RandomState(0).randn(100, 8)
+    vector_index.add(range(100), vectors)
+    vector_index.remove([0])
+    batches = list(vector_index.iter_nearest(vectors[0], 10))
+    assert [len(batch) for batch in batches] == [10, 20, 40, 29]
+    assert [docid for batch in batches for docid, _ in batch][:50] == \
+           [docid for docid, _ in vector_index.search(vectors[0], 50)]
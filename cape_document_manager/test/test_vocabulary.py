@@ -0,0 +1,85 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from cape_document_manager.tables import DocumentVocabulary, TermStatistic, IndexDocument
+from cape_document_manager.vocabulary import Vocabulary, stems
+from cape_document_manager.document_store import DocumentStore
+from cape_document_manager.test.test_document_store import reset_db, _LOGIN, _DOCUMENT_TEXTS
+
+
+def _index_counts(terms):
+    "Counts of the FTS index itself, which only holds the chunks of DocumentStore in these tests"
+    counts = dict(DocumentVocabulary
+                  .select(DocumentVocabulary.term, DocumentVocabulary.documents)
+                  .where((DocumentVocabulary.col == '*') & (DocumentVocabulary.term << list(terms)))
+                  .tuples())
+    return {term: counts.get(term, 0) for term in terms}
+
+
+def _statistics():
+    return sorted(TermStatistic
+                  .select(TermStatistic.key_value, TermStatistic.term, TermStatistic.documents)
+                  .where(TermStatistic.retriever == DocumentStore._retriever.name)
+                  .tuples())
+
+
+def test_document_frequencies(reset_db):
+    vocabulary = DocumentStore._retriever.vocabulary
+    vocabulary.clear_cache()
+    DocumentStore.create_documents(_LOGIN, ({'title': 'doc %d' % idx, 'origin': 'test', 'text': text}
+                                            for idx, text in enumerate(_DOCUMENT_TEXTS)))
+    DocumentStore.create_document('other@bla.com', 'other', 'test', 'The Normans and the Saxons', document_id='other')
+    terms = stems(['the', 'normans', 'european', 'saxons', 'nonexistingword'])
+    frequencies = vocabulary.document_frequencies(terms)
+    assert frequencies == _index_counts(terms)
+    assert frequencies['norman'] == 2 and frequencies['nonexistingword'] == 0
+    assert vocabulary.document_frequencies(['norman', 'saxon'], key_value='other@bla.com') == {'norman': 1,
+                                                                                               'saxon': 1}
+    assert vocabulary.document_frequencies(['saxon'], key_value=_LOGIN) == {'saxon': 0}
+    assert vocabulary.number_of_documents() == IndexDocument.select().count()
+    assert vocabulary.number_of_documents('other@bla.com') == 1
+    top_terms = vocabulary.top_terms(5)
+    assert dict(top_terms) == _index_counts([term for term, _ in top_terms])
+    assert [documents for _, documents in top_terms] == sorted((documents for _, documents in top_terms),
+                                                               reverse=True)
+    assert top_terms[0][1] >= max(_index_counts(terms).values())
+    assert vocabulary.top_terms(key_value='other@bla.com', prefix='s') == [('saxon', 1)]
+
+    # the cached entries of the written terms are refreshed, the others are kept
+    cached = dict(vocabulary._cache)
+    DocumentStore.create_document('other@bla.com', 'other', 'test', 'The Saxons', document_id='other',
+                                  replace=True)
+    assert vocabulary.document_frequencies(['norman', 'saxon', 'european'], key_value='other@bla.com') == \
+           {'norman': 0, 'saxon': 1, 'european': 0}
+    assert vocabulary._cache[(None, 'european')] == cached[(None, 'european')]
+    assert vocabulary.document_frequencies(terms) == _index_counts(terms)
+
+    DocumentStore.delete_document(_LOGIN, DocumentStore.get_documents(_LOGIN)[0]['id'])
+    assert vocabulary.document_frequencies(terms) == _index_counts(terms)
+    assert all(documents > 0 for _, _, documents in _statistics())
+
+    # counts maintained incrementally are the counts of a full rebuild
+    statistics = _statistics()
+    vocabulary.rebuild()
+    assert _statistics() == statistics
+
+
+def test_backfill(reset_db):
+    DocumentStore.create_documents(_LOGIN, ({'title': 'doc %d' % idx, 'origin': 'test', 'text': text}
+                                            for idx, text in enumerate(_DOCUMENT_TEXTS)))
+    statistics = _statistics()
+    TermStatistic.delete().execute()  # as written before the statistics were kept
+    vocabulary = Vocabulary(DocumentStore._retriever.name, DocumentStore._retriever.indexes, 'user_id')
+    assert vocabulary.number_of_documents(_LOGIN) == IndexDocument.select().count()
+    assert _statistics() == statistics
@@ -0,0 +1,62 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from cape_api_helpers.exceptions import UserException
+from cape_document_manager import write_queue
+from cape_document_manager.write_queue import WriteQueue
+from cape_document_manager.annotation_store import AnnotationStore
+from cape_document_manager.test.test_document_store import reset_db
+
+_LOGIN = 'bla@bla.com'
+
+
+def test_group_commit(reset_db):
+    queue = WriteQueue(max_batch_size=10)
+    # queued before the writer starts, so applied in a single transaction
+    created = queue.submit(AnnotationStore.create_annotation, _LOGIN, 'Who are the Normans?', 'Vikings')
+    failed = queue.submit(AnnotationStore.delete_annotation, _LOGIN, 'nonexistingannotation')
+    also_created = queue.submit(AnnotationStore.create_annotation, _LOGIN, 'Where is Normandy?', 'France')
+    queue.start()
+    with pytest.raises(UserException):
+        failed.result()
+    annotation_ids = {annotation['id'] for annotation in AnnotationStore.get_annotations(_LOGIN)}
+    assert annotation_ids == {created.result()['annotationId'], also_created.result()['annotationId']}
+    assert (queue.transactions, queue.mutations) == (1, 3)
+    queue.stop()
+    queue.join()
+
+
+def test_queued_writes(reset_db, monkeypatch):
+    monkeypatch.setattr(write_queue, 'WRITE_QUEUE_ENABLED', True)
+    queue = WriteQueue(max_batch_size=8, max_delay=0.01)
+    queue.start()
+    monkeypatch.setattr(WriteQueue, '_started', queue)
+
+    def create_and_edit(thread_number: int):
+        created = AnnotationStore.create_annotation(_LOGIN, f'Question {thread_number}', 'Answer')
+        AnnotationStore.add_answer(_LOGIN, created['annotationId'], f'Answer {thread_number}')
+        return created['annotationId']
+
+    with ThreadPoolExecutor(16) as executor:
+        annotation_ids = list(executor.map(create_and_edit, range(64)))
+    annotations = {annotation['id']: annotation for annotation in AnnotationStore.get_annotations(_LOGIN)}
+    assert annotations.keys() == set(annotation_ids)
+    assert all(len(annotation['answers']) == 2 for annotation in annotations.values())
+    assert queue.mutations == 128 and queue.transactions < queue.mutations
+    with pytest.raises(UserException):
+        AnnotationStore.delete_annotation(_LOGIN, 'nonexistingannotation')
+    queue.stop()
+    queue.join()
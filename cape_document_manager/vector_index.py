@@ -0,0 +1,252 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import fcntl
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple, Optional, Iterable, Generator
+import numpy as np
+
+_DELETED_ID = -1
+_COMPACT_MIN_DELETED_ROWS = 1024
+
+
+def _normalized(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+class VectorIndex:
+    """Memory-mapped float32 matrix of unit-normalized embeddings, with a parallel array of document ids.
+
+    Appends and tombstones go straight to the files (path + '.f32' and path + '.ids') under a file lock,
+    so every process on the host shares the same index. Search is an exact brute-force scan,
+    or once train() was called, a scan of the n_probe closest clusters only (IVF).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.centroids: Optional[np.ndarray] = None
+        self._assignments = np.zeros(0, dtype=np.int32)
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._vectors = np.zeros((0, 0), dtype=np.float32)
+        self._mapped_key = None
+        self._lock = threading.RLock()
+        self._holding_file_lock = False
+
+    @property
+    def _ids_path(self) -> str:
+        return self.path + '.ids'
+
+    @property
+    def _vectors_path(self) -> str:
+        return self.path + '.f32'
+
+    def exists(self) -> bool:
+        return os.path.exists(self._ids_path)
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._refresh()
+            return int(np.count_nonzero(self._ids != _DELETED_ID))
+
+    @property
+    def dimension(self) -> Optional[int]:
+        "Dimension of the stored vectors, None before the first one"
+        with self._lock:
+            self._refresh()
+            return self._vectors.shape[1] if len(self._ids) else None
+
+    @contextmanager
+    def _file_lock(self, operation: int):
+        "Inter-process lock, taken while holding self._lock, re-entrant for the thread already holding it"
+        if self._holding_file_lock:
+            yield
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, operation)
+            self._holding_file_lock = True
+            try:
+                yield
+            finally:
+                self._holding_file_lock = False
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        "Map the files again when they were appended to, compacted or removed, by this or another process"
+        try:
+            ids_stat = os.stat(self._ids_path)
+            mapped_key = (ids_stat.st_ino, ids_stat.st_size)
+        except FileNotFoundError:
+            mapped_key = None
+        if mapped_key == self._mapped_key:
+            return
+        if mapped_key is None or mapped_key[1] == 0:
+            self._ids = np.zeros(0, dtype=np.int64)
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+            self.centroids = None
+            self._assignments = np.zeros(0, dtype=np.int32)
+        else:
+            with self._file_lock(fcntl.LOCK_SH):
+                number_of_rows = os.path.getsize(self._ids_path) // 8
+                dimension = os.path.getsize(self._vectors_path) // (4 * number_of_rows)
+                self._ids = np.memmap(self._ids_path, dtype=np.int64, mode='r+', shape=(number_of_rows,))
+                self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r',
+                                          shape=(number_of_rows, dimension))
+            if mapped_key[0] != (self._mapped_key or (None,))[0]:  # compacted, rows moved
+                self._assignments = np.zeros(0, dtype=np.int32)
+            if self.centroids is not None and len(self._assignments) < number_of_rows:
+                self._assignments = np.concatenate(
+                    [self._assignments, self._nearest_centroids(self._vectors[len(self._assignments):])])
+        self._mapped_key = mapped_key
+
+    def _nearest_centroids(self, vectors: np.ndarray) -> np.ndarray:
+        return np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32) if len(vectors) else \
+            np.zeros(0, dtype=np.int32)
+
+    def add(self, ids: Iterable[int], vectors: Iterable):
+        ids = np.asarray(list(ids), dtype=np.int64)
+        if not len(ids):
+            return
+        vectors = _normalized(np.asarray(list(vectors), dtype=np.float32).reshape(len(ids), -1))
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            if len(self._ids) and vectors.shape[1] != self._vectors.shape[1]:
+                raise ValueError(f"Expected embeddings of dimension {self._vectors.shape[1]}, "
+                                 f"got {vectors.shape[1]}")
+            with open(self._vectors_path, 'ab') as vectors_file:
+                vectors_file.write(vectors.tobytes())
+            with open(self._ids_path, 'ab') as ids_file:
+                ids_file.write(ids.tobytes())
+        with self._lock:
+            self._refresh()
+
+    def remove(self, ids: Iterable[int]):
+        ids = np.asarray(list(ids), dtype=np.int64)
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            self._refresh()
+            deleted_rows = np.isin(self._ids, ids)
+            if deleted_rows.any():
+                self._ids[deleted_rows] = _DELETED_ID
+                self._ids.flush()
+            number_of_deleted_rows = int(np.count_nonzero(self._ids == _DELETED_ID))
+            if number_of_deleted_rows >= _COMPACT_MIN_DELETED_ROWS and \
+                    number_of_deleted_rows * 2 > len(self._ids):
+                self._compact()
+
+    def _compact(self):
+        "Rewrite the files without the deleted rows, the caller holds the exclusive file lock"
+        live_rows = self._ids != _DELETED_ID
+        for file_path, array in ((self._vectors_path, self._vectors[live_rows]),
+                                 (self._ids_path, self._ids[live_rows])):
+            with open(file_path + '.tmp', 'wb') as compacted_file:
+                compacted_file.write(np.ascontiguousarray(array).tobytes())
+            os.replace(file_path + '.tmp', file_path)
+        self._refresh()
+
+    def create(self):
+        "Create the files of an empty index when they are missing, so that it exists() before its first vector"
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            for file_path in (self._vectors_path, self._ids_path):
+                open(file_path, 'ab').close()
+            self._refresh()
+
+    def clear(self):
+        with self._lock, self._file_lock(fcntl.LOCK_EX):
+            for file_path in (self._vectors_path, self._ids_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            self._refresh()
+
+    def train(self, number_of_clusters: int, number_of_iterations: int = 10, sample_size: int = 100000,
+              seed: int = 0):
+        """Cluster the vectors with spherical k-means, after which search() can probe a few clusters only."""
+        with self._lock:
+            self._refresh()
+            live_rows = np.flatnonzero(self._ids != _DELETED_ID)
+            if len(live_rows) < number_of_clusters:
+                raise ValueError(f"Cannot train {number_of_clusters} clusters on {len(live_rows)} vectors")
+            random_state = np.random.RandomState(seed)
+            if len(live_rows) > sample_size:
+                live_rows = np.sort(random_state.choice(live_rows, sample_size, replace=False))
+            live_vectors = np.asarray(self._vectors[live_rows])
+            centroids = live_vectors[random_state.choice(len(live_vectors), number_of_clusters, replace=False)]
+            for _ in range(number_of_iterations):
+                assignments = np.argmax(live_vectors @ centroids.T, axis=1)
+                for cluster in range(number_of_clusters):
+                    members = live_vectors[assignments == cluster]
+                    if len(members):
+                        centroids[cluster] = members.sum(axis=0)
+                centroids = _normalized(centroids)
+            self.centroids = centroids
+            self._assignments = self._nearest_centroids(self._vectors)
+
+    def _scores(self, query_embedding, allowed_ids: Optional[Iterable[int]],
+                n_probe: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+        ":return: the ids of the scanned rows and their cosine similarity, -inf for the rows which are not candidates"
+        with self._lock:
+            self._refresh()
+            ids, vectors, assignments = self._ids, self._vectors, self._assignments
+        query_vector = _normalized(np.asarray(query_embedding, dtype=np.float32).reshape(-1))
+        if not len(ids):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if query_vector.shape[0] != vectors.shape[1]:
+            raise ValueError(f"Expected a query embedding of dimension {vectors.shape[1]}, got {query_vector.shape[0]}")
+        candidates = ids != _DELETED_ID
+        if allowed_ids is not None:
+            candidates &= np.isin(ids, np.fromiter(allowed_ids, dtype=np.int64))
+        if n_probe and self.centroids is not None:
+            probed_clusters = np.argsort(-(self.centroids @ query_vector))[:n_probe]
+            candidates &= np.isin(assignments, probed_clusters)
+            rows = np.flatnonzero(candidates)
+            return np.asarray(ids[rows]), vectors[rows] @ query_vector
+        return np.asarray(ids), np.where(candidates, vectors @ query_vector, -np.inf)
+
+    @staticmethod
+    def _top(scores: np.ndarray, start: int, stop: int) -> np.ndarray:
+        "Positions of the scores ranked start to stop, best first, leaving out the -inf ones"
+        stop = min(stop, int(np.count_nonzero(np.isfinite(scores))))
+        if stop <= start:
+            return np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, stop - 1)[:stop]
+        return top[np.argsort(-scores[top], kind='stable')][start:]
+
+    def search(self, query_embedding, limit: int, allowed_ids: Optional[Iterable[int]] = None,
+               n_probe: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Top limit (id, cosine similarity) pairs, best first.
+
+        :param allowed_ids: only return these ids
+        :param n_probe: only scan the vectors of the n_probe closest clusters, requires train()
+        """
+        ids, scores = self._scores(query_embedding, allowed_ids, n_probe)
+        return [(int(ids[position]), float(scores[position])) for position in self._top(scores, 0, limit)]
+
+    def iter_nearest(self, query_embedding, batch_size: int,
+                     n_probe: Optional[int] = None) -> Generator[List[Tuple[int, float]], None, None]:
+        """Successive batches of (id, cosine similarity) pairs, best first, the first one of batch_size pairs
+        and each next one twice as large, for callers filtering the ids to fetch more of them without scanning
+        the vectors again.
+
+        :param n_probe: only scan the vectors of the n_probe closest clusters, requires train()
+        """
+        ids, scores = self._scores(query_embedding, None, n_probe)
+        start, stop = 0, max(batch_size, 1)
+        while True:
+            top = self._top(scores, start, stop)
+            if not len(top):
+                return
+            yield [(int(ids[position]), float(scores[position])) for position in top]
+            start, stop = stop, stop + 2 * (stop - start)
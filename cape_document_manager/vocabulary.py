@@ -0,0 +1,215 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from functools import partial
+from time import monotonic
+from collections import OrderedDict
+from typing import List, Dict, Iterable, Optional, Tuple
+from peewee import OperationalError, SQL, fn, Tuple as RowValue
+from cape_document_manager.tables import database, Document, Metadata, IndexDocument, Index, TermStatistic
+from cape_document_manager.connections import write_transaction, after_commit
+from cape_document_manager.document_manager_settings import VOCABULARY_CACHE_TTL, VOCABULARY_CACHE_MAX_ENTRIES, \
+    SQLITE_MAX_VARIABLE_NUMBER
+
+_TOKENIZER_TABLE = 'temp.cape_query_tokenizer'
+_ALL_DOCUMENTS_TERM = ''  # never produced by the tokenizer
+
+
+def _execute_with_tokenizer(sql: str, params: Iterable = ()):
+    """Execute sql reading _TOKENIZER_TABLE, a fts3tokenize table with the tokenizer of the Document table,
+    created first when the connection does not have it yet, since temporary tables live as long as their connection"""
+    try:
+        return database.execute_sql(sql, params)
+    except OperationalError:
+        tokenizer = Document._meta.options['tokenize'].split()[0]
+        database.execute_sql(f'CREATE VIRTUAL TABLE IF NOT EXISTS {_TOKENIZER_TABLE} USING fts3tokenize({tokenizer})')
+        return database.execute_sql(sql, params)
+
+
+def stems(words: List[str]) -> List[str]:
+    "Stem of each word, as indexed by the tokenizer of the Document table, words are [0-9a-z] only"
+    if not words:
+        return []
+    return [token for token, in _execute_with_tokenizer(
+        f'SELECT token FROM {_TOKENIZER_TABLE} WHERE input = ? ORDER BY position', (' '.join(words),))]
+
+
+class Vocabulary:
+    """Term statistics of the chunks indexed by a Retriever, kept in the TermStatistic table:
+    how many chunks contain each stemmed term, overall or for each value of the key metadata (e.g. user_id).
+
+    The Retriever calls ensure() then add() and remove() as it writes chunks, which update the counts of their terms
+    by the number of chunks tokenized in SQLite. Lookups are cached in memory, the entries of the terms of the chunks
+    written by this process are refreshed once committed, the others after VOCABULARY_CACHE_TTL seconds.
+
+    :param name: name of the retriever
+    :param indexes: indexes of the retriever
+    :param key: metadata key the statistics are broken down by, None for overall statistics only
+    """
+
+    def __init__(self, name: str, indexes: List[Index], key: Optional[str] = None,
+                 cache_ttl: float = VOCABULARY_CACHE_TTL, cache_max_entries: int = VOCABULARY_CACHE_MAX_ENTRIES):
+        self.name = name
+        self.indexes = indexes
+        self.key = key
+        self.cache_ttl = cache_ttl
+        self.cache_max_entries = cache_max_entries
+        self._cache: 'OrderedDict[Tuple[Optional[str], str], Tuple[int, float]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._checked = False
+
+    def _term_counts_sql(self, docids: List[int]) -> Tuple[str, list]:
+        "SQL of (key value, term, number of chunks) of the chunks, the empty term counting the chunks themselves"
+        key_value = "COALESCE(key_metadata.value, '')" if self.key is not None else "''"
+        key_join = (f'LEFT JOIN {Metadata._meta.table_name} AS key_metadata '
+                    f'ON key_metadata.document_id = document.docid AND key_metadata.key = ? '
+                    if self.key is not None else '')
+        key_params = [self.key] if self.key is not None else []
+        placeholders = ', '.join('?' * len(docids))
+        # The porter tokenizer can truncate a long token in the middle of a UTF-8 character, hence the BLOB
+        sql = (f'SELECT {key_value}, CAST(tokens.token AS BLOB), COUNT(DISTINCT document.docid) '
+               f'FROM {Document._meta.table_name} AS document {key_join}'
+               f'JOIN {_TOKENIZER_TABLE} AS tokens ON tokens.input = document.content '
+               f'WHERE document.docid IN ({placeholders}) GROUP BY 1, 2 '
+               f'UNION ALL SELECT {key_value}, ?, COUNT(*) '
+               f'FROM {Document._meta.table_name} AS document {key_join}'
+               f'WHERE document.docid IN ({placeholders}) GROUP BY 1')
+        return sql, key_params + docids + [_ALL_DOCUMENTS_TERM] + key_params + docids
+
+    def _apply(self, docids: Iterable[int], sign: int):
+        from cape_document_manager.document_manager_core import chunked  # which imports this module
+        for docids_batch in chunked(list(docids), (SQLITE_MAX_VARIABLE_NUMBER - 3) // 2):
+            counts = [(key_value, term if isinstance(term, str) else term.decode('utf-8', 'replace'), documents)
+                      for key_value, term, documents in _execute_with_tokenizer(*self._term_counts_sql(docids_batch))]
+            rows = [{'retriever': self.name, 'key_value': key_value, 'term': term, 'documents': sign * documents}
+                    for key_value, term, documents in counts]
+            for rows_batch in chunked(rows, SQLITE_MAX_VARIABLE_NUMBER // 4):
+                (TermStatistic
+                 .insert_many(rows_batch)
+                 .on_conflict(conflict_target=[TermStatistic.retriever, TermStatistic.key_value, TermStatistic.term],
+                              update={TermStatistic.documents: TermStatistic.documents + SQL('excluded.documents')})
+                 .execute())
+            if sign < 0:
+                for counts_batch in chunked(counts, SQLITE_MAX_VARIABLE_NUMBER // 2 - 1):
+                    (TermStatistic
+                     .delete()
+                     .where((TermStatistic.retriever == self.name) & (TermStatistic.documents <= 0) &
+                            (RowValue(TermStatistic.key_value, TermStatistic.term) <<
+                             [RowValue(key_value, term) for key_value, term, _ in counts_batch]))
+                     .execute())
+            # Once committed, so that no other thread caches the counts again before they change
+            after_commit(partial(self._invalidate, [(key_value, term) for key_value, term, _ in counts]))
+
+    def add(self, docids: Iterable[int]):
+        "Count the chunks, after they were inserted"
+        self._apply(docids, 1)
+
+    def remove(self, docids: Iterable[int]):
+        "Stop counting the chunks, before they are deleted"
+        self._apply(docids, -1)
+
+    def ensure(self):
+        "Count the chunks written before the statistics were kept, the first time this process needs them"
+        if self._checked:
+            return
+        with write_transaction():
+            has_statistics = TermStatistic.select().where(TermStatistic.retriever == self.name).exists()
+            if not has_statistics and IndexDocument.select().where(IndexDocument.index << self.indexes).exists():
+                self.rebuild()
+        self._checked = True
+
+    def rebuild(self):
+        "Recount all the chunks of the retriever"
+        with write_transaction():
+            TermStatistic.delete().where(TermStatistic.retriever == self.name).execute()
+            self._checked = True
+            self.add(docid for docid, in IndexDocument
+                     .select(IndexDocument.document)
+                     .where(IndexDocument.index << self.indexes)
+                     .tuples())
+            after_commit(self.clear_cache)
+
+    def _invalidate(self, entries: Iterable[Tuple[str, str]]):
+        with self._lock:
+            for key_value, term in entries:
+                self._cache.pop((key_value, term), None)
+                self._cache.pop((None, term), None)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def document_frequencies(self, terms: Iterable[str], key_value: Optional[str] = None) -> Dict[str, int]:
+        """Number of chunks containing each term, 0 for the terms which were never indexed
+
+        :param terms: stemmed terms, see stems()
+        :param key_value: only count the chunks with this value of the key, None counts all of them
+        """
+        from cape_document_manager.document_manager_core import chunked  # which imports this module
+        self.ensure()
+        terms = list(OrderedDict.fromkeys(terms))
+        frequencies = {}
+        now = monotonic()
+        with self._lock:
+            for term in terms:
+                entry = self._cache.get((key_value, term))
+                if entry is not None and now - entry[1] <= self.cache_ttl:
+                    frequencies[term] = entry[0]
+                    self._cache.move_to_end((key_value, term))
+        missing_terms = [term for term in terms if term not in frequencies]
+        loaded = dict.fromkeys(missing_terms, 0)
+        for terms_batch in chunked(missing_terms, SQLITE_MAX_VARIABLE_NUMBER - 2):
+            query = (TermStatistic
+                     .select(TermStatistic.term, fn.SUM(TermStatistic.documents))
+                     .where((TermStatistic.retriever == self.name) & (TermStatistic.term << terms_batch))
+                     .group_by(TermStatistic.term))
+            if key_value is not None:
+                query = query.where(TermStatistic.key_value == key_value)
+            loaded.update(query.tuples())
+        with self._lock:
+            for term, documents in loaded.items():
+                self._cache[(key_value, term)] = (documents, now)
+            while len(self._cache) > self.cache_max_entries:
+                self._cache.popitem(last=False)
+        frequencies.update(loaded)
+        return {term: frequencies[term] for term in terms}
+
+    def number_of_documents(self, key_value: Optional[str] = None) -> int:
+        "Number of chunks, with this value of the key when given"
+        return self.document_frequencies([_ALL_DOCUMENTS_TERM], key_value)[_ALL_DOCUMENTS_TERM]
+
+    def top_terms(self, limit: int = 10, key_value: Optional[str] = None,
+                  prefix: str = '') -> List[Tuple[str, int]]:
+        """(term, number of chunks) of the terms in most chunks, e.g. to autocomplete a prefix
+
+        :param limit: maximum number of terms
+        :param key_value: only count the chunks with this value of the key, None counts all of them
+        :param prefix: only the terms starting with prefix
+        """
+        self.ensure()
+        documents = TermStatistic.documents if key_value is not None else fn.SUM(TermStatistic.documents)
+        query = (TermStatistic
+                 .select(TermStatistic.term, documents.alias('documents'))
+                 .where((TermStatistic.retriever == self.name) & (TermStatistic.term != _ALL_DOCUMENTS_TERM))
+                 .order_by(documents.desc(), TermStatistic.term)
+                 .limit(limit))
+        if key_value is not None:
+            query = query.where(TermStatistic.key_value == key_value)
+        else:
+            query = query.group_by(TermStatistic.term)
+        if prefix:
+            query = query.where(TermStatistic.term.startswith(prefix))
+        return list(query.tuples())
+
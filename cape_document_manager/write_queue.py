@@ -0,0 +1,138 @@
+# Copyright 2018 BLEMUNDSBURY AI LIMITED
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import queue
+import threading
+from functools import wraps
+from time import monotonic
+from itertools import groupby
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Tuple
+from cape_document_manager.tables import database
+from cape_document_manager.connections import ConnectionPool, current_pool, routed, write_transaction
+from cape_document_manager.document_manager_settings import WRITE_QUEUE_ENABLED, WRITE_QUEUE_MAX_BATCH_SIZE, \
+    WRITE_QUEUE_MAX_DELAY
+
+_Mutation = Tuple[Future, ConnectionPool, Callable, tuple, dict]
+
+
+class WriteQueue(threading.Thread):
+    """Daemon thread applying the queued mutations of the process in order, several per transaction (group commit),
+    so that a burst of writes pays for one commit instead of one each. Every mutation runs in a savepoint of its own:
+    the one raising an exception is rolled back alone and its future gets the exception,
+    the futures of the others get their results once the transaction is committed.
+    Mutations are applied on the database they were submitted for, e.g. a shard,
+    consecutive mutations of the same database share a transaction.
+
+    :param max_batch_size: maximum number of mutations per transaction
+    :param max_delay: seconds to wait for more mutations after the first one, 0 only groups the mutations
+                      queued while the previous transaction was being committed
+    """
+    _started: Optional['WriteQueue'] = None
+    _start_lock = threading.Lock()
+
+    def __init__(self, max_batch_size: int = WRITE_QUEUE_MAX_BATCH_SIZE, max_delay: float = WRITE_QUEUE_MAX_DELAY):
+        super().__init__(name='cape-write-queue', daemon=True)
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self._mutations: 'queue.Queue[Optional[_Mutation]]' = queue.Queue()
+        self.transactions = 0
+        self.mutations = 0
+
+    @staticmethod
+    def start_once() -> 'WriteQueue':
+        "The write queue of this process, started on first call"
+        with WriteQueue._start_lock:
+            if WriteQueue._started is None or not WriteQueue._started.is_alive():
+                WriteQueue._started = WriteQueue()
+                WriteQueue._started.start()
+            return WriteQueue._started
+
+    def submit(self, function: Callable, *args, **kwargs) -> Future:
+        "Queue a mutation of the database the current thread is routed to"
+        future = Future()
+        self._mutations.put((future, current_pool(), function, args, kwargs))
+        return future
+
+    def _next_batch(self) -> Tuple[List[_Mutation], bool]:
+        ":return: the mutations of the next transaction, and whether the queue was stopped"
+        mutation = self._mutations.get()
+        if mutation is None:
+            return [], True
+        batch = [mutation]
+        deadline = monotonic() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                mutation = self._mutations.get(timeout=max(deadline - monotonic(), 0)) if self.max_delay else \
+                    self._mutations.get_nowait()
+            except queue.Empty:
+                break
+            if mutation is None:
+                return batch, True
+            batch.append(mutation)
+        return batch, False
+
+    def _apply(self, batch: List[_Mutation]):
+        for pool, pool_batch in groupby(batch, key=lambda mutation: mutation[1]):
+            self._apply_transaction(pool, list(pool_batch))
+
+    def _apply_transaction(self, pool: ConnectionPool, batch: List[_Mutation]):
+        outcomes = []
+        try:
+            with routed(pool), write_transaction():
+                for future, _, function, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        with write_transaction():  # a savepoint, whose after_commit() callbacks go if it fails
+                            outcomes.append((future, function(*args, **kwargs), None))
+                    except Exception as error:
+                        outcomes.append((future, None, error))
+        except Exception as error:  # the transaction failed, so did every mutation
+            outcomes = [(future, None, error) for future, _, _, _, _ in batch
+                        if future.running() or future.set_running_or_notify_cancel()]
+        self.transactions += 1
+        self.mutations += len(batch)
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def run(self):
+        try:
+            stopped = False
+            while not stopped:
+                batch, stopped = self._next_batch()
+                if batch:
+                    self._apply(batch)
+        finally:
+            database.close()
+
+    def stop(self):
+        "Stop once the mutations queued so far are applied"
+        self._mutations.put(None)
+
+
+def queued_write(function: Callable) -> Callable:
+    """Run the decorated mutation on the write queue of the process and wait for its result, when WRITE_QUEUE_ENABLED.
+    Mutations called by a queued mutation, or inside a transaction of the caller, run right away."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if not WRITE_QUEUE_ENABLED or isinstance(threading.current_thread(), WriteQueue) or database.in_transaction():
+            return function(*args, **kwargs)
+        return WriteQueue.start_once().submit(function, *args, **kwargs).result()
+
+    return wrapper
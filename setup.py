@@ -13,7 +13,10 @@
 # limitations under the License.
 
 from package_settings import NAME, VERSION, PACKAGES, DESCRIPTION
-from setuptools import setup
+from setuptools import setup, Extension
+from setuptools.command.build_ext import build_ext
+from distutils.errors import CCompilerError, DistutilsExecError, DistutilsPlatformError
+from Cython.Build import cythonize  # a build requirement, see pyproject.toml
 from pathlib import Path
 import json
 import urllib.request
@@ -29,6 +32,30 @@ def _get_github_sha(github_install_url: str):
         return json.loads(response.read())['sha']
 
 
+class OptionalBuildExt(build_ext):
+    """Installs without the extension when it fails to compile, e.g. without a C compiler,
+    rank_similarity then falls back to its pure Python implementation"""
+
+    def run(self):
+        try:
+            super().run()
+        except DistutilsPlatformError as error:
+            self.warn(f'Building the extensions failed, installing without them: {error}')
+
+    def build_extensions(self):
+        self.failed_extensions = []
+        super().build_extensions()
+        # not copied by --inplace builds nor listed in the outputs
+        self.extensions = [ext for ext in self.extensions if ext not in self.failed_extensions]
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except (CCompilerError, DistutilsExecError, DistutilsPlatformError) as error:
+            self.warn(f'Building {ext.name} failed, installing without it: {error}')
+            self.failed_extensions.append(ext)
+
+
 setup(
     name=NAME,
     version=VERSION,
@@ -36,6 +63,10 @@ setup(
     author='Bloomsbury AI',
     author_email='contact@bloomsbury.ai',
     packages=PACKAGES,
+    ext_modules=cythonize([Extension('cape_document_manager._rank_similarity',
+                                     ['cape_document_manager/_rank_similarity.pyx'])],
+                          compiler_directives={'language_level': 3}),
+    cmdclass={'build_ext': OptionalBuildExt},
     include_package_data=True,
     install_requires=[
         'pytest==3.6.4',
@@ -43,6 +74,7 @@ setup(
         'scout==3.0.2',
         'dataclasses==0.6',
         'cytoolz==0.9.0.1',
+        'numpy==1.15.1',
         'cape_splitter==' + _get_github_sha('git+https://github.com/bloomsburyai/cape-splitter#egg=cape_splitter'),
         'cape_api_helpers==' + _get_github_sha(
             'git+https://github.com/bloomsburyai/cape-api-helpers#egg=cape_api_helpers'),